@@ -0,0 +1,252 @@
+"""
+Offline stand-ins for the services the bot talks to, implementing just
+the parts of their interfaces the benchmarked code paths use.
+"""
+
+import datetime
+import time
+
+from src.RetractionBot.db import DEFAULT_BATCH_SIZE, RetractionWriter
+from src.RetractionBot.identifiers import record_identifiers
+
+
+class FakeResponse:
+    """A streamed requests response serving a fixed body."""
+
+    def __init__(self, body, status_code=200, headers=None):
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    @property
+    def content(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError("HTTP %d" % self.status_code)
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i : i + chunk_size]
+
+
+class FakeSession:
+    """
+    Stand-in for requests.Session answering every GET with the same body,
+    or 304 when the request's If-None-Match matches its ETag.
+    """
+
+    def __init__(self, body, etag='"synthetic"'):
+        self.body = body
+        self.etag = etag
+
+    def __call__(self):
+        # Installed in place of the requests.Session class.
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def get(self, url, stream=False, headers=None):
+        if (headers or {}).get("If-None-Match") == self.etag:
+            return FakeResponse(b"", 304)
+        return FakeResponse(self.body, headers={"ETag": self.etag})
+
+
+class FakeEutils:
+    """
+    Stand-in for requests.Session answering E-utilities esearch and efetch
+    requests from PubMed records as returned by pubmed_articles. A search
+    term matches the records with the publication type it quotes.
+    """
+
+    def __init__(self, articles):
+        self.articles = articles
+        self.requests = 0
+        self._history = {}
+
+    def __call__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def get(self, url, params=None, headers=None, stream=False):
+        self.requests += 1
+        if url.endswith("esearch.fcgi"):
+            return self._search(params)
+        return self._fetch(params)
+
+    def _search(self, params):
+        publication_type = params["term"].split('"')[1].lower()
+        first, last = (
+            datetime.datetime.strptime(params[x], "%Y/%m/%d").date()
+            for x in ("mindate", "maxdate")
+        )
+        found = [
+            xml
+            for types, date, xml in self.articles
+            if publication_type in types and first <= date <= last
+        ]
+        query_key = str(len(self._history) + 1)
+        self._history[query_key] = found
+        return FakeResponse(
+            (
+                "<eSearchResult><Count>%d</Count><RetMax>0</RetMax>"
+                "<RetStart>0</RetStart><QueryKey>%s</QueryKey>"
+                "<WebEnv>MCID_synthetic</WebEnv></eSearchResult>"
+                % (len(found), query_key)
+            ).encode("utf-8")
+        )
+
+    def _fetch(self, params):
+        found = self._history[params["query_key"]]
+        start = int(params["retstart"])
+        page = found[start : start + int(params["retmax"])]
+        return FakeResponse(
+            b'<?xml version="1.0" ?>\n<PubmedArticleSet>'
+            + b"".join(page)
+            + b"</PubmedArticleSet>"
+        )
+
+
+class FakeDatabase:
+    """
+    In-memory stand-in for Database. Every method which would be a round
+    trip to MySQL sleeps for latency seconds first, so that the effect of
+    batching can be measured.
+    """
+
+    def __init__(self, latency=0.0, batch_size=DEFAULT_BATCH_SIZE):
+        self.latency = latency
+        self.batch_size = batch_size
+        self.round_trips = 0
+        self.tables = {"retractions": {}, "retractions_new": {}}
+        self.dataset_state = {}
+        self.deletions = {}
+        self.edits = []
+
+    def _round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def save_retractions_to_db(self, rows, table="retractions"):
+        self._round_trip()
+        stored = self.tables[table]
+        for row in rows:
+            stored[(row[1], row[8])] = row
+
+    def delete_retractions(self, origin, record_ids, table="retractions", deleted=None):
+        self._round_trip()
+        stored = self.tables[table]
+        for record_id in record_ids:
+            row = stored.pop((origin, record_id), None)
+            if row is not None:
+                for key in record_identifiers(row[2], row[4]):
+                    self.deletions[key] = deleted or datetime.datetime.now()
+
+    def bulk_writer(self, origin, table="retractions", batch_size=None):
+        return RetractionWriter(self, origin, batch_size or self.batch_size, table)
+
+    def has_retractions(self, origin):
+        self._round_trip()
+        return any(x[0] == origin for x in self.tables["retractions"])
+
+    def load_row_hashes(self, origin, table="retractions"):
+        self._round_trip()
+        return {x[8]: x[9] for x in self.tables[table].values() if x[1] == origin}
+
+    def create_shadow_table(self):
+        self._round_trip()
+        self.tables["retractions_new"] = dict(self.tables["retractions"])
+
+    def swap_shadow_table(self):
+        self._round_trip()
+        self.tables["retractions"] = self.tables.pop("retractions_new")
+        self.tables["retractions_new"] = {}
+
+    def get_dataset_state(self, origin):
+        self._round_trip()
+        return self.dataset_state.get(origin, (None, None))
+
+    def save_dataset_state(self, origin, etag, last_modified):
+        self._round_trip()
+        self.dataset_state[origin] = (etag, last_modified)
+
+    def load_retractions(self):
+        """Returns rows as bytes, the way pymysql returns them."""
+        self._round_trip()
+        return [
+            tuple(str(x).encode("utf-8") for x in row[1:8])
+            for row in self.tables["retractions"].values()
+        ]
+
+    def load_identifier_versions(self):
+        self._round_trip()
+        versions = {}
+        for row in self.tables["retractions"].values():
+            for key in record_identifiers(row[2], row[4]):
+                versions[key] = max(versions.get(key, row[10]), row[10])
+        for key, deleted in self.deletions.items():
+            versions[key] = max(versions.get(key, deleted), deleted)
+        return versions
+
+    def load_retracted_identifiers(self):
+        self._round_trip()
+        return [(x[2], x[4]) for x in self.tables["retractions"].values()]
+
+    def log_retraction_edit(self, timestamp, domain, page_title, orig_doi, orig_pmid):
+        self._round_trip()
+        self.edits.append((timestamp, domain, str(page_title), orig_doi, orig_pmid))
+
+
+class FakePage:
+    def __init__(self, title, text):
+        self._title = title
+        self.text = text
+
+    def __repr__(self):
+        return "FakePage(%r)" % self._title
+
+    def title(self):
+        return self._title
+
+
+class FakeSite:
+    """
+    Stand-in for a pywikibot Site serving page text from memory, taking
+    latency seconds for each API request.
+    """
+
+    def __init__(self, code="en", latency=0.0):
+        self.code = code
+        self.latency = latency
+        self.requests = 0
+
+    def preloadpages(self, pages, groupsize=50):
+        for i in range(0, len(pages), groupsize):
+            self.requests += 1
+            if self.latency:
+                time.sleep(self.latency)
+            yield from pages[i : i + groupsize]
+
+
+class NoLimit:
+    """RateLimiter which never waits."""
+
+    def call(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
@@ -0,0 +1,351 @@
+"""
+Offline benchmarks of Retraction Watch ingest and page processing, run
+against synthetic data and in-memory stand-ins for the DB and wikis.
+
+    python -m benchmarks.run --rows 60000 --pages 2000 --output bench.json
+    python -m benchmarks.run --baseline bench.json
+
+Results are written as JSON. Given a baseline from an earlier run, any
+metric which has got worse by more than the tolerance is reported and the
+exit status is 1.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import unittest.mock
+
+# The bot's modules import pywikibot, which otherwise wants a user-config.py.
+os.environ.setdefault("PYWIKIBOT_NO_USER_CONFIG", "2")
+
+from src.RetractionBot import find_retractions  # noqa: E402
+from src.RetractionBot.db import Database  # noqa: E402
+from src.RetractionBot.pipeline import (  # noqa: E402
+    ANALYSIS_WORKERS,
+    PRELOAD_GROUP_SIZE,
+    analyse_pages,
+)
+from src.RetractionBot.retraction_bot import (  # noqa: E402
+    load_bot_settings,
+    process_page,
+)
+from src.RetractionBot.retraction_index import RetractionIndex  # noqa: E402
+from src.RetractionBot.rewrite import RewriteEngine, build_decisions  # noqa: E402
+from src.RetractionBot.snapshot import SnapshotIndex, write_snapshot  # noqa: E402
+
+from .fakes import (  # noqa: E402
+    FakeDatabase,
+    FakeEutils,
+    FakePage,
+    FakeSession,
+    FakeSite,
+    NoLimit,
+)
+from .synthetic import (  # noqa: E402
+    pubmed_articles,
+    retraction_csv,
+    retraction_rows,
+    wikitext_corpus,
+)
+
+# Metrics compared against a baseline, and whether higher is better.
+METRICS = {
+    ("ingest_full", "rows_per_sec"): True,
+    ("ingest_unchanged", "rows_per_sec"): True,
+    ("ingest_ncbi", "records_per_sec"): True,
+    ("index", "seconds"): False,
+    ("snapshot", "open_seconds"): False,
+    ("pages", "pages_per_sec"): True,
+    ("pages", "latency_ms", "p50"): False,
+    ("pages", "latency_ms", "p99"): False,
+}
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0.0
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_ingest(database, body, rows, etag):
+    """Times one get_crossref_retractions run over body."""
+    with unittest.mock.patch.object(
+        find_retractions.requests, "Session", FakeSession(body, etag)
+    ):
+        round_trips = getattr(database, "round_trips", None)
+        start = time.perf_counter()
+        find_retractions.get_crossref_retractions(database)
+        seconds = time.perf_counter() - start
+    results = {
+        "rows": rows,
+        "seconds": seconds,
+        "rows_per_sec": rows / seconds,
+    }
+    if round_trips is not None:
+        results["db_round_trips"] = database.round_trips - round_trips
+    return results
+
+
+def bench_ncbi(database, articles):
+    """
+    Times one get_ncbi_retractions run against articles, with pages and a
+    search limit small enough that searches are split and paged as
+    PubMed's are at full size.
+    """
+    session = FakeEutils(articles)
+    with unittest.mock.patch.object(
+        find_retractions.requests, "Session", session
+    ), unittest.mock.patch.object(
+        find_retractions, "NCBI_FETCH_SIZE", 200
+    ), unittest.mock.patch.object(
+        find_retractions, "NCBI_SEARCH_LIMIT", 1000
+    ):
+        round_trips = database.round_trips
+        start = time.perf_counter()
+        find_retractions.get_ncbi_retractions(database, limiter=NoLimit())
+        seconds = time.perf_counter() - start
+    return {
+        "records": len(articles),
+        "rows": len(database.load_retracted_identifiers()),
+        "seconds": seconds,
+        "records_per_sec": len(articles) / seconds,
+        "requests": session.requests,
+        "db_round_trips": database.round_trips - round_trips,
+    }
+
+
+def bench_pages(index, engine, corpus, site, workers, groupsize):
+    """
+    Times the page-processing path of run_language, fetching pages from
+    site and analysing them on workers threads.
+    """
+    latencies = []
+
+    def analyse(page_text):
+        start = time.perf_counter()
+        result = process_page(page_text, index, engine)
+        latencies.append(time.perf_counter() - start)
+        return result
+
+    pages = [FakePage(title, text) for title, text in corpus]
+    changed = 0
+    flagged = 0
+    start = time.perf_counter()
+    for page, (page_text, changes) in analyse_pages(
+        site, pages, analyse, workers=workers, groupsize=groupsize, limiter=NoLimit()
+    ):
+        if page_text != page.text:
+            changed += 1
+            flagged += len(changes)
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "pages": len(pages),
+        "bytes": sum(len(x.text) for x in pages),
+        "seconds": seconds,
+        "pages_per_sec": len(pages) / seconds,
+        "changed": changed,
+        "flagged": flagged,
+        "latency_ms": {
+            "p50": percentile(latencies, 50) * 1000,
+            "p90": percentile(latencies, 90) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+            "max": latencies[-1] * 1000 if latencies else 0.0,
+        },
+    }
+
+
+def run(args):
+    body = retraction_csv(args.rows, args.seed)
+    if args.sqlite:
+        database = Database(
+            {"backend": "sqlite", "path": args.sqlite, "batch_size": args.batch_size}
+        )
+        database.migrate()
+        database.truncate_db()
+    else:
+        database = FakeDatabase(latency=args.db_latency, batch_size=args.batch_size)
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "parameters": vars(args).copy(),
+    }
+    results["parameters"].pop("baseline")
+    results["parameters"].pop("output")
+    results["parameters"]["sqlite"] = bool(args.sqlite)
+
+    # Each run uses a new ETag, so the file is downloaded and parsed again.
+    results["ingest_full"] = bench_ingest(database, body, args.rows, '"v1"')
+    # Every row is unchanged the second time, so nothing should be written.
+    results["ingest_unchanged"] = bench_ingest(database, body, args.rows, '"v2"')
+    # PubMed records of the same notices, ingested into a database of their
+    # own so the index and page benchmarks are unaffected.
+    results["ingest_ncbi"] = bench_ncbi(
+        FakeDatabase(latency=args.db_latency, batch_size=args.batch_size),
+        pubmed_articles(retraction_rows(args.rows, args.seed)),
+    )
+
+    start = time.perf_counter()
+    index = RetractionIndex.from_database(database)
+    index.matcher
+    results["index"] = {
+        "records": index.count,
+        "identifiers": len(index),
+        "seconds": time.perf_counter() - start,
+        "approximate_bytes": index.approximate_size(),
+    }
+
+    snapshot_dir = tempfile.TemporaryDirectory()
+    snapshot_path = os.path.join(snapshot_dir.name, "retractions.snapshot")
+    start = time.perf_counter()
+    size = write_snapshot(snapshot_path, index, database.load_retracted_identifiers())
+    write_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    snapshot = SnapshotIndex(snapshot_path)
+    snapshot.matcher
+    results["snapshot"] = {
+        "bytes": size,
+        "write_seconds": write_seconds,
+        "open_seconds": time.perf_counter() - start,
+    }
+    if args.snapshot:
+        # Pages are processed with lookups served from the mapped file.
+        index = snapshot
+
+    settings = load_bot_settings()
+    template_map = settings["template_name_map"][args.language]
+    field_map = settings["template_field_names"][args.language]
+    start = time.perf_counter()
+    decisions = build_decisions(index, template_map, field_map)
+    results["decisions"] = {
+        "count": len(decisions),
+        "seconds": time.perf_counter() - start,
+    }
+    engine = RewriteEngine(template_map, field_map, decisions)
+    corpus = list(
+        wikitext_corpus(
+            retraction_rows(args.rows, args.seed),
+            args.pages,
+            references=args.references,
+            hit_rate=args.hit_rate,
+            seed=args.seed,
+        )
+    )
+    results["pages"] = bench_pages(
+        index,
+        engine,
+        corpus,
+        FakeSite(args.language, latency=args.site_latency),
+        args.workers,
+        args.group_size,
+    )
+    snapshot.close()
+    snapshot_dir.cleanup()
+    return results
+
+
+def _lookup(results, path):
+    for key in path:
+        results = results.get(key, {}) if isinstance(results, dict) else {}
+    return results if isinstance(results, (int, float)) else None
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of descriptions of the metrics which are worse than in
+    baseline by more than tolerance, a fraction.
+    """
+    regressions = []
+    for path, higher_is_better in METRICS.items():
+        new, old = _lookup(results, path), _lookup(baseline, path)
+        if not new or not old:
+            continue
+        change = (new - old) / old
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            regressions.append(
+                "%s: %.4g -> %.4g (%+.1f%%)" % (".".join(path), old, new, change * 100)
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=20000, help="CSV records")
+    parser.add_argument("--pages", type=int, default=500, help="wikitext pages")
+    parser.add_argument(
+        "--references", type=int, default=30, help="references per page"
+    )
+    parser.add_argument(
+        "--hit-rate",
+        type=float,
+        default=0.9,
+        help="share of pages citing a retracted work",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--language", default="en")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=ANALYSIS_WORKERS)
+    parser.add_argument("--group-size", type=int, default=PRELOAD_GROUP_SIZE)
+    parser.add_argument(
+        "--db-latency", type=float, default=0.0, help="seconds per DB round trip"
+    )
+    parser.add_argument(
+        "--site-latency", type=float, default=0.0, help="seconds per API request"
+    )
+    parser.add_argument(
+        "--sqlite",
+        help="ingest into an SQLite database at this path instead of in memory",
+    )
+    parser.add_argument(
+        "--snapshot",
+        action="store_true",
+        help="process pages against a snapshot of the index instead",
+    )
+    parser.add_argument("--output", help="write results here instead of stdout")
+    parser.add_argument("--baseline", help="results of an earlier run to compare")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="fractional change in a metric reported as a regression",
+    )
+    args = parser.parse_args()
+
+    # The per-row and per-page log lines would dominate the timings.
+    logging.disable(logging.INFO)
+
+    results = run(args)
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(report + "\n")
+    else:
+        print(report)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print("Regression in " + regression, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
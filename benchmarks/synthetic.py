@@ -0,0 +1,326 @@
+import csv
+import datetime
+import io
+import random
+
+# Columns of the Retraction Watch CSV, in the order Crossref publishes them.
+RETRACTION_WATCH_COLUMNS = (
+    "Record ID",
+    "Title",
+    "Subject",
+    "Institution",
+    "Journal",
+    "Publisher",
+    "Country",
+    "Author",
+    "URLS",
+    "ArticleType",
+    "RetractionDate",
+    "RetractionDOI",
+    "RetractionPubMedID",
+    "OriginalPaperDate",
+    "OriginalPaperDOI",
+    "OriginalPaperPubMedID",
+    "RetractionNature",
+    "Reason",
+    "Paywalled",
+    "Notes",
+)
+
+# Roughly the mix of natures in the real dataset.
+NATURES = (
+    ("Retraction", 0.82),
+    ("Correction", 0.1),
+    ("Expression of concern", 0.06),
+    ("Reinstatement", 0.02),
+)
+
+WORDS = (
+    "cell protein expression cancer patients clinical trial gene analysis "
+    "study effect treatment model response tumor signalling pathway mouse "
+    "human risk outcome therapy receptor inhibition association review"
+).split()
+
+
+def _words(rng, count):
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def _date(rng):
+    date = datetime.datetime(1980, 1, 1) + datetime.timedelta(
+        minutes=rng.randrange(45 * 365 * 24 * 60)
+    )
+    return "%d/%d/%d %d:%02d" % (
+        date.month,
+        date.day,
+        date.year,
+        date.hour,
+        date.minute,
+    )
+
+
+def _nature(rng):
+    value = rng.random()
+    for nature, share in NATURES:
+        if value < share:
+            return nature
+        value -= share
+    return NATURES[0][0]
+
+
+def retraction_rows(count, seed=0):
+    """
+    Yields count dicts keyed by RETRACTION_WATCH_COLUMNS, shaped like the
+    Retraction Watch data: some works have several notices, some have no
+    PMID and some notices have no DOI.
+    """
+    rng = random.Random(seed)
+    work = 0
+    for record_id in range(1, count + 1):
+        # About one work in twenty has a second notice.
+        if rng.random() > 0.05 or work == 0:
+            work += 1
+        has_pmid = rng.random() < 0.6
+        yield {
+            "Record ID": str(record_id),
+            "Title": _words(rng, rng.randint(6, 16)).capitalize(),
+            "Subject": "(BLS) Biology - Cellular;(HSC) Medicine - Oncology;",
+            "Institution": "Department of " + _words(rng, 2).title() + ";",
+            "Journal": "Journal of " + _words(rng, 2).title(),
+            "Publisher": rng.choice(("Elsevier", "Springer", "Wiley", "PLoS")),
+            "Country": rng.choice(("China", "United States", "India", "Germany")),
+            "Author": ";".join(_words(rng, 2).title() for _ in range(4)),
+            "URLS": ";".join(
+                "https://retractionwatch.com/%d/" % rng.randrange(10**6)
+                for _ in range(rng.randint(0, 2))
+            ),
+            "ArticleType": "Research Article;",
+            "RetractionDate": _date(rng),
+            "RetractionDOI": (
+                "10.%d/ret.%d" % (1000 + work % 500, record_id)
+                if rng.random() < 0.9
+                else "unavailable"
+            ),
+            "RetractionPubMedID": str(30000000 + record_id) if has_pmid else "0",
+            "OriginalPaperDate": _date(rng),
+            "OriginalPaperDOI": "10.%d/journal.%d" % (1000 + work % 500, work),
+            "OriginalPaperPubMedID": str(10000000 + work) if has_pmid else "0",
+            "RetractionNature": _nature(rng),
+            "Reason": "+Concerns/Issues About Data;+Investigation by Journal;",
+            "Paywalled": "No",
+            "Notes": _words(rng, rng.randint(0, 20)),
+        }
+
+
+def retraction_csv(count, seed=0):
+    """Returns a synthetic Retraction Watch CSV of count records as bytes."""
+    out = io.StringIO()
+    writer = csv.DictWriter(
+        out, fieldnames=RETRACTION_WATCH_COLUMNS, quoting=csv.QUOTE_ALL
+    )
+    writer.writeheader()
+    writer.writerows(retraction_rows(count, seed))
+    return out.getvalue().encode("utf-8")
+
+
+def _cite_journal(rng, doi=None, pmid=None):
+    params = [
+        "last=" + rng.choice(WORDS).title(),
+        "first=" + rng.choice("ABCDEFGHJKLMNPRSTW"),
+        "title=" + _words(rng, rng.randint(5, 12)).capitalize(),
+        "journal=Journal of " + _words(rng, 2).title(),
+        "year=%d" % rng.randint(1980, 2024),
+        "volume=%d" % rng.randint(1, 300),
+        "pages=%d–%d" % (rng.randint(1, 500), rng.randint(501, 900)),
+    ]
+    if doi:
+        params.append("doi=" + doi)
+    if pmid:
+        params.append("pmid=" + pmid)
+    return "{{cite journal |" + " |".join(params) + "}}"
+
+
+def _cite_web(rng):
+    return (
+        "{{cite web |url=https://example.org/%d |title=%s |access-date=2024-01-01}}"
+        % (rng.randrange(10**6), _words(rng, 4).capitalize())
+    )
+
+
+def _clean_identifiers(rng):
+    # Identifiers which aren't in the synthetic dataset.
+    return (
+        "10.%d/clean.%d" % (rng.randint(5000, 9999), rng.randrange(10**7)),
+        str(rng.randint(20000000, 29999999)),
+    )
+
+
+def _reference(rng, retracted):
+    """
+    Returns the wikitext of one <ref>, citing retracted, an (original DOI,
+    original PMID) pair, or a work not in the dataset if it is None.
+    """
+    if retracted:
+        doi, pmid = retracted
+        pmid = pmid if pmid != "0" else None
+    else:
+        doi, pmid = _clean_identifiers(rng)
+    kind = rng.random()
+    if kind < 0.55:
+        body = _cite_journal(rng, doi, pmid if rng.random() < 0.7 else None)
+    elif kind < 0.65:
+        body = "%s. ''%s''. {{doi|%s}}" % (
+            _words(rng, 3).title(),
+            _words(rng, 6).capitalize(),
+            doi,
+        )
+    elif kind < 0.7 and pmid:
+        body = "%s. {{pmid|%s}}" % (_words(rng, 6).capitalize(), pmid)
+    elif retracted:
+        body = _cite_journal(rng, doi, pmid)
+    else:
+        body = _cite_web(rng)
+    if retracted and rng.random() < 0.2:
+        # Already flagged by an earlier run, or by hand.
+        body += "{{Retracted|doi=10.1000/old|intentional=yes}}"
+    return "<ref>" + body + "</ref>"
+
+
+def wikitext_page(rng, retracted, references=30):
+    """
+    Returns the text of one article with about the given number of
+    references, citing each of the retracted (DOI, PMID) pairs once.
+    """
+    cited = [None] * max(references - len(retracted), 0) + list(retracted)
+    rng.shuffle(cited)
+    parts = [
+        "{{Short description|%s}}\n{{Infobox medical condition\n| name = %s\n"
+        "| field = Oncology\n}}\n"
+        % (_words(rng, 3).capitalize(), _words(rng, 2).title())
+    ]
+    for i, item in enumerate(cited):
+        if i % 6 == 0:
+            parts.append("\n== %s ==\n" % _words(rng, 2).title())
+        parts.append(
+            "%s [[%s]] %s.%s "
+            % (
+                _words(rng, rng.randint(8, 30)).capitalize(),
+                rng.choice(WORDS),
+                _words(rng, rng.randint(4, 15)),
+                _reference(rng, item),
+            )
+        )
+    parts.append(
+        "\n== References ==\n{{Reflist}}\n\n[[Category:%s]]\n" % _words(rng, 2).title()
+    )
+    return "".join(parts)
+
+
+def wikitext_corpus(rows, pages, references=30, hit_rate=0.9, seed=0):
+    """
+    Yields (title, text) for pages synthetic articles citing works from
+    rows, dicts as yielded by retraction_rows. A hit_rate share of the
+    pages cite between one and three retracted works, as pages found by
+    searching for them do; the rest cite none.
+    """
+    rng = random.Random(seed)
+    works = sorted({(x["OriginalPaperDOI"], x["OriginalPaperPubMedID"]) for x in rows})
+    for number in range(pages):
+        retracted = []
+        if works and rng.random() < hit_rate:
+            retracted = rng.sample(works, min(len(works), rng.randint(1, 3)))
+        yield "Synthetic article %d" % number, wikitext_page(rng, retracted, references)
+
+
+# PubMed publication types and CommentsCorrections reference types of the
+# notice and original article records for each nature.
+PUBMED_NOTICES = {
+    "Retraction": ("Retraction of Publication", "RetractionOf", "RetractionIn"),
+    "Expression of concern": (
+        "Expression of Concern",
+        "ExpressionOfConcernFor",
+        "ExpressionOfConcernIn",
+    ),
+    "Correction": ("Published Erratum", "ErratumFor", "ErratumIn"),
+}
+
+
+def _pubmed_date(value):
+    return datetime.datetime.strptime(value, "%m/%d/%Y %H:%M").date()
+
+
+def pubmed_articles(rows):
+    """
+    Returns (publication types, date, PubmedArticle XML) for the PubMed
+    records of the notices in rows, dicts as yielded by retraction_rows,
+    and of the works they are about, ordered by PMID. Rows without PMIDs
+    and reinstatements aren't in PubMed. Retracted works are tagged as
+    Retracted Publication; other works are only linked from their notices.
+    """
+    articles = {}
+
+    def article(pmid, doi, date):
+        return articles.setdefault(
+            pmid, {"types": set(), "doi": doi, "date": date, "links": []}
+        )
+
+    for row in rows:
+        notice = PUBMED_NOTICES.get(row["RetractionNature"])
+        if notice is None or row["OriginalPaperPubMedID"] == "0":
+            continue
+        publication_type, notice_ref, original_ref = notice
+        original_pmid = row["OriginalPaperPubMedID"]
+        retraction_pmid = row["RetractionPubMedID"]
+        retraction_doi = row["RetractionDOI"]
+        original = article(
+            original_pmid,
+            row["OriginalPaperDOI"],
+            _pubmed_date(row["OriginalPaperDate"]),
+        )
+        if row["RetractionNature"] == "Retraction":
+            original["types"].add("Retracted Publication")
+            original["links"].append((original_ref, retraction_pmid))
+        notice_article = article(
+            retraction_pmid,
+            retraction_doi if retraction_doi != "unavailable" else None,
+            _pubmed_date(row["RetractionDate"]),
+        )
+        notice_article["types"].add(publication_type)
+        notice_article["links"].append((notice_ref, original_pmid))
+
+    result = []
+    for pmid in sorted(articles, key=int):
+        data = articles[pmid]
+        ids = '<ArticleId IdType="pubmed">%s</ArticleId>' % pmid
+        if data["doi"]:
+            ids += '<ArticleId IdType="doi">%s</ArticleId>' % data["doi"]
+        links = "".join(
+            '<CommentsCorrections RefType="%s"><RefSource>Journal</RefSource>'
+            '<PMID Version="1">%s</PMID></CommentsCorrections>' % link
+            for link in data["links"]
+        )
+        types = "".join(
+            "<PublicationType>%s</PublicationType>" % x for x in sorted(data["types"])
+        )
+        xml = (
+            '<PubmedArticle><MedlineCitation Status="MEDLINE">'
+            '<PMID Version="1">%s</PMID><Article><ArticleTitle>Article %s'
+            "</ArticleTitle><PublicationTypeList>%s</PublicationTypeList>"
+            "</Article><CommentsCorrectionsList>%s</CommentsCorrectionsList>"
+            '</MedlineCitation><PubmedData><History><PubMedPubDate PubStatus="pubmed">'
+            "<Year>%d</Year><Month>%d</Month><Day>%d</Day></PubMedPubDate></History>"
+            "<ArticleIdList>%s</ArticleIdList></PubmedData></PubmedArticle>"
+        ) % (
+            pmid,
+            pmid,
+            types,
+            links,
+            data["date"].year,
+            data["date"].month,
+            data["date"].day,
+            ids,
+        )
+        result.append(
+            ({x.lower() for x in data["types"]}, data["date"], xml.encode("utf-8"))
+        )
+    return result
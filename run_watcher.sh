@@ -0,0 +1,4 @@
+#/bin/sh
+
+cd $HOME/RetractionBot
+venv/bin/python -m src.RetractionBot.watcher
@@ -6,7 +6,28 @@ CREATE TABLE `retractions` (
   `original_pmid` varbinary(200) NOT NULL,
   `retraction_pmid` varbinary(200) NOT NULL,
   `retraction_nature` varbinary(200) NOT NULL,
-  `url` varbinary(5000) NOT NULL
+  `url` varbinary(5000) NOT NULL,
+  `record_id` varbinary(50) NOT NULL,
+  `row_hash` varbinary(40) NOT NULL,
+  `added` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `changed` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  UNIQUE KEY `origin_record_id` (`origin`, `record_id`)
+) ENGINE=Aria;
+
+CREATE TABLE `retraction_identifiers` (
+  `id_type` varbinary(4) NOT NULL,
+  `id_value` varbinary(200) NOT NULL,
+  `origin` varbinary(20) NOT NULL,
+  `record_id` varbinary(50) NOT NULL,
+  PRIMARY KEY (`id_type`, `id_value`, `origin`, `record_id`),
+  KEY `origin_record_id` (`origin`, `record_id`)
+) ENGINE=Aria;
+
+CREATE TABLE `retraction_deletions` (
+  `id_type` varbinary(4) NOT NULL,
+  `id_value` varbinary(200) NOT NULL,
+  `deleted` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id_type`, `id_value`)
 ) ENGINE=Aria;
 
 CREATE TABLE `edit_log` (
@@ -16,5 +37,84 @@ CREATE TABLE `edit_log` (
   `original_doi` varbinary(200) NOT NULL,
   `retraction_doi` varbinary(200) NOT NULL,
   `original_pmid` varbinary(200) NOT NULL,
-  `retraction_pmid` varbinary(200) NOT NULL
-) ENGINE=Aria;
\ No newline at end of file
+  `retraction_pmid` varbinary(200) NOT NULL,
+  KEY `page_title_doi` (`page_title`, `original_doi`)
+) ENGINE=Aria;
+
+CREATE TABLE `dataset_state` (
+  `origin` varbinary(20) NOT NULL PRIMARY KEY,
+  `etag` varbinary(255) NULL,
+  `last_modified` varbinary(64) NULL
+) ENGINE=Aria;
+
+CREATE TABLE `search_progress` (
+  `domain` varbinary(20) NOT NULL,
+  `term` varbinary(200) NOT NULL,
+  `searched` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`domain`, `term`)
+) ENGINE=Aria;
+
+CREATE TABLE `page_state` (
+  `domain` varbinary(20) NOT NULL,
+  `page_id` INT UNSIGNED NOT NULL,
+  `revid` INT UNSIGNED NOT NULL,
+  `dataset_version` TIMESTAMP NULL,
+  `checked` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`domain`, `page_id`)
+) ENGINE=Aria;
+
+CREATE TABLE `edit_queue` (
+  `domain` varbinary(20) NOT NULL,
+  `page_id` INT UNSIGNED NOT NULL,
+  `page_title` varbinary(255) NOT NULL,
+  `base_revid` INT UNSIGNED NOT NULL,
+  `text` MEDIUMBLOB NOT NULL,
+  `changes` BLOB NOT NULL,
+  `queued` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `attempts` INT UNSIGNED NOT NULL DEFAULT 0,
+  `owner` varbinary(100) NULL,
+  PRIMARY KEY (`domain`, `page_id`),
+  KEY `domain_queued` (`domain`, `queued`)
+) ENGINE=Aria;
+
+CREATE TABLE `search_cache` (
+  `domain` varbinary(20) NOT NULL,
+  `term` varbinary(200) NOT NULL,
+  `page_ids` MEDIUMBLOB NOT NULL,
+  `fetched` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `ttl` INT UNSIGNED NOT NULL,
+  PRIMARY KEY (`domain`, `term`)
+) ENGINE=Aria;
+
+CREATE TABLE `shard_leases` (
+  `domain` varbinary(20) NOT NULL,
+  `partition_id` INT UNSIGNED NOT NULL,
+  `owner` varbinary(100) NULL,
+  `expires` TIMESTAMP NULL,
+  `completed` TIMESTAMP NULL,
+  PRIMARY KEY (`domain`, `partition_id`),
+  KEY `owner` (`owner`)
+) ENGINE=Aria;
+
+CREATE TABLE `shard_workers` (
+  `worker` varbinary(100) NOT NULL PRIMARY KEY,
+  `heartbeat` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=Aria;
+
+CREATE TABLE `template_decisions` (
+  `language` varbinary(20) NOT NULL,
+  `id_type` varbinary(4) NOT NULL,
+  `id_value` varbinary(200) NOT NULL,
+  `template` BLOB NULL,
+  `original_doi` varbinary(200) NOT NULL,
+  `original_pmid` varbinary(200) NOT NULL,
+  `build_hash` varbinary(40) NOT NULL,
+  PRIMARY KEY (`language`, `id_type`, `id_value`)
+) ENGINE=Aria;
+
+CREATE TABLE `schema_migrations` (
+  `version` INT NOT NULL PRIMARY KEY,
+  `applied` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=Aria;
+
+INSERT INTO `schema_migrations` (`version`) VALUES (1), (2), (3), (4), (5), (6), (7), (8), (9), (10);
\ No newline at end of file
@@ -0,0 +1,322 @@
+"""
+Connection handling and SQL dialect differences for the databases the bot
+can store its data in. Database runs the same queries on either backend,
+written for MySQL with %s placeholders; a backend supplies connections
+and the statements which can't be written portably.
+"""
+
+import abc
+import contextlib
+import datetime
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+import pymysql
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Connections kept open by the MySQL backend.
+DEFAULT_POOL_SIZE = 4
+
+# A pooled connection idle for longer than this many seconds is pinged, and
+# reconnected if need be, before it is next used. Busy connections are
+# never pinged.
+HEALTH_CHECK_INTERVAL = 60
+
+DEFAULT_SQLITE_PATH = "retractionbot.sqlite3"
+
+
+class Backend(abc.ABC):
+    """
+    Interface to a database. cursor() is a context manager yielding a
+    cursor whose statements form one transaction, committed when the block
+    exits and rolled back if it raises. The statement builders return
+    MySQL syntax, and are overridden by backends which differ.
+    """
+
+    dialect = None
+
+    @abc.abstractmethod
+    def cursor(self):
+        pass
+
+    def close(self):
+        pass
+
+    def upsert(self, table, columns, keys):
+        """
+        INSERT statement for columns which updates the existing row when
+        one with the same keys exists.
+        """
+        return """
+            INSERT INTO {table} ({columns})
+            VALUES ({values})
+            ON DUPLICATE KEY UPDATE {updates}""".format(
+            table=table,
+            columns=", ".join(columns),
+            values=", ".join(["%s"] * len(columns)),
+            updates=", ".join(
+                "{0}=VALUES({0})".format(x) for x in columns if x not in keys
+            ),
+        )
+
+    def insert_ignore(self, table, columns):
+        """INSERT statement which skips rows that would violate a key."""
+        return """
+            INSERT IGNORE INTO {table} ({columns})
+            VALUES ({values})""".format(
+            table=table,
+            columns=", ".join(columns),
+            values=", ".join(["%s"] * len(columns)),
+        )
+
+    def truncate(self, cur, table):
+        cur.execute("TRUNCATE TABLE {0}".format(table))
+
+    def drop_tables(self, cur, tables):
+        cur.execute("DROP TABLE IF EXISTS {0}".format(", ".join(tables)))
+
+    def create_table_like(self, cur, table, source):
+        """Creates an empty table with the same columns and keys as source."""
+        cur.execute("CREATE TABLE {0} LIKE {1}".format(table, source))
+
+    def rename_tables(self, cur, renames):
+        """Renames each (old, new) pair of tables in one atomic step."""
+        cur.execute(
+            "RENAME TABLE "
+            + ", ".join("{0} TO {1}".format(old, new) for old, new in renames)
+        )
+
+
+class MySQLBackend(Backend):
+    """
+    Pool of pymysql connections. Rather than pinging the server before
+    every query, a connection is only checked when it is taken from the
+    pool after sitting idle for longer than the health check interval, and
+    is discarded if a query on it loses the connection.
+    """
+
+    dialect = "mysql"
+
+    def __init__(self, db_settings):
+        self._connect_args = {
+            "host": db_settings["host"],
+            "db": db_settings["name"],
+            "read_default_file": os.path.expanduser(
+                db_settings.get("credentials", "~/replica.my.cnf")
+            ),
+        }
+        self.pool_size = int(db_settings.get("pool_size", DEFAULT_POOL_SIZE))
+        self.health_check_interval = float(
+            db_settings.get("health_check_interval", HEALTH_CHECK_INTERVAL)
+        )
+        # Most recently used first, so the connections in use stay warm and
+        # surplus ones go idle.
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+
+    def _checkout(self):
+        self._slots.acquire()
+        try:
+            try:
+                connection, cur, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                connection = pymysql.connect(**self._connect_args)
+                return connection, connection.cursor()
+            if time.monotonic() - last_used > self.health_check_interval:
+                connection.ping(reconnect=True)
+            return connection, cur
+        except BaseException:
+            self._slots.release()
+            raise
+
+    @contextlib.contextmanager
+    def cursor(self):
+        start = time.perf_counter()
+        connection, cur = self._checkout()
+        try:
+            yield cur
+            connection.commit()
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            # The connection may be broken, so don't hand it out again.
+            connection.close()
+            raise
+        except BaseException:
+            connection.rollback()
+            self._idle.put((connection, cur, time.monotonic()))
+            raise
+        else:
+            self._idle.put((connection, cur, time.monotonic()))
+        finally:
+            self._slots.release()
+            metrics.observe("db", time.perf_counter() - start)
+
+    def close(self):
+        while True:
+            try:
+                connection, _, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            connection.close()
+
+
+class _SQLiteCursor:
+    """
+    Wraps an sqlite3 cursor to take MySQL-style %s placeholders. Strings
+    are stored as BLOBs, matching the varbinary columns of the MySQL
+    schema, so values come back as bytes from both backends.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    @staticmethod
+    def _params(params):
+        return [x.encode("utf-8") if isinstance(x, str) else x for x in params]
+
+    def execute(self, query, params=()):
+        self._cursor.execute(query.replace("%s", "?"), self._params(params))
+
+    def executemany(self, query, rows):
+        self._cursor.executemany(
+            query.replace("%s", "?"), (self._params(x) for x in rows)
+        )
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+
+def _adapt_datetime(value):
+    return value.isoformat(" ")
+
+
+def _convert_timestamp(value):
+    return datetime.datetime.fromisoformat(value.decode("utf-8"))
+
+
+sqlite3.register_adapter(datetime.datetime, _adapt_datetime)
+sqlite3.register_converter("TIMESTAMP", _convert_timestamp)
+
+
+class SQLiteBackend(Backend):
+    """
+    Embedded SQLite database in a single file, for local runs and
+    single-node deployments. Each thread gets its own connection, and the
+    database is in WAL mode so readers don't block the writer.
+    """
+
+    dialect = "sqlite"
+
+    def __init__(self, db_settings):
+        self.path = os.path.expanduser(db_settings.get("path", DEFAULT_SQLITE_PATH))
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Transactions are managed by cursor(), not the sqlite3 module.
+            connection = sqlite3.connect(
+                self.path,
+                timeout=30,
+                isolation_level=None,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    @contextlib.contextmanager
+    def cursor(self):
+        connection = self._connection()
+        with metrics.timer("db"):
+            connection.execute("BEGIN")
+            try:
+                yield _SQLiteCursor(connection.cursor())
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def upsert(self, table, columns, keys):
+        return """
+            INSERT INTO {table} ({columns})
+            VALUES ({values})
+            ON CONFLICT ({keys}) DO UPDATE SET {updates}""".format(
+            table=table,
+            columns=", ".join(columns),
+            values=", ".join(["%s"] * len(columns)),
+            keys=", ".join(keys),
+            updates=", ".join(
+                "{0}=excluded.{0}".format(x) for x in columns if x not in keys
+            ),
+        )
+
+    def insert_ignore(self, table, columns):
+        return """
+            INSERT OR IGNORE INTO {table} ({columns})
+            VALUES ({values})""".format(
+            table=table,
+            columns=", ".join(columns),
+            values=", ".join(["%s"] * len(columns)),
+        )
+
+    def truncate(self, cur, table):
+        cur.execute("DELETE FROM {0}".format(table))
+
+    def drop_tables(self, cur, tables):
+        for table in tables:
+            cur.execute("DROP TABLE IF EXISTS {0}".format(table))
+
+    def create_table_like(self, cur, table, source):
+        """
+        Copies source's CREATE TABLE statement. Only keys declared in the
+        table definition are copied, so shadowed tables declare all of
+        theirs there rather than with CREATE INDEX.
+        """
+        cur.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = '{0}'".format(
+                source
+            )
+        )
+        statement = cur.fetchone()[0]
+        cur.execute(
+            re.sub(r"^CREATE TABLE\s+(\S+)", "CREATE TABLE " + table, statement)
+        )
+
+    def rename_tables(self, cur, renames):
+        # DDL is transactional in SQLite, so this is atomic within cursor().
+        for old, new in renames:
+            cur.execute("ALTER TABLE {0} RENAME TO {1}".format(old, new))
+
+
+BACKENDS = {"mysql": MySQLBackend, "sqlite": SQLiteBackend}
+
+
+def open_backend(db_settings):
+    """Creates the backend named by the db settings' backend, MySQL if unset."""
+    name = db_settings.get("backend", "mysql")
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown database backend {0!r}".format(name))
+    return backend(db_settings)
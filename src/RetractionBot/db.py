@@ -1,9 +1,60 @@
-import pymysql
-import os
 import datetime
+import hashlib
+import sys
+
+from .backends import open_backend
+from .identifiers import classify_identifier, record_identifiers
+from .migrations import apply_migrations
+
+# Number of rows buffered by RetractionWriter before they are written and
+# committed, unless overridden by the batch_size db setting.
+DEFAULT_BATCH_SIZE = 1000
+
+# Columns written by save_retractions_to_db, in order.
+RETRACTION_COLUMNS = (
+    "timestamp",
+    "origin",
+    "original_doi",
+    "retraction_doi",
+    "original_pmid",
+    "retraction_pmid",
+    "retraction_nature",
+    "url",
+    "record_id",
+    "row_hash",
+    "changed",
+)
+
+# Each retractions table and the identifier table indexing it.
+IDENTIFIER_TABLES = {
+    "retractions": "retraction_identifiers",
+    "retractions_new": "retraction_identifiers_new",
+}
+
+
+def _clamp_timestamp(timestamp):
+    """
+    TIMESTAMP columns can't hold dates before 1970, so very old papers are
+    stored against a placeholder date just after the epoch.
+    """
+    if timestamp.year < 1971:
+        return datetime.datetime.fromtimestamp(60)
+    return timestamp
 
 
 class Retraction:
+    # Retractions are held in memory for the whole dataset by
+    # RetractionIndex, so avoid a per-instance __dict__.
+    __slots__ = (
+        "origin",
+        "original_doi",
+        "retraction_doi",
+        "original_pubmed",
+        "retraction_pubmed",
+        "retraction_nature",
+        "url",
+    )
+
     def __init__(
         self,
         origin,
@@ -14,22 +65,137 @@ class Retraction:
         retraction_nature,
         url,
     ):
-        self.origin = origin.decode("utf-8")
+        self.origin = sys.intern(origin.decode("utf-8"))
         self.original_doi = original_doi.decode("utf-8")
         self.retraction_doi = retraction_doi.decode("utf-8")
         self.original_pubmed = original_pmid.decode("utf-8")
         self.retraction_pubmed = retraction_pmid.decode("utf-8")
-        self.retraction_nature = retraction_nature.decode("utf-8")
+        self.retraction_nature = sys.intern(retraction_nature.decode("utf-8"))
         self.url = url.decode("utf-8")
 
 
+def row_hash(row):
+    """
+    Content hash of a retraction row, used to tell whether a record has
+    changed since it was last written.
+    """
+    return hashlib.sha1("\x1f".join(str(x) for x in row).encode("utf-8")).hexdigest()
+
+
+class RetractionWriter:
+    """
+    Buffers retraction rows for one origin and upserts them, keyed on the
+    source's record ID, with a single executemany per batch, committing
+    after each one. Records whose content hash matches the one already
+    stored are skipped, so an unchanged dataset causes no writes, and
+    every record written is stamped with the time the writer was created
+    as its changed time. Use as a context manager so the final partial
+    batch is flushed; nothing is flushed if the block raises.
+    """
+
+    def __init__(
+        self, database, origin, batch_size=DEFAULT_BATCH_SIZE, table="retractions"
+    ):
+        self._database = database
+        self.origin = origin
+        self.batch_size = batch_size
+        self.table = table
+        self._rows = []
+        self._known = database.load_row_hashes(origin, table)
+        self._seen = set()
+        self.written = 0
+        self.changed = datetime.datetime.now()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(
+        self,
+        record_id,
+        timestamp,
+        original_doi,
+        retraction_doi,
+        original_pmid,
+        retraction_pmid,
+        retraction_nature,
+        url,
+    ):
+        """
+        Queue a retraction for writing. Returns False if the record is
+        unchanged since it was stored, or has already been seen in this
+        run, True otherwise.
+        """
+        if record_id in self._seen:
+            return False
+        self._seen.add(record_id)
+
+        row = (
+            _clamp_timestamp(timestamp),
+            self.origin,
+            original_doi,
+            retraction_doi,
+            original_pmid,
+            retraction_pmid,
+            retraction_nature,
+            url,
+        )
+        digest = row_hash(row)
+        if self._known.get(record_id) == digest:
+            return False
+
+        self._rows.append(row + (record_id, digest, self.changed))
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        """
+        Write and commit any buffered rows. If the write fails the rows stay
+        buffered and the error is raised.
+        """
+        if not self._rows:
+            return
+        self._database.save_retractions_to_db(self._rows, self.table)
+        self.written += len(self._rows)
+        self._rows = []
+
+    def keep(self, record_id):
+        """
+        Mark a record as present in this run without writing it, leaving
+        whatever is stored for it untouched.
+        """
+        self._seen.add(record_id)
+
+    def delete_stale(self):
+        """
+        Delete stored records for this origin which weren't seen in this
+        run. Only call this once the whole source has been read, otherwise
+        every record after a failed download would be removed.
+        """
+        stale = [x for x in self._known if x not in self._seen]
+        if stale:
+            self._database.delete_retractions(
+                self.origin, stale, self.table, self.changed
+            )
+        return len(stale)
+
+
 class Database:
+    """
+    The bot's queries, run on the backend chosen by the backend db setting:
+    pooled MySQL by default, or an SQLite file.
+    """
+
     def __init__(self, db_settings: dict[str, str]):
-        self._db = pymysql.connect(
-            host=db_settings["host"],
-            db=db_settings["name"],
-            read_default_file=os.path.expanduser("~/replica.my.cnf"),
-        )
+        self.backend = open_backend(db_settings)
+        self.batch_size = int(db_settings.get("batch_size", DEFAULT_BATCH_SIZE))
+
+    def close(self):
+        self.backend.close()
 
     def save_retraction_to_db(
         self,
@@ -41,85 +207,221 @@ class Database:
         retraction_pmid,
         retraction_nature,
         url,
+        record_id,
     ):
         """
         Given a certain type of identifier (e.g. doi, pmid), its origin
         (e.g. crossref, pubmed) and both the new (retraction) id and old
         (retracted) id, save this to the DB. type can be 'doi' or 'pmid'
         """
-        self._db.ping(reconnect=True)
-        cur = self._db.cursor()
-        query = """
-            INSERT INTO retractions
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"""
+        row = (
+            _clamp_timestamp(timestamp),
+            origin,
+            original_doi,
+            retraction_doi,
+            original_pmid,
+            retraction_pmid,
+            retraction_nature,
+            url,
+        )
+        self.save_retractions_to_db(
+            [row + (record_id, row_hash(row), datetime.datetime.now())]
+        )
 
-        if timestamp.year < 1971:
-            cur.execute(
-                query,
-                (
-                    datetime.datetime.fromtimestamp(60),
-                    origin,
-                    original_doi,
-                    retraction_doi,
-                    original_pmid,
-                    retraction_pmid,
-                    retraction_nature,
-                    url,
-                ),
+    def save_retractions_to_db(self, rows, table="retractions"):
+        """
+        Upsert a batch of retraction rows, each a tuple in RETRACTION_COLUMNS
+        order, and commit. pymysql rewrites executemany on an INSERT into a
+        single multi-row statement, so this is one round trip per batch.
+        """
+        with self.backend.cursor() as cur:
+            cur.executemany(
+                self.backend.upsert(table, RETRACTION_COLUMNS, ("origin", "record_id")),
+                rows,
             )
-        else:
-            cur.execute(
-                query,
-                (
-                    timestamp,
-                    origin,
-                    original_doi,
-                    retraction_doi,
-                    original_pmid,
-                    retraction_pmid,
-                    retraction_nature,
-                    url,
+
+            # Re-index the identifiers of every written record.
+            by_origin = {}
+            for row in rows:
+                by_origin.setdefault(row[1], []).append(row[8])
+            for origin, record_ids in by_origin.items():
+                self._delete_rows(cur, IDENTIFIER_TABLES[table], origin, record_ids)
+            cur.executemany(
+                self.backend.insert_ignore(
+                    IDENTIFIER_TABLES[table],
+                    ("id_type", "id_value", "origin", "record_id"),
                 ),
+                [
+                    (id_type, id_value, row[1], row[8])
+                    for row in rows
+                    for id_type, id_value in record_identifiers(row[2], row[4])
+                ],
+            )
+
+    def _delete_rows(self, cur, table, origin, record_ids):
+        for i in range(0, len(record_ids), self.batch_size):
+            batch = record_ids[i : i + self.batch_size]
+            query = """
+                DELETE FROM {table} WHERE origin = %s AND record_id IN ({ids})
+            """.format(
+                table=table, ids=", ".join(["%s"] * len(batch))
             )
+            cur.execute(query, [origin] + batch)
+
+    def delete_retractions(self, origin, record_ids, table="retractions", deleted=None):
+        """
+        Delete the given record IDs for an origin, in batches. The
+        identifiers they were indexed under are recorded as changed at
+        deleted, or now, so that pages citing them are checked again.
+        """
+        deleted = deleted or datetime.datetime.now()
+        with self.backend.cursor() as cur:
+            for i in range(0, len(record_ids), self.batch_size):
+                batch = record_ids[i : i + self.batch_size]
+                query = """
+                    SELECT DISTINCT id_type, id_value FROM {table}
+                    WHERE origin = %s AND record_id IN ({ids})
+                """.format(
+                    table=IDENTIFIER_TABLES[table], ids=", ".join(["%s"] * len(batch))
+                )
+                cur.execute(query, [origin] + batch)
+                cur.executemany(
+                    self.backend.upsert(
+                        "retraction_deletions",
+                        ("id_type", "id_value", "deleted"),
+                        ("id_type", "id_value"),
+                    ),
+                    [
+                        (id_type, id_value, deleted)
+                        for id_type, id_value in cur.fetchall()
+                    ],
+                )
+            self._delete_rows(cur, table, origin, record_ids)
+            self._delete_rows(cur, IDENTIFIER_TABLES[table], origin, record_ids)
+
+    def bulk_writer(self, origin, table="retractions", batch_size=None):
+        """
+        Returns a RetractionWriter which batches upserts for one origin into
+        this database.
+        """
+        return RetractionWriter(self, origin, batch_size or self.batch_size, table)
+
+    def has_retractions(self, origin):
+        """Returns True if any records from the given origin are stored."""
+        query = """
+            SELECT 1 FROM retractions WHERE origin = %s LIMIT 1
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(query, (origin,))
+            return cur.fetchone() is not None
+
+    def load_row_hashes(self, origin, table="retractions"):
+        """
+        Returns a dict of record_id to row_hash for every stored record from
+        the given origin.
+        """
+        query = """
+            SELECT record_id, row_hash FROM {table} WHERE origin = %s
+        """.format(
+            table=table
+        )
+        with self.backend.cursor() as cur:
+            cur.execute(query, (origin,))
+            rows = cur.fetchall()
+        return {x[0].decode("utf-8"): x[1].decode("utf-8") for x in rows}
+
+    def create_shadow_table(self):
+        """
+        Creates retractions_new (and its identifier table) for a full
+        refresh, as a copy of the live tables. Rows the refresh finds
+        unchanged are left as they are, keeping their added and changed
+        times.
+        """
+        with self.backend.cursor() as cur:
+            for table in ["retractions", "retraction_identifiers"]:
+                self.backend.drop_tables(cur, [table + "_new"])
+                self.backend.create_table_like(cur, table + "_new", table)
+                cur.execute("INSERT INTO {0}_new SELECT * FROM {0}".format(table))
+
+    def swap_shadow_table(self):
+        """
+        Atomically replaces retractions and retraction_identifiers with
+        their _new copies, so readers never see a partially loaded table.
+        """
+        old_tables = ["retractions_old", "retraction_identifiers_old"]
+        with self.backend.cursor() as cur:
+            self.backend.drop_tables(cur, old_tables)
+            self.backend.rename_tables(
+                cur,
+                [
+                    ("retractions", "retractions_old"),
+                    ("retractions_new", "retractions"),
+                    ("retraction_identifiers", "retraction_identifiers_old"),
+                    ("retraction_identifiers_new", "retraction_identifiers"),
+                ],
+            )
+            self.backend.drop_tables(cur, old_tables)
+
+    def get_dataset_state(self, origin):
+        """
+        Returns the ETag and Last-Modified headers recorded for the last
+        successful download from an origin, or None for each if unknown.
+        """
+        query = """
+            SELECT etag, last_modified FROM dataset_state WHERE origin = %s
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(query, (origin,))
+            fetch_one = cur.fetchone()
+        if fetch_one is None:
+            return None, None
+        return tuple(x.decode("utf-8") if x else None for x in fetch_one)
+
+    def save_dataset_state(self, origin, etag, last_modified):
+        query = self.backend.upsert(
+            "dataset_state", ("origin", "etag", "last_modified"), ("origin",)
+        )
+        with self.backend.cursor() as cur:
+            cur.execute(query, (origin, etag, last_modified))
+
+    def migrate(self):
+        """Applies any pending schema migrations."""
+        return apply_migrations(self.backend)
 
     def truncate_db(self):
-        self._db.ping(reconnect=True)
-        cur = self._db.cursor()
-        query = """TRUNCATE table retractions"""
-        cur.execute(query, ())
+        with self.backend.cursor() as cur:
+            self.backend.truncate(cur, "retractions")
+            self.backend.truncate(cur, "retraction_identifiers")
 
     def retracted_id_exists(self, retraction_id):
         """
         Given a retraction ID string, checks if an entry already exists for it
         in the database. If so, return True.
         """
-        cur = self._db.cursor()
+        identifier = classify_identifier(retraction_id)
+        if identifier is None:
+            return False
         query = """
-            SELECT COUNT(*) FROM retractions
-            WHERE original_doi = %s OR original_pmid = %s
+            SELECT 1 FROM retraction_identifiers
+            WHERE id_type = %s AND id_value = %s
+            LIMIT 1
         """
-        self._db.ping(reconnect=True)
-        cur.execute(query, (retraction_id, retraction_id))
-        count_result = cur.fetchone()
-
-        if count_result[0] != 0:
-            return True
-        else:
-            return False
+        with self.backend.cursor() as cur:
+            cur.execute(query, identifier)
+            return cur.fetchone() is not None
 
     def get_latest_timestamp(self):
         """
         Get the latest timestamp from the database in the format YYYY-MM-DD
         """
-        cur = self._db.cursor()
         query = """
             SELECT timestamp FROM retractions
             ORDER BY timestamp DESC
             LIMIT 1
         """
-        self._db.ping(reconnect=True)
-        cur.execute(query)
-        fetch_one = cur.fetchone()
+        with self.backend.cursor() as cur:
+            cur.execute(query)
+            fetch_one = cur.fetchone()
         if fetch_one:
             max_timestamp = fetch_one[0].strftime("%Y-%m-%d")
         else:
@@ -129,49 +431,432 @@ class Database:
         return max_timestamp
 
     def load_retracted_identifiers(self):
-        cur = self._db.cursor()
         query = """
-            SELECT original_doi,original_pmid FROM retractions ORDER BY RAND()
+            SELECT original_doi, original_pmid FROM retractions
+            ORDER BY added DESC, timestamp DESC
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(query)
+            return list(cur.fetchall())
+
+    def load_retractions(self):
+        """
+        Returns every stored retraction as a tuple of the columns taken by
+        Retraction, for building an in-memory index.
+        """
+        query = """
+            SELECT origin, original_doi, retraction_doi, original_pmid,
+                retraction_pmid, retraction_nature, url
+            FROM retractions
         """
-        self._db.ping(reconnect=True)
-        cur.execute(query)
-        return list(cur.fetchall())
+        with self.backend.cursor() as cur:
+            cur.execute(query)
+            return cur.fetchall()
 
     def retrieve_retracted_identifier(self, id):
-        cur = self._db.cursor()
+        identifier = classify_identifier(id)
+        if identifier is None:
+            return []
         query = """
-            SELECT * FROM retractions WHERE original_doi=%s OR original_pmid=%s
+            SELECT r.* FROM retraction_identifiers i
+            JOIN retractions r ON r.origin = i.origin AND r.record_id = i.record_id
+            WHERE i.id_type = %s AND i.id_value = %s
         """
-        self._db.ping(reconnect=True)
-        cur.execute(query, (id, id))
-        item = list(cur.fetchall())
+        with self.backend.cursor() as cur:
+            cur.execute(query, identifier)
+            item = list(cur.fetchall())
         return [Retraction(x[1], x[2], x[3], x[4], x[5], x[6], x[7]) for x in item]
 
+    def load_identifier_versions(self):
+        """
+        Returns a dict of (id_type, canonical value) to the last time any
+        record for that identifier was added, changed or deleted.
+        """
+        # The latest time is found here rather than with MAX(), which would
+        # lose the column type and so the conversion to datetime in SQLite.
+        query = """
+            SELECT i.id_type, i.id_value, r.changed
+            FROM retraction_identifiers i
+            JOIN retractions r ON r.origin = i.origin AND r.record_id = i.record_id
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(query)
+            rows = list(cur.fetchall())
+            cur.execute("SELECT id_type, id_value, deleted FROM retraction_deletions")
+            rows += cur.fetchall()
+        versions = {}
+        for id_type, id_value, changed in rows:
+            key = (id_type.decode("utf-8"), id_value.decode("utf-8"))
+            if key not in versions or changed > versions[key]:
+                versions[key] = changed
+        return versions
+
+    def load_page_states(self, domain):
+        """
+        Returns a dict of page ID to (revision ID, dataset version) for
+        every page on the given wiki recorded by save_page_states.
+        """
+        query = """
+            SELECT page_id, revid, dataset_version FROM page_state
+            WHERE domain = %s
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(query, (domain,))
+            return {x[0]: (x[1], x[2]) for x in cur.fetchall()}
+
+    def save_page_states(self, domain, states, timestamp=None):
+        """
+        Records that pages on the given wiki were checked, from (page ID,
+        revision ID, dataset version) tuples.
+        """
+        timestamp = timestamp or datetime.datetime.now()
+        query = self.backend.upsert(
+            "page_state",
+            ("domain", "page_id", "revid", "dataset_version", "checked"),
+            ("domain", "page_id"),
+        )
+        with self.backend.cursor() as cur:
+            cur.executemany(query, [(domain,) + x + (timestamp,) for x in states])
+
+    def load_search_progress(self, domain):
+        """
+        Returns a dict of search term to when it was last searched on the
+        given wiki.
+        """
+        query = """
+            SELECT term, searched FROM search_progress WHERE domain = %s
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(query, (domain,))
+            return {x[0].decode("utf-8"): x[1] for x in cur.fetchall()}
+
+    def record_search_progress(self, domain, terms, timestamp=None):
+        """Records that terms have been searched on the given wiki."""
+        timestamp = timestamp or datetime.datetime.now()
+        query = self.backend.upsert(
+            "search_progress", ("domain", "term", "searched"), ("domain", "term")
+        )
+        with self.backend.cursor() as cur:
+            cur.executemany(query, [(domain, x, timestamp) for x in terms])
+
+    def load_search_cache(self, domain):
+        """
+        Returns a dict of search term to (page IDs, when they were fetched,
+        TTL in seconds) for every search cached on the given wiki.
+        """
+        query = """
+            SELECT term, page_ids, fetched, ttl FROM search_cache
+            WHERE domain = %s
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(query, (domain,))
+            rows = cur.fetchall()
+        return {
+            term.decode("utf-8"): (
+                [int(x) for x in page_ids.split()],
+                fetched,
+                ttl,
+            )
+            for term, page_ids, fetched, ttl in rows
+        }
+
+    def save_search_cache(self, domain, entries):
+        """
+        Caches search results on the given wiki, from (term, page IDs,
+        fetched, TTL in seconds) tuples.
+        """
+        query = self.backend.upsert(
+            "search_cache",
+            ("domain", "term", "page_ids", "fetched", "ttl"),
+            ("domain", "term"),
+        )
+        with self.backend.cursor() as cur:
+            cur.executemany(
+                query,
+                [
+                    (domain, term, " ".join(str(x) for x in page_ids), fetched, ttl)
+                    for term, page_ids, fetched, ttl in entries
+                ],
+            )
+
+    def save_template_decisions(self, language, build_hash, rows):
+        """
+        Replaces the template decisions stored for a language with rows of
+        (id_type, id_value, template or None, original DOI, original PMID),
+        built from the template settings and dataset hashed to build_hash.
+        """
+        query = self.backend.insert_ignore(
+            "template_decisions",
+            (
+                "language",
+                "id_type",
+                "id_value",
+                "template",
+                "original_doi",
+                "original_pmid",
+                "build_hash",
+            ),
+        )
+        with self.backend.cursor() as cur:
+            cur.execute(
+                "DELETE FROM template_decisions WHERE language = %s", (language,)
+            )
+            for i in range(0, len(rows), self.batch_size):
+                cur.executemany(
+                    query,
+                    [
+                        (language,) + tuple(row) + (build_hash,)
+                        for row in rows[i : i + self.batch_size]
+                    ],
+                )
+
+    def has_template_decisions(self, language, build_hash):
+        query = """
+            SELECT 1 FROM template_decisions
+            WHERE language = %s AND build_hash = %s
+            LIMIT 1
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(query, (language, build_hash))
+            return cur.fetchone() is not None
+
+    def load_template_decisions(self, language, build_hash):
+        """
+        Returns a dict of (id_type, id_value) to (template or None, original
+        DOI, original PMID) for a language, or None if those stored weren't
+        built from the template settings and dataset hashed to build_hash.
+        """
+        query = """
+            SELECT id_type, id_value, template, original_doi, original_pmid
+            FROM template_decisions
+            WHERE language = %s AND build_hash = %s
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(query, (language, build_hash))
+            rows = cur.fetchall()
+        if not rows:
+            return None
+        return {
+            (id_type.decode("utf-8"), id_value.decode("utf-8")): (
+                template.decode("utf-8") if template is not None else None,
+                original_doi.decode("utf-8"),
+                original_pmid.decode("utf-8"),
+            )
+            for id_type, id_value, template, original_doi, original_pmid in rows
+        }
+
+    def ensure_partitions(self, domain, count):
+        """Creates the lease rows for partitions 0 to count - 1 of a wiki."""
+        query = self.backend.insert_ignore("shard_leases", ("domain", "partition_id"))
+        with self.backend.cursor() as cur:
+            cur.executemany(query, [(domain, x) for x in range(count)])
+
+    def load_leases(self, domain, count):
+        """
+        Returns a dict of partition to (owner, lease expiry, when it was
+        last completed) for the first count partitions of a wiki.
+        """
+        query = """
+            SELECT partition_id, owner, expires, completed FROM shard_leases
+            WHERE domain = %s AND partition_id < %s
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(query, (domain, count))
+            rows = cur.fetchall()
+        return {
+            partition: (owner.decode("utf-8") if owner else None, expires, completed)
+            for partition, owner, expires, completed in rows
+        }
+
+    def claim_partition(self, domain, partition, owner, expires, now, due_before):
+        """
+        Leases a partition to owner until expires, unless another owner
+        holds an unexpired lease on it or it was completed at or after
+        due_before. Returns True if the lease was taken.
+        """
+        query = """
+            UPDATE shard_leases SET owner = %s, expires = %s
+            WHERE domain = %s AND partition_id = %s
+            AND (owner IS NULL OR owner = %s OR expires < %s)
+            AND (completed IS NULL OR completed < %s)
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(
+                query, (owner, expires, domain, partition, owner, now, due_before)
+            )
+            return cur.rowcount == 1
+
+    def release_partition(self, domain, partition, owner, completed=None):
+        """
+        Gives up owner's lease on a partition, recording it as completed at
+        the given time if there is one.
+        """
+        query = """
+            UPDATE shard_leases
+            SET owner = NULL, expires = NULL, completed = COALESCE(%s, completed)
+            WHERE domain = %s AND partition_id = %s AND owner = %s
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(query, (completed, domain, partition, owner))
+
+    def heartbeat(self, owner, expires, now=None):
+        """
+        Extends every lease held by owner until expires, and records that
+        it is alive.
+        """
+        now = now or datetime.datetime.now()
+        with self.backend.cursor() as cur:
+            cur.execute(
+                "UPDATE shard_leases SET expires = %s WHERE owner = %s",
+                (expires, owner),
+            )
+            cur.execute(
+                self.backend.upsert(
+                    "shard_workers", ("worker", "heartbeat"), ("worker",)
+                ),
+                (owner, now),
+            )
+
+    def load_workers(self, since):
+        """Returns the workers whose last heartbeat was after since."""
+        query = """
+            SELECT worker FROM shard_workers WHERE heartbeat > %s
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(query, (since,))
+            return sorted(x[0].decode("utf-8") for x in cur.fetchall())
+
     def log_retraction_edit(self, timestamp, domain, page_title, orig_doi, orig_pmid):
-        cur = self._db.cursor()
+        self.log_retraction_edits(
+            [(timestamp, domain, page_title, orig_doi, orig_pmid)]
+        )
+
+    def _log_edits(self, cur, rows):
         query = """
             INSERT INTO edit_log
             VALUES (%s, %s, %s, %s, %s, %s, %s)
         """
-        self._db.ping(reconnect=True)
-        cur.execute(
-            query,
+        cur.executemany(query, [tuple(x) + (0, 0) for x in rows])
+
+    def log_retraction_edits(self, rows):
+        """
+        Logs a batch of edits, each a (timestamp, domain, page title,
+        original DOI, original PMID) tuple, in one round trip.
+        """
+        with self.backend.cursor() as cur:
+            self._log_edits(cur, rows)
+
+    def queue_edit(
+        self, domain, page_id, page_title, base_revid, text, changes, owner=None
+    ):
+        """
+        Adds an edit to the given wiki's edit queue, replacing any edit to
+        the same page still queued. base_revid is the revision text was
+        computed from, and changes the identifiers whose citations it flags.
+        owner is the worker of a sharded run which queued it.
+        """
+        query = self.backend.upsert(
+            "edit_queue",
             (
-                timestamp,
-                domain,
-                page_title,
-                orig_doi,
-                orig_pmid,
-                0,
-                0,
+                "domain",
+                "page_id",
+                "page_title",
+                "base_revid",
+                "text",
+                "changes",
+                "queued",
+                "attempts",
+                "owner",
             ),
+            ("domain", "page_id"),
         )
+        with self.backend.cursor() as cur:
+            cur.execute(
+                query,
+                (
+                    domain,
+                    page_id,
+                    page_title,
+                    base_revid,
+                    text,
+                    "\n".join(changes),
+                    datetime.datetime.now(),
+                    0,
+                    owner,
+                ),
+            )
+
+    def claim_queued_edits(self, domain, owner, alive_since):
+        """
+        Makes owner the owner of every edit queued on the given wiki which
+        has no owner, or whose owner's last heartbeat was before
+        alive_since, in one statement, so that no two workers of a sharded
+        run claim the same edit.
+        """
+        query = """
+            UPDATE edit_queue SET owner = %s
+            WHERE domain = %s AND (owner IS NULL OR owner NOT IN (
+                SELECT worker FROM shard_workers WHERE heartbeat > %s
+            ))
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(query, (owner, domain, alive_since))
+
+    def load_queued_edits(self, domain, max_attempts, owner=None):
+        """
+        Returns (page ID, page title, base revision ID, text, changes) for
+        each edit queued on the given wiki which has failed fewer than
+        max_attempts times, oldest first. Given owner, only the edits it
+        owns are returned.
+        """
+        query = """
+            SELECT page_id, page_title, base_revid, text, changes
+            FROM edit_queue
+            WHERE domain = %s AND attempts < %s AND (%s IS NULL OR owner = %s)
+            ORDER BY queued
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(query, (domain, max_attempts, owner, owner))
+            rows = cur.fetchall()
+        return [
+            (
+                page_id,
+                page_title.decode("utf-8"),
+                base_revid,
+                text.decode("utf-8"),
+                changes.decode("utf-8").split("\n") if changes else [],
+            )
+            for page_id, page_title, base_revid, text, changes in rows
+        ]
+
+    def record_edit_failure(self, domain, page_id):
+        query = """
+            UPDATE edit_queue SET attempts = attempts + 1
+            WHERE domain = %s AND page_id = %s
+        """
+        with self.backend.cursor() as cur:
+            cur.execute(query, (domain, page_id))
+
+    def complete_edits(self, domain, page_ids, log_rows):
+        """
+        Removes saved edits from the given wiki's queue and logs them, as
+        for log_retraction_edits, in one transaction.
+        """
+        with self.backend.cursor() as cur:
+            for i in range(0, len(page_ids), self.batch_size):
+                batch = page_ids[i : i + self.batch_size]
+                query = """
+                    DELETE FROM edit_queue WHERE domain = %s AND page_id IN ({ids})
+                """.format(
+                    ids=", ".join(["%s"] * len(batch))
+                )
+                cur.execute(query, [domain] + batch)
+            self._log_edits(cur, log_rows)
 
     def check_edits(self, page_title, id):
-        cur = self._db.cursor()
         query = """
             SELECT * FROM edit_log WHERE page_title=%s AND (original_doi=%s OR original_pmid=%s)
         """
-        self._db.ping(reconnect=True)
-        cur.execute(query, (page_title, id, id))
-        return list(cur.fetchall())
+        with self.backend.cursor() as cur:
+            cur.execute(query, (page_title, id, id))
+            return list(cur.fetchall())
@@ -0,0 +1,272 @@
+"""
+Persistent queue of edits for one wiki, saved by a writer thread so that
+the bot's edit rate and save latency don't hold up the analysis of the
+pages after them.
+
+Each edit is written to the edit_queue table when it is queued, along
+with the revision it was computed from, and removed once it is saved, so
+edits queued but not yet saved when a run stops are saved by the next
+one. Before saving, the writer checks each page's latest revision; if the
+page has been edited since, the edit is rebased by analysing the current
+text again.
+"""
+
+import datetime
+import logging
+import queue
+import threading
+
+import pywikibot
+import pywikibot.exceptions
+
+from .metrics import metrics
+from .page_state import load_revision_info
+from .throttle import RateLimiter, site_limiter
+
+logger = logging.getLogger(__name__)
+
+# Edits per second, unless overridden by the rate edits setting. Bots on
+# Wikipedia are expected to make no more than about six edits a minute.
+DEFAULT_EDIT_RATE = 0.1
+
+# Saved edits whose edit_log rows and queue deletions are written together.
+LOG_BATCH_SIZE = 50
+
+# Failed saves of an edit, over this and earlier runs, before it is left in
+# the queue for someone to look at.
+MAX_ATTEMPTS = 3
+
+# Edit conflicts on saving one edit before it is given up on for this run.
+MAX_REBASES = 3
+
+
+class QueuedEdit:
+    __slots__ = ("page_id", "title", "base_revid", "text", "changes")
+
+    def __init__(self, page_id, title, base_revid, text, changes):
+        self.page_id = page_id
+        self.title = title
+        self.base_revid = base_revid
+        self.text = text
+        self.changes = changes
+
+
+class EditQueue:
+    """
+    Queue of edits to pages on site, saved in the order they were queued
+    by a writer thread at the rate allowed for edits. rebase is called
+    with the current text of a page edited since its edit was computed,
+    and returns (new text, changes) as process_page does. Pages saved are
+    recorded in page_states, if given. can_run, if given, is called before
+    each save, and while it returns False, as when the killswitch has been
+    turned off, edits are left in the table for a later run. Use as a
+    context manager, which starts the writer with any edits left from
+    earlier runs, and waits for the queue to drain on exit.
+
+    Given the Shard of a sharded run, the edits it queues are owned by its
+    worker, and it only resumes the edits it claims: those with no owner
+    or whose owner has stopped, so that each leftover edit is saved by
+    one of the run's jobs rather than all of them.
+    """
+
+    def __init__(
+        self,
+        database,
+        site,
+        domain,
+        summary,
+        rebase,
+        page_states=None,
+        rate=DEFAULT_EDIT_RATE,
+        log_batch_size=LOG_BATCH_SIZE,
+        can_run=None,
+        shard=None,
+    ):
+        self._database = database
+        self.site = site
+        self.domain = domain
+        self.summary = summary
+        self.rebase = rebase
+        self.page_states = page_states
+        self.log_batch_size = log_batch_size
+        self.can_run = can_run
+        self.shard = shard
+        self.owner = None if shard is None else shard.worker_id
+        # Reads share the site's rate limit; saves have their own.
+        self._read_limiter = site_limiter(site)
+        self._edit_limiter = RateLimiter(rate=rate, min_rate=min(rate, 1 / 300))
+        self._queue = queue.Queue()
+        self._saved = []
+        self._thread = None
+        self.edited = 0
+        self.flagged = 0
+        self.failed = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        """
+        Starts the writer on the edits left in the queue by earlier runs,
+        unless it is already running.
+        """
+        if self._thread is not None:
+            return
+        if self.shard is not None:
+            self._database.claim_queued_edits(
+                self.domain,
+                self.owner,
+                datetime.datetime.now() - self.shard.lease_ttl,
+            )
+        pending = self._database.load_queued_edits(
+            self.domain, MAX_ATTEMPTS, self.owner
+        )
+        if pending:
+            logger.info("Resuming %d queued edits on %s", len(pending), self.domain)
+        for row in pending:
+            self._queue.put(QueuedEdit(*row))
+        self._thread = threading.Thread(
+            target=self._write, name="edits-" + self.domain, daemon=True
+        )
+        self._thread.start()
+
+    def put(self, page, text, changes):
+        """
+        Queues text, computed from the page's latest revision, to be saved
+        to page, along with the identifiers whose citations it flags.
+        """
+        self.add(
+            QueuedEdit(
+                page.pageid, page.title(), page.latest_revision_id, text, changes
+            )
+        )
+
+    def add(self, edit):
+        """Queues a QueuedEdit."""
+        self._database.queue_edit(
+            self.domain,
+            edit.page_id,
+            edit.title,
+            edit.base_revid,
+            edit.text,
+            edit.changes,
+            self.owner,
+        )
+        metrics.count("edits_queued", language=self.site.code)
+        self._queue.put(edit)
+
+    def close(self):
+        """Waits for every queued edit to be saved or to fail."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _write(self):
+        while True:
+            batch = [self._queue.get()]
+            # Take whatever else is waiting, so the revisions of the whole
+            # batch are checked with one request.
+            while batch[-1] is not None and len(batch) < self.log_batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = batch[-1] is None
+            edits = [x for x in batch if x is not None]
+            if edits:
+                try:
+                    self._save_batch(edits)
+                except Exception as e:
+                    logger.exception(
+                        "Edit writer for %s failed", self.domain, exc_info=e
+                    )
+            if done:
+                self._flush()
+                return
+
+    def _save_batch(self, edits):
+        pages = [pywikibot.Page(self.site, x.title) for x in edits]
+        load_revision_info(self.site, pages, self._read_limiter)
+        for edit, page in zip(edits, pages):
+            if self.can_run is not None and not self.can_run():
+                logger.warning(
+                    "Not running on %s, left %s queued", self.domain, edit.title
+                )
+                metrics.count("edits_held", language=self.site.code)
+                continue
+            try:
+                self._save(edit, page)
+            except Exception as e:
+                logger.error("Failed to save %s: %r", edit.title, e)
+                metrics.count("edit_failures", language=self.site.code)
+                self.failed += 1
+                self._database.record_edit_failure(self.domain, edit.page_id)
+                continue
+            if self.page_states is not None:
+                self.page_states.checked(page)
+            if len(self._saved) >= self.log_batch_size:
+                self._flush()
+        self._flush()
+
+    def _save(self, edit, page):
+        """
+        Saves edit to page, rebasing it if the page has been edited since
+        it was computed, unless once rebased there is nothing left to change.
+        """
+        text, changes = edit.text, edit.changes
+        base_revid = edit.base_revid
+        for _ in range(MAX_REBASES):
+            if page.latest_revision_id != base_revid:
+                current = self._read_limiter.call(page.get, force=True)
+                base_revid = page.latest_revision_id
+                with metrics.timer("rebase", language=self.site.code):
+                    text, changes = self.rebase(current)
+                metrics.count("edits_rebased", language=self.site.code)
+                if text == current:
+                    logger.info("Nothing left to change on %s", edit.title)
+                    self._saved.append((edit, []))
+                    return
+
+            page.text = text
+            try:
+                with metrics.timer("save", language=self.site.code):
+                    self._edit_limiter.call(page.save, self.summary, minor=False)
+            except pywikibot.exceptions.EditConflictError:
+                logger.info("Edit conflict on %s, rebasing", edit.title)
+                # Rebase onto the revision it conflicted with.
+                base_revid = None
+                continue
+
+            metrics.count("pages_edited", language=self.site.code)
+            metrics.count("citations_flagged", len(changes), language=self.site.code)
+            self.edited += 1
+            self.flagged += len(changes)
+            logger.info(
+                "Successfully edited {page_name} with "
+                "retracted source(s).".format(page_name=edit.title)
+            )
+            self._saved.append((edit, changes))
+            return
+        raise pywikibot.exceptions.EditConflictError(page)
+
+    def _flush(self):
+        """Logs the saved edits and removes them from the queue."""
+        if not self._saved:
+            return
+        saved, self._saved = self._saved, []
+        timestamp = datetime.datetime.now()
+        self._database.complete_edits(
+            self.domain,
+            [x.page_id for x, _ in saved],
+            [
+                (timestamp, self.domain, x.title, y, 0)
+                for x, changes in saved
+                for y in changes
+            ],
+        )
@@ -0,0 +1,142 @@
+import argparse
+import bz2
+import collections
+import concurrent.futures
+import logging
+import os
+
+import lxml.etree
+
+from .matcher import IdentifierMatcher
+from .search import write_candidates
+
+directory = os.path.dirname(os.path.realpath(__file__))
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    filename=os.path.join(directory, "findcitingpages.log"),
+    level=logging.INFO,
+)
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+# Pages sent to a worker process at a time.
+CHUNK_SIZE = 200
+
+_matcher = None
+
+
+def iter_dump_pages(path):
+    """
+    Streams a pages-articles XML dump, plain or bz2 compressed, yielding
+    (title, text) for each article in the main namespace. Elements are
+    cleared as they are read, so memory use doesn't grow with the dump.
+    """
+    opener = bz2.open if path.endswith(".bz2") else open
+    with opener(path, "rb") as dump:
+        for _, page in lxml.etree.iterparse(dump, events=("end",), tag="{*}page"):
+            ns = page.findtext("{*}ns")
+            if ns == "0" and page.find("{*}redirect") is None:
+                title = page.findtext("{*}title")
+                text = page.findtext("{*}revision/{*}text") or ""
+                yield title, text
+            page.clear()
+            while page.getprevious() is not None:
+                del page.getparent()[0]
+
+
+def _init_worker(dois, pmids):
+    global _matcher
+    _matcher = IdentifierMatcher(dois, pmids)
+
+
+def _scan_chunk(chunk):
+    results = []
+    for title, text in chunk:
+        found = _matcher.matches(text)
+        if found:
+            results.append((title, found))
+    return results
+
+
+def _chunks(pages, size):
+    chunk = []
+    for page in pages:
+        chunk.append(page)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def scan_dump(path, dois, pmids, workers=None, chunk_size=CHUNK_SIZE):
+    """
+    Yields (title, identifiers) for every article in the dump at path citing
+    any of the given DOIs or PMIDs. Pages are matched on a pool of worker
+    processes, with a bounded number of chunks in flight so that reading
+    the dump never runs far ahead of matching.
+    """
+    workers = workers or os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(set(dois), set(pmids)),
+    ) as pool:
+        pending = collections.deque()
+        for chunk in _chunks(iter_dump_pages(path), chunk_size):
+            pending.append(pool.submit(_scan_chunk, chunk))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def load_identifiers(path):
+    """
+    Reads DOIs and PMIDs, one per line, from a file. Lines of digits are
+    taken as PMIDs and anything else as a DOI.
+    """
+    dois, pmids = set(), set()
+    with open(path, encoding="utf-8") as identifier_file:
+        for line in identifier_file:
+            value = line.strip()
+            if value.isdigit():
+                pmids.add(value)
+            elif value:
+                dois.add(value)
+    return dois, pmids
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find articles in a dump which cite retracted works."
+    )
+    parser.add_argument("dump", help="pages-articles.xml or .xml.bz2 dump")
+    parser.add_argument("output", help="candidate page list for run_bot")
+    parser.add_argument(
+        "--identifiers",
+        help="file of DOIs and PMIDs to look for, instead of the database",
+    )
+    parser.add_argument("--workers", type=int, help="matching processes")
+    args = parser.parse_args()
+
+    if args.identifiers:
+        dois, pmids = load_identifiers(args.identifiers)
+    else:
+        from .db import Database
+        from .retraction_bot import load_bot_settings, load_index
+
+        bot_settings = load_bot_settings()
+        index = load_index(Database(bot_settings["db"]), bot_settings)
+        dois, pmids = set(index.identifiers("doi")), set(index.identifiers("pmid"))
+
+    logger.info(
+        "Scanning %s for %d DOIs and %d PMIDs", args.dump, len(dois), len(pmids)
+    )
+    count = write_candidates(
+        args.output, scan_dump(args.dump, dois, pmids, workers=args.workers)
+    )
+    logger.info("Wrote %d candidate pages to %s", count, args.output)
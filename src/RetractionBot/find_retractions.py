@@ -1,14 +1,21 @@
+import argparse
 import lxml.etree
 import lxml.html
 import requests
 import os
 import csv
+import codecs
 from .db import Database
 import datetime
 import logging
 import lxml
 
+from .metrics import metrics, run_report
 from .retraction_bot import load_bot_settings
+from .retraction_index import RetractionIndex
+from .rewrite import save_decisions
+from .snapshot import export_snapshot
+from .throttle import RateLimiter
 
 directory = os.path.dirname(os.path.realpath(__file__))
 
@@ -24,82 +31,494 @@ logger.setLevel(logging.WARNING)
 
 user_agent = "RetractionBot (https://github.com/cookies52/RetractionBot; mailto:matthewdann52@gmail.com)"
 
+# Size of the raw byte chunks read from the network while streaming the
+# Retraction Watch CSV and PubMed records.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
-def get_crossref_retractions(database: Database):
+NCBI_EUTILS_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+
+# PubMed searches for retracted articles and for retraction, expression of
+# concern and correction notices, whose records link each original article
+# to its notice. Retracted articles come first, as only their records have
+# the original article's DOI.
+NCBI_QUERIES = (
+    '"retracted publication"[pt]',
+    '"retraction of publication"[pt]',
+    '"expression of concern"[pt]',
+    '"published erratum"[pt]',
+)
+
+# CommentsCorrections reference types linking an original article and a
+# notice: the nature of the notice, and whether the record holding the
+# reference is the notice's rather than the original article's.
+NCBI_REF_TYPES = {
+    "RetractionIn": ("Retraction", False),
+    "RetractionOf": ("Retraction", True),
+    "ExpressionOfConcernIn": ("Expression of concern", False),
+    "ExpressionOfConcernFor": ("Expression of concern", True),
+    "ErratumIn": ("Correction", False),
+    "ErratumFor": ("Correction", True),
+}
+
+# Records per efetch request. E-utilities allows up to 10,000.
+NCBI_FETCH_SIZE = 5000
+
+# Most records E-utilities will page through for one PubMed search. Longer
+# searches are split by publication date.
+NCBI_SEARCH_LIMIT = 10000
+
+# Earliest publication date searched for.
+NCBI_FIRST_DATE = datetime.date(1800, 1, 1)
+
+# Requests per second E-utilities allows without and with an API key.
+NCBI_RATE = 3
+NCBI_API_KEY_RATE = 10
+
+
+def iter_decoded_lines(chunks, encoding="utf-8"):
+    """
+    Incrementally decode an iterable of byte chunks and yield text lines,
+    keeping their line endings so that csv.reader can reassemble quoted
+    fields which span several lines. Multi-byte characters split across
+    chunk boundaries are handled by the incremental decoder.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    pending = ""
+    for chunk in chunks:
+        if not chunk:
+            continue
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+def get_crossref_retractions(database: Database, full_refresh=False):
+    """
+    Loads the Retraction Watch dataset into the retractions table.
+
+    Only records whose content has changed since the last run are
+    written, records which have left the dataset are deleted, and nothing
+    is downloaded at all if the file is unchanged. A full refresh, which is
+    also used when no Crossref records are stored yet, downloads the file
+    regardless and applies it to a shadow copy of the table that is
+    swapped in once complete, so the bot never reads a partially loaded
+    table. Unchanged records keep their added and changed times either
+    way.
+    """
     # List of crossref retraction types based on, but stricter than,
     # https://github.com/fathomlabs/crossref-retractions/blob/master/index.js
 
     url = "https://gitlab.com/crossref/retraction-watch-data/-/raw/main/retraction_watch.csv?ref_type=heads"
+    origin = "Crossref"
+
+    full_refresh = full_refresh or not database.has_retractions(origin)
+    headers = {"User-Agent": user_agent}
+    if not full_refresh:
+        etag, last_modified = database.get_dataset_state(origin)
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
 
     # for retraction_type in retraction_types:
-    with requests.Session() as s:
-        r = s.get(url)
-        text = r.content.decode("utf-8", errors="replace")
+    with requests.Session() as s, s.get(url, stream=True, headers=headers) as r:
+        if r.status_code == 304:
+            logging.info("Retraction Watch data unchanged since last run")
+            metrics.count("ingest_unchanged_downloads", origin=origin)
+            return
+        r.raise_for_status()
+
+        table = "retractions"
+        if full_refresh:
+            logging.info("Rebuilding %s retractions in shadow table", origin)
+            table = "retractions_new"
+            database.create_shadow_table()
 
-        csv_reader = csv.DictReader(text.splitlines(), delimiter=",", quotechar='"')
+        # Rows are parsed while the file is still downloading, so memory use
+        # stays flat however large the dataset grows.
+        lines = iter_decoded_lines(r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE))
+        csv_reader = csv.DictReader(lines, delimiter=",", quotechar='"')
         logger.info("Processing downloaded file")
 
         items_count = 0
-        for item in csv_reader:
-            try:
-
+        with database.bulk_writer(origin, table) as writer:
+            for item in csv_reader:
                 items_count += 1
-
-                timestamp = datetime.datetime.strptime(
-                    item["OriginalPaperDate"], "%m/%d/%Y %H:%M"
-                )
                 try:
-
-                    if (
-                        item["OriginalPaperDOI"] != 0
-                        and not database.retracted_id_exists(item["RetractionDOI"])
-                    ) or (
-                        item["OriginalPaperPubMedID"] != 0
-                        and not database.retracted_id_exists(item["RetractionPubMedID"])
-                    ):
-                        logger.info("Saving retraction to db")
-                        database.save_retraction_to_db(
-                            timestamp=timestamp,
-                            origin="Crossref",
-                            original_doi=item["OriginalPaperDOI"],
-                            retraction_doi=item["RetractionDOI"],
-                            original_pmid=item["OriginalPaperPubMedID"],
-                            retraction_pmid=item["RetractionPubMedID"],
-                            retraction_nature=item["RetractionNature"],
-                            url=item["URLS"],
-                        )
-                    else:
-                        logger.info("%s already in db", item)
-                except Exception as e:
-                    logging.warning(
-                        "Failed to write record %s to database : %s",
-                        item["Record ID"],
-                        repr(e),
+                    record = dict(
+                        record_id=item["Record ID"],
+                        timestamp=datetime.datetime.strptime(
+                            item["OriginalPaperDate"], "%m/%d/%Y %H:%M"
+                        ),
+                        original_doi=item["OriginalPaperDOI"],
+                        retraction_doi=item["RetractionDOI"],
+                        original_pmid=item["OriginalPaperPubMedID"],
+                        retraction_pmid=item["RetractionPubMedID"],
+                        retraction_nature=item["RetractionNature"],
+                        url=item["URLS"],
                     )
+                except Exception as e:
+                    # Don't let an unreadable row delete the stored record.
+                    writer.keep(item.get("Record ID"))
+                    metrics.count("ingest_rows_failed", origin=origin)
+                    logging.exception("Error passing Item %s", item, exc_info=e)
+                    continue
+
+                # A failed write is raised, so the batch it loses can't be
+                # swapped in or deleted as stale below.
+                if writer.add(**record):
+                    logger.info("Queued retraction for db")
+                else:
+                    logger.info("%s unchanged in db", item["Record ID"])
+
+        # Only reached once the whole file has been read and written, so a
+        # failed download or write never deletes records or swaps in a
+        # partial table.
+        deleted = writer.delete_stale()
+        if full_refresh:
+            database.swap_shadow_table()
+        database.save_dataset_state(
+            origin, r.headers.get("ETag"), r.headers.get("Last-Modified")
+        )
+        metrics.count("ingest_rows_read", items_count, origin=origin)
+        metrics.count("ingest_rows_written", writer.written, origin=origin)
+        metrics.count("ingest_rows_deleted", deleted, origin=origin)
+        logging.info(
+            "Processed %d records, wrote %d and deleted %d",
+            items_count,
+            writer.written,
+            deleted,
+        )
+
+
+def precompute_template_decisions(database: Database, bot_settings):
+    """
+    Works out, for every configured language, how citations of each
+    retracted identifier are flagged, and stores the rendered templates,
+    so the bot looks them up rather than rendering them for every
+    citation. Languages whose stored decisions were built from the same
+    template settings and dataset are left as they are.
+    """
+    index = RetractionIndex.from_database(database)
+    for language, template_map in bot_settings["template_name_map"].items():
+        field_map = bot_settings["template_field_names"][language]
+        count = save_decisions(database, language, template_map, field_map, index)
+        if count is None:
+            logging.info("Template decisions for %s are up to date", language)
+            continue
+        metrics.count("template_decisions", count, language=language)
+        logging.info("Stored %d template decisions for %s", count, language)
+
+
+def ncbi_params(settings, **params):
+    """Adds the parameters E-utilities wants on every request."""
+    params.update(db="pubmed", tool="RetractionBot")
+    if settings.get("email"):
+        params["email"] = settings["email"]
+    if settings.get("api_key"):
+        params["api_key"] = settings["api_key"]
+    return params
 
-            except Exception as e:
-                logging.exception("Error passing Item %s", item, exc_info=e)
-                continue
-        logging.info("Wrote %d records to database", items_count)
 
+def ncbi_search(session, limiter, settings, term, first, last):
+    """
+    Runs an esearch for term on the history server, limited to records
+    published between two dates, and returns (count, query key, WebEnv).
+    """
+    params = ncbi_params(
+        settings,
+        term=term,
+        usehistory="y",
+        retmax=0,
+        datetype="pdat",
+        mindate=first.strftime("%Y/%m/%d"),
+        maxdate=last.strftime("%Y/%m/%d"),
+    )
 
-def get_ncbi_retractions():
-    with requests.Session() as s:
+    def search():
+        with session.get(
+            NCBI_EUTILS_URL + "esearch.fcgi",
+            params=params,
+            headers={"User-Agent": user_agent},
+        ) as r:
+            r.raise_for_status()
+            return lxml.etree.fromstring(r.content)
 
-        for mode in ["correction"]:  # , "retraction", '"expression of concern"']
-            r = s.get(
-                f"https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pmc&term=${mode}[filter]&usehistory=y&RetMax=100"
+    result = limiter.call(search)
+    error = result.findtext("ERROR")
+    if error:
+        raise RuntimeError("esearch for %s failed: %s" % (term, error))
+    return (
+        int(result.findtext("Count")),
+        result.findtext("QueryKey"),
+        result.findtext("WebEnv"),
+    )
+
+
+def ncbi_searches(session, limiter, settings, term, first, last):
+    """
+    Yields (count, query key, WebEnv, complete) for searches which together
+    cover the records for term published between two dates. Date ranges
+    are halved until each search is within NCBI_SEARCH_LIMIT; complete is
+    False for a single day's search which still isn't.
+    """
+    count, query_key, webenv = ncbi_search(
+        session, limiter, settings, term, first, last
+    )
+    if count <= NCBI_SEARCH_LIMIT or first == last:
+        if count > NCBI_SEARCH_LIMIT:
+            logger.warning(
+                "%d records for %s on %s, only the first %d are read",
+                count,
+                term,
+                first,
+                NCBI_SEARCH_LIMIT,
             )
-            lxml.etree.parse(r.text)
+        if count:
+            yield count, query_key, webenv, count <= NCBI_SEARCH_LIMIT
+        return
+    middle = first + (last - first) // 2
+    yield from ncbi_searches(session, limiter, settings, term, first, middle)
+    yield from ncbi_searches(
+        session, limiter, settings, term, middle + datetime.timedelta(days=1), last
+    )
+
+
+def iter_pubmed_articles(chunks):
+    """
+    Incrementally parses PubMed XML from an iterable of byte chunks,
+    yielding each PubmedArticle element as soon as it is complete. Each is
+    cleared, along with the ones before it, once the caller asks for the
+    next, so memory use doesn't grow with the response.
+    """
+    parser = lxml.etree.XMLPullParser(events=("end",), tag="PubmedArticle")
+
+    def read_events():
+        for _, element in parser.read_events():
+            yield element
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from read_events()
+    parser.close()
+    yield from read_events()
+
+
+def ncbi_fetch(session, limiter, settings, count, query_key, webenv):
+    """
+    Yields every PubmedArticle found by a search on the history server,
+    fetched NCBI_FETCH_SIZE records at a time. Raises RuntimeError if a
+    page is cut short, as E-utilities reports some errors in the body of
+    a successful response.
+    """
+    count = min(count, NCBI_SEARCH_LIMIT)
+    for retstart in range(0, count, NCBI_FETCH_SIZE):
+        params = ncbi_params(
+            settings,
+            query_key=query_key,
+            WebEnv=webenv,
+            retstart=retstart,
+            retmax=NCBI_FETCH_SIZE,
+            retmode="xml",
+        )
+
+        def fetch():
+            r = session.get(
+                NCBI_EUTILS_URL + "efetch.fcgi",
+                params=params,
+                headers={"User-Agent": user_agent},
+                stream=True,
+            )
+            r.raise_for_status()
+            return r
+
+        expected = min(NCBI_FETCH_SIZE, count - retstart)
+        received = 0
+        with limiter.call(fetch) as r:
+            for article in iter_pubmed_articles(
+                r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+            ):
+                received += 1
+                yield article
+        if received < expected:
+            raise RuntimeError(
+                "efetch returned %d of %d records from %d"
+                % (received, expected, retstart)
+            )
+
 
-            # Get details
+def pubmed_date(article):
+    """
+    Returns when a PubmedArticle was added to PubMed, or the epoch if the
+    record doesn't say.
+    """
+    date = article.find("PubmedData/History/PubMedPubDate[@PubStatus='pubmed']")
+    try:
+        return datetime.datetime(
+            int(date.findtext("Year")),
+            int(date.findtext("Month")),
+            int(date.findtext("Day")),
+        )
+    except (AttributeError, TypeError, ValueError):
+        return datetime.datetime.fromtimestamp(0)
 
-            # https://www.ncbi.nlm.nih.gov/pmc/oai/oai.cgi?verb=GetRecord&identifier=oai:pubmedcentral.nih.gov:11924858&metadataPrefix=pmc_fm
+
+def pubmed_links(article):
+    """
+    Returns a dict of the retraction row fields for each notice linked to
+    or from a PubmedArticle element. Only the record of the original
+    article has its DOI, and only the record of a notice has the notice's.
+    """
+    pmid = article.findtext("MedlineCitation/PMID")
+    doi = article.findtext("PubmedData/ArticleIdList/ArticleId[@IdType='doi']")
+    if not doi:
+        doi = article.findtext("MedlineCitation/Article/ELocationID[@EIdType='doi']")
+    timestamp = pubmed_date(article)
+    links = []
+    for reference in article.iterfind(
+        "MedlineCitation/CommentsCorrectionsList/CommentsCorrections"
+    ):
+        link = NCBI_REF_TYPES.get(reference.get("RefType"))
+        ref_pmid = reference.findtext("PMID")
+        if link is None or not ref_pmid or not pmid:
+            continue
+        nature, is_notice = link
+        if is_notice:
+            original_doi, original_pmid = "", ref_pmid.strip()
+            retraction_doi, retraction_pmid = doi or "0", pmid
+        else:
+            original_doi, original_pmid = doi or "", pmid
+            retraction_doi, retraction_pmid = "0", ref_pmid.strip()
+        links.append(
+            {
+                "record_id": "%s-%s" % (original_pmid, retraction_pmid),
+                "timestamp": timestamp,
+                "original_doi": original_doi,
+                "retraction_doi": retraction_doi,
+                "original_pmid": original_pmid,
+                "retraction_pmid": retraction_pmid,
+                "retraction_nature": nature,
+                "url": "",
+            }
+        )
+    return links
+
+
+def get_ncbi_retractions(
+    database: Database, settings=None, full_refresh=False, limiter=None
+):
+    """
+    Loads retraction, expression of concern and correction notices from
+    PubMed into the retractions table, through the same bulk writer as the
+    Retraction Watch data, under the NCBI origin.
+
+    Each of NCBI_QUERIES is searched for on the E-utilities history server
+    and its records fetched in large pages, each parsed as it streams in.
+    As with Retraction Watch, only changed records are written and a full
+    refresh loads into a shadow table, a copy of the live one, which is
+    swapped in however much was read. Records which have left PubMed are
+    only deleted once every search has been read in full, so a bad record
+    or an oversized date slice can't hold back the rest of the data.
+    """
+    settings = settings or {}
+    origin = "NCBI"
+    if limiter is None:
+        limiter = RateLimiter(
+            rate=NCBI_API_KEY_RATE if settings.get("api_key") else NCBI_RATE
+        )
+    full_refresh = full_refresh or not database.has_retractions(origin)
+    table = "retractions"
+    if full_refresh:
+        logging.info("Rebuilding %s retractions in shadow table", origin)
+        table = "retractions_new"
+        database.create_shadow_table()
+
+    today = datetime.date.today()
+    last = datetime.date(today.year + 1, 12, 31)
+    articles_count = 0
+    complete = True
+    with requests.Session() as s, database.bulk_writer(origin, table) as writer:
+        for term in settings.get("queries", NCBI_QUERIES):
+            for count, query_key, webenv, whole in ncbi_searches(
+                s, limiter, settings, term, NCBI_FIRST_DATE, last
+            ):
+                complete = complete and whole
+                logger.info("Fetching %d records for %s", count, term)
+                for article in ncbi_fetch(
+                    s, limiter, settings, count, query_key, webenv
+                ):
+                    articles_count += 1
+                    try:
+                        links = pubmed_links(article)
+                    except Exception as e:
+                        # Rows from this record mustn't be deleted as stale.
+                        complete = False
+                        metrics.count("ingest_rows_failed", origin=origin)
+                        logging.exception("Error parsing PubMed record", exc_info=e)
+                        continue
+                    for link in links:
+                        writer.add(**link)
+
+    deleted = 0
+    if complete:
+        deleted = writer.delete_stale()
+    else:
+        logging.warning("Not every %s record was read, none deleted", origin)
+    if full_refresh:
+        database.swap_shadow_table()
+    metrics.count("ingest_rows_read", articles_count, origin=origin)
+    metrics.count("ingest_rows_written", writer.written, origin=origin)
+    metrics.count("ingest_rows_deleted", deleted, origin=origin)
+    logging.info(
+        "Processed %d PubMed records, wrote %d and deleted %d",
+        articles_count,
+        writer.written,
+        deleted,
+    )
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="rebuild the whole dataset rather than applying changed rows",
+    )
+    args = parser.parse_args()
+
     bot_settings = load_bot_settings()
-    database = Database(bot_settings["db"])
-    database.truncate_db()
+    with run_report("findretraction", bot_settings.get("metrics"), directory):
+        database = Database(bot_settings["db"])
+        database.migrate()
+
+        with metrics.timer("ingest", origin="Crossref"):
+            get_crossref_retractions(database, full_refresh=args.full)
+
+        ncbi_settings = bot_settings.get("ncbi", {})
+        if ncbi_settings.get("enabled", True):
+            try:
+                with metrics.timer("ingest", origin="NCBI"):
+                    get_ncbi_retractions(
+                        database, ncbi_settings, full_refresh=args.full
+                    )
+            except Exception as e:
+                # Nothing is deleted or swapped in by a failed ingest, so
+                # the bot carries on with what was stored before.
+                metrics.count("ingest_failures", origin="NCBI")
+                logger.exception("PubMed ingest failed", exc_info=e)
+
+        with metrics.timer("decisions"):
+            precompute_template_decisions(database, bot_settings)
 
-    get_crossref_retractions(database)
+        snapshot_path = (bot_settings.get("snapshot") or {}).get("path")
+        if snapshot_path:
+            with metrics.timer("snapshot"):
+                export_snapshot(database, snapshot_path)
@@ -0,0 +1,67 @@
+import re
+import urllib.parse
+
+DOI_REGEX = r"\b(10[.][0-9]{4,}(?:[.][0-9]+)*/(?:(?![\"&'<>])[a-zA-Z.\/0-9\-])+)\b"
+
+DOI_PREFIXES = (
+    "https://doi.org/",
+    "http://doi.org/",
+    "https://dx.doi.org/",
+    "http://dx.doi.org/",
+    "doi:",
+)
+
+
+def canonical_doi(value):
+    """
+    Returns the canonical form of a DOI, or None if the value isn't one.
+    DOIs are case-insensitive, so the canonical form is lower case, with
+    any resolver prefix and URL encoding removed.
+    """
+    value = urllib.parse.unquote(value.strip()).strip().lower()
+    for prefix in DOI_PREFIXES:
+        if value.startswith(prefix):
+            value = value[len(prefix) :]
+            break
+    if not value.startswith("10.") or "/" not in value:
+        return None
+    return value
+
+
+def canonical_pmid(value):
+    """
+    Returns the canonical form of a PubMed ID, or None if the value isn't
+    one. Retraction Watch uses 0 for records without a PMID.
+    """
+    value = value.strip()
+    if not value.isdigit() or int(value) == 0:
+        return None
+    return str(int(value))
+
+
+def classify_identifier(value):
+    """
+    Given an identifier as found in a template, returns an (id_type,
+    canonical value) tuple where id_type is 'doi' or 'pmid', or None if
+    it's neither.
+    """
+    if re.fullmatch(r"\s*[0-9]+\s*", value):
+        pmid = canonical_pmid(value)
+        return ("pmid", pmid) if pmid else None
+    doi = canonical_doi(value)
+    return ("doi", doi) if doi else None
+
+
+def record_identifiers(original_doi, original_pmid):
+    """
+    Returns the (id_type, canonical value) pairs a retraction record can be
+    looked up by.
+    """
+    identifiers = []
+    doi = canonical_doi(original_doi)
+    if doi:
+        identifiers.append(("doi", doi))
+    pmid = canonical_pmid(original_pmid)
+    if pmid:
+        identifiers.append(("pmid", pmid))
+    return identifiers
@@ -0,0 +1,81 @@
+import re
+
+from .identifiers import canonical_doi, canonical_pmid
+
+# Anything that could be a DOI, including URL-encoded ones (10.1000%2Fabc).
+# Candidates end at whitespace or wikitext/HTML syntax, and are then
+# trimmed of trailing punctuation until they match.
+DOI_CANDIDATE = re.compile(r"10\.[0-9]{4,9}(?:/|%2[fF])[^\s|{}\[\]<>\"]+")
+
+# PMIDs are plain numbers, so only look for them where they are labelled as
+# one: pmid=123, {{pmid|123}}, PMID: 123 or a PubMed URL.
+PMID_CANDIDATE = re.compile(
+    r"(?:\bpmid\s*[=|:]?\s*|pubmed(?:\.ncbi\.nlm\.nih\.gov)?/)([0-9]{1,9})\b",
+    re.IGNORECASE,
+)
+
+TRAILING_PUNCTUATION = ".,;:)]'"
+
+
+class IdentifierMatcher:
+    """
+    Finds every occurrence of a set of DOIs and PMIDs in a text in one pass.
+    Rather than searching for each identifier in turn, each DOI- or
+    PMID-shaped token in the text is canonicalised and looked up in a set,
+    so the cost depends on the length of the text and not on the number of
+    identifiers.
+    """
+
+    def __init__(self, dois=(), pmids=()):
+        self.dois = {x for x in (canonical_doi(x) for x in dois) if x}
+        self.pmids = {x for x in (canonical_pmid(x) for x in pmids) if x}
+
+    @classmethod
+    def from_index(cls, index):
+        return cls(index.identifiers("doi"), index.identifiers("pmid"))
+
+    @classmethod
+    def from_sets(cls, dois, pmids):
+        """
+        Matcher looking identifiers up in containers of canonical DOIs and
+        PMIDs as they are, rather than copying them into sets.
+        """
+        matcher = cls()
+        matcher.dois = dois
+        matcher.pmids = pmids
+        return matcher
+
+    def _match_doi(self, candidate):
+        while candidate:
+            doi = canonical_doi(candidate)
+            if doi in self.dois:
+                return doi, candidate
+            if candidate[-1] not in TRAILING_PUNCTUATION:
+                return None
+            candidate = candidate[:-1]
+        return None
+
+    def finditer(self, text):
+        """
+        Yields (start, end, id_type, canonical value) for each identifier
+        found in text, DOIs first and then PMIDs, each in text order.
+        """
+        if self.dois:
+            for match in DOI_CANDIDATE.finditer(text):
+                found = self._match_doi(match.group())
+                if found:
+                    doi, matched = found
+                    yield match.start(), match.start() + len(matched), "doi", doi
+        if self.pmids:
+            for match in PMID_CANDIDATE.finditer(text):
+                pmid = canonical_pmid(match.group(1))
+                if pmid in self.pmids:
+                    yield match.start(1), match.end(1), "pmid", pmid
+
+    def find(self, text):
+        """Returns the list of hits finditer yields, ordered by offset."""
+        return sorted(self.finditer(text))
+
+    def matches(self, text):
+        """Returns the set of canonical identifiers found in text."""
+        return {x[3] for x in self.finditer(text)}
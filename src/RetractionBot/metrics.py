@@ -0,0 +1,299 @@
+"""
+Timings and counters for each stage of a run, written out as a JSON report
+and a Prometheus textfile (for node_exporter's textfile collector) when
+the run ends, and periodically while it is going.
+
+    with metrics.timer("parse"):
+        wikitext = mwparserfromhell.parse(page_text)
+    metrics.count("pages_edited", language="en")
+
+Each observation costs a couple of perf_counter calls and a lock, so the
+instrumentation can stay on for production runs.
+"""
+
+import bisect
+import contextlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    300,
+)
+
+# Seconds between report snapshots during a run.
+SNAPSHOT_INTERVAL = 60
+
+PREFIX = "retractionbot"
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Estimates the pth percentile by interpolating within the bucket it
+        falls in.
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100
+        seen = 0
+        for i, bucket_count in enumerate(self.buckets):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = BUCKETS[i - 1] if i else 0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                lower, upper = max(lower, self.min), min(upper, self.max)
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "min": self.min,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _label_text(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '{0}="{1}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+            for k, v in labels
+        )
+        + "}"
+    )
+
+
+def _write_atomically(path, text):
+    # Readers, node_exporter included, never see a partly written file.
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as output_file:
+        output_file.write(text)
+    os.replace(temp_path, path)
+
+
+class Metrics:
+    """
+    Thread-safe registry of per-stage latency histograms and counters, each
+    identified by a name and optional labels.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+            self.started = time.time()
+
+    def observe(self, stage, seconds, **labels):
+        if not self.enabled:
+            return
+        key = _key(stage, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, stage, **labels):
+        """Times the body of a with block as one observation of stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def report(self):
+        """Returns the current state of every stage and counter as a dict."""
+        with self._lock:
+            stages = [
+                dict(labels, stage=name, **histogram.summary())
+                for (name, labels), histogram in self._histograms.items()
+            ]
+            counters = [
+                dict(labels, name=name, value=value)
+                for (name, labels), value in self._counters.items()
+            ]
+        return {
+            "started": self.started,
+            "elapsed": time.time() - self.started,
+            "stages": sorted(stages, key=lambda x: (x["stage"], str(x))),
+            "counters": sorted(counters, key=lambda x: (x["name"], str(x))),
+        }
+
+    def prometheus(self, job):
+        """Returns every stage and counter in Prometheus text format."""
+        base = (("script", job),)
+        lines = [
+            "# HELP {0}_stage_seconds Time spent in each stage of a run.".format(
+                PREFIX
+            ),
+            "# TYPE {0}_stage_seconds histogram".format(PREFIX),
+        ]
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            started = self.started
+        for (name, labels), histogram in histograms:
+            labels = base + (("stage", name),) + labels
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ("+Inf",), histogram.buckets):
+                cumulative += bucket_count
+                lines.append(
+                    "{0}_stage_seconds_bucket{1} {2}".format(
+                        PREFIX, _label_text(labels, [("le", bound)]), cumulative
+                    )
+                )
+            lines.append(
+                "{0}_stage_seconds_sum{1} {2}".format(
+                    PREFIX, _label_text(labels), histogram.sum
+                )
+            )
+            lines.append(
+                "{0}_stage_seconds_count{1} {2}".format(
+                    PREFIX, _label_text(labels), histogram.count
+                )
+            )
+        for name, group in itertools.groupby(counters, key=lambda x: x[0][0]):
+            lines.append("# TYPE {0}_{1}_total counter".format(PREFIX, name))
+            for (_, labels), value in group:
+                lines.append(
+                    "{0}_{1}_total{2} {3}".format(
+                        PREFIX, name, _label_text(base + labels), value
+                    )
+                )
+        lines.append("# TYPE {0}_run_start_seconds gauge".format(PREFIX))
+        lines.append(
+            "{0}_run_start_seconds{1} {2}".format(PREFIX, _label_text(base), started)
+        )
+        lines.append("# TYPE {0}_last_report_seconds gauge".format(PREFIX))
+        lines.append(
+            "{0}_last_report_seconds{1} {2}".format(
+                PREFIX, _label_text(base), time.time()
+            )
+        )
+        return "\n".join(lines) + "\n"
+
+    def write(self, job, report_path=None, prometheus_path=None, final=False):
+        """Writes the JSON report and Prometheus textfile, where given."""
+        if report_path:
+            report = self.report()
+            report["job"] = job
+            report["final"] = final
+            _write_atomically(report_path, json.dumps(report, indent=2) + "\n")
+        if prometheus_path:
+            _write_atomically(prometheus_path, self.prometheus(job))
+
+
+metrics = Metrics()
+
+
+@contextlib.contextmanager
+def run_report(job, settings=None, directory="."):
+    """
+    Collects metrics for the run inside the with block. The report and
+    textfile are rewritten every snapshot_interval seconds while it runs,
+    and a final time when it ends, even if it fails. settings is the
+    metrics section of bot_settings.yml; the files default to job.json
+    and job.prom in directory.
+    """
+    settings = settings or {}
+    metrics.enabled = settings.get("enabled", True)
+    if not metrics.enabled:
+        yield metrics
+        return
+
+    paths = {
+        "report_path": settings.get("report", os.path.join(directory, job + ".json")),
+        "prometheus_path": settings.get(
+            "prometheus", os.path.join(directory, job + ".prom")
+        ),
+    }
+    interval = settings.get("snapshot_interval", SNAPSHOT_INTERVAL)
+    metrics.reset()
+    stop = threading.Event()
+
+    def snapshot():
+        while not stop.wait(interval):
+            try:
+                metrics.write(job, **paths)
+            except OSError as e:
+                logger.warning("Failed to write metrics snapshot: %r", e)
+
+    snapshots = threading.Thread(target=snapshot, name="metrics", daemon=True)
+    snapshots.start()
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        stop.set()
+        snapshots.join()
+        metrics.observe("run", time.perf_counter() - start)
+        metrics.write(job, final=True, **paths)
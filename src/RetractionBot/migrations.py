@@ -0,0 +1,499 @@
+"""
+Versioned schema migrations for the bot database.
+
+Each migration is a version number, a description and a list of steps,
+where a step is either an SQL statement or a function taking a cursor.
+Applied versions are recorded in schema_migrations, so running the
+migrations again only applies the ones a deployment hasn't seen yet.
+schema.sql always describes the latest schema and marks every migration
+as applied, so new deployments start up to date. SQLite databases are
+created by their own list of migrations, SQLITE_MIGRATIONS.
+"""
+
+import logging
+
+from .identifiers import record_identifiers
+
+logger = logging.getLogger(__name__)
+
+
+def _backfill_identifiers(cur):
+    cur.execute(
+        "SELECT origin, record_id, original_doi, original_pmid FROM retractions"
+    )
+    rows = [
+        (id_type, id_value, origin, record_id)
+        for origin, record_id, original_doi, original_pmid in cur.fetchall()
+        for id_type, id_value in record_identifiers(
+            original_doi.decode("utf-8"), original_pmid.decode("utf-8")
+        )
+    ]
+    cur.executemany(
+        """
+        INSERT IGNORE INTO retraction_identifiers (id_type, id_value, origin, record_id)
+        VALUES (%s, %s, %s, %s)""",
+        rows,
+    )
+
+
+MIGRATIONS = [
+    (
+        1,
+        "Record IDs, content hashes and dataset state for delta refreshes",
+        [
+            # Existing rows have no record ID to key on. Rather than clear
+            # the table, which would leave the bot with nothing to serve
+            # until the next find_retractions run, each row gets a unique
+            # placeholder ID and an empty hash. No source record has either,
+            # so that run inserts every record afresh and deletes the
+            # placeholder rows as stale. Every step is safe to rerun.
+            """
+            ALTER TABLE retractions
+                ADD COLUMN IF NOT EXISTS `record_id` varbinary(50) NOT NULL DEFAULT '',
+                ADD COLUMN IF NOT EXISTS `row_hash` varbinary(40) NOT NULL DEFAULT ''
+            """,
+            """
+            UPDATE retractions SET record_id = CONCAT('legacy-', UUID())
+            WHERE record_id = ''
+            """,
+            """
+            ALTER TABLE retractions
+                ALTER COLUMN `record_id` DROP DEFAULT,
+                ALTER COLUMN `row_hash` DROP DEFAULT,
+                ADD UNIQUE KEY IF NOT EXISTS `origin_record_id` (`origin`, `record_id`)
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS `dataset_state` (
+                `origin` varbinary(20) NOT NULL PRIMARY KEY,
+                `etag` varbinary(255) NULL,
+                `last_modified` varbinary(64) NULL
+            ) ENGINE=Aria
+            """,
+        ],
+    ),
+    (
+        2,
+        "Identifier lookup table and edit_log index",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS `retraction_identifiers` (
+                `id_type` varbinary(4) NOT NULL,
+                `id_value` varbinary(200) NOT NULL,
+                `origin` varbinary(20) NOT NULL,
+                `record_id` varbinary(50) NOT NULL,
+                PRIMARY KEY (`id_type`, `id_value`, `origin`, `record_id`),
+                KEY `origin_record_id` (`origin`, `record_id`)
+            ) ENGINE=Aria
+            """,
+            _backfill_identifiers,
+            """
+            ALTER TABLE edit_log
+                ADD KEY IF NOT EXISTS `page_title_doi` (`page_title`, `original_doi`)
+            """,
+        ],
+    ),
+    (
+        3,
+        "Retraction added times and per-wiki search progress",
+        [
+            """
+            ALTER TABLE retractions
+                ADD COLUMN IF NOT EXISTS `added` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS `search_progress` (
+                `domain` varbinary(20) NOT NULL,
+                `term` varbinary(200) NOT NULL,
+                `searched` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (`domain`, `term`)
+            ) ENGINE=Aria
+            """,
+        ],
+    ),
+    (
+        4,
+        "Retraction change times and per-page revision state",
+        [
+            """
+            ALTER TABLE retractions
+                ADD COLUMN IF NOT EXISTS `changed` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS `page_state` (
+                `domain` varbinary(20) NOT NULL,
+                `page_id` INT UNSIGNED NOT NULL,
+                `revid` INT UNSIGNED NOT NULL,
+                `dataset_version` TIMESTAMP NULL,
+                `checked` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (`domain`, `page_id`)
+            ) ENGINE=Aria
+            """,
+        ],
+    ),
+    (
+        5,
+        "Persistent edit queue",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS `edit_queue` (
+                `domain` varbinary(20) NOT NULL,
+                `page_id` INT UNSIGNED NOT NULL,
+                `page_title` varbinary(255) NOT NULL,
+                `base_revid` INT UNSIGNED NOT NULL,
+                `text` MEDIUMBLOB NOT NULL,
+                `changes` BLOB NOT NULL,
+                `queued` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                `attempts` INT UNSIGNED NOT NULL DEFAULT 0,
+                PRIMARY KEY (`domain`, `page_id`),
+                KEY `domain_queued` (`domain`, `queued`)
+            ) ENGINE=Aria
+            """,
+        ],
+    ),
+    (
+        6,
+        "Per-wiki search result cache",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS `search_cache` (
+                `domain` varbinary(20) NOT NULL,
+                `term` varbinary(200) NOT NULL,
+                `page_ids` MEDIUMBLOB NOT NULL,
+                `fetched` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                `ttl` INT UNSIGNED NOT NULL,
+                PRIMARY KEY (`domain`, `term`)
+            ) ENGINE=Aria
+            """,
+        ],
+    ),
+    (
+        7,
+        "Partition leases and worker heartbeats for sharded runs",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS `shard_leases` (
+                `domain` varbinary(20) NOT NULL,
+                `partition_id` INT UNSIGNED NOT NULL,
+                `owner` varbinary(100) NULL,
+                `expires` TIMESTAMP NULL,
+                `completed` TIMESTAMP NULL,
+                PRIMARY KEY (`domain`, `partition_id`),
+                KEY `owner` (`owner`)
+            ) ENGINE=Aria
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS `shard_workers` (
+                `worker` varbinary(100) NOT NULL PRIMARY KEY,
+                `heartbeat` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            ) ENGINE=Aria
+            """,
+        ],
+    ),
+    (
+        8,
+        "Template decisions per language and identifier",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS `template_decisions` (
+                `language` varbinary(20) NOT NULL,
+                `id_type` varbinary(4) NOT NULL,
+                `id_value` varbinary(200) NOT NULL,
+                `template` BLOB NULL,
+                `original_doi` varbinary(200) NOT NULL,
+                `original_pmid` varbinary(200) NOT NULL,
+                `build_hash` varbinary(40) NOT NULL,
+                PRIMARY KEY (`language`, `id_type`, `id_value`)
+            ) ENGINE=Aria
+            """,
+        ],
+    ),
+    (
+        9,
+        "Owners of queued edits for sharded runs",
+        [
+            """
+            ALTER TABLE edit_queue
+                ADD COLUMN IF NOT EXISTS `owner` varbinary(100) NULL
+            """,
+        ],
+    ),
+    (
+        10,
+        "Deletion times of retracted identifiers",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS `retraction_deletions` (
+                `id_type` varbinary(4) NOT NULL,
+                `id_value` varbinary(200) NOT NULL,
+                `deleted` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (`id_type`, `id_value`)
+            ) ENGINE=Aria
+            """,
+        ],
+    ),
+]
+
+
+# SQLite databases are always created from scratch, so start at the schema
+# the MySQL migrations above lead to. Columns are in the same order as in
+# MySQL, and keys of tables that get shadow copies are declared inline so
+# that create_table_like copies them.
+SQLITE_MIGRATIONS = [
+    (
+        3,
+        "Initial schema",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS retractions (
+                timestamp TIMESTAMP NOT NULL,
+                origin BLOB NOT NULL,
+                original_doi BLOB NOT NULL,
+                retraction_doi BLOB NOT NULL,
+                original_pmid BLOB NOT NULL,
+                retraction_pmid BLOB NOT NULL,
+                retraction_nature BLOB NOT NULL,
+                url BLOB NOT NULL,
+                record_id BLOB NOT NULL,
+                row_hash BLOB NOT NULL,
+                added TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (origin, record_id)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS retraction_identifiers (
+                id_type BLOB NOT NULL,
+                id_value BLOB NOT NULL,
+                origin BLOB NOT NULL,
+                record_id BLOB NOT NULL,
+                PRIMARY KEY (id_type, id_value, origin, record_id),
+                UNIQUE (origin, record_id, id_type, id_value)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS edit_log (
+                timestamp TIMESTAMP NOT NULL,
+                domain BLOB NOT NULL,
+                page_title BLOB NOT NULL,
+                original_doi BLOB NOT NULL,
+                retraction_doi BLOB NOT NULL,
+                original_pmid BLOB NOT NULL,
+                retraction_pmid BLOB NOT NULL
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS edit_log_page_title_doi
+                ON edit_log (page_title, original_doi)
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS dataset_state (
+                origin BLOB NOT NULL PRIMARY KEY,
+                etag BLOB NULL,
+                last_modified BLOB NULL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS search_progress (
+                domain BLOB NOT NULL,
+                term BLOB NOT NULL,
+                searched TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (domain, term)
+            )
+            """,
+        ],
+    ),
+    (
+        4,
+        "Retraction change times and per-page revision state",
+        [
+            # SQLite can't add a column defaulting to CURRENT_TIMESTAMP, so
+            # existing records are dated to the epoch.
+            """
+            ALTER TABLE retractions
+                ADD COLUMN changed TIMESTAMP NOT NULL
+                DEFAULT '1970-01-01 00:00:01'
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS page_state (
+                domain BLOB NOT NULL,
+                page_id INTEGER NOT NULL,
+                revid INTEGER NOT NULL,
+                dataset_version TIMESTAMP NULL,
+                checked TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (domain, page_id)
+            )
+            """,
+        ],
+    ),
+    (
+        5,
+        "Persistent edit queue",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS edit_queue (
+                domain BLOB NOT NULL,
+                page_id INTEGER NOT NULL,
+                page_title BLOB NOT NULL,
+                base_revid INTEGER NOT NULL,
+                text BLOB NOT NULL,
+                changes BLOB NOT NULL,
+                queued TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (domain, page_id)
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS edit_queue_domain_queued
+                ON edit_queue (domain, queued)
+            """,
+        ],
+    ),
+    (
+        6,
+        "Per-wiki search result cache",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS search_cache (
+                domain BLOB NOT NULL,
+                term BLOB NOT NULL,
+                page_ids BLOB NOT NULL,
+                fetched TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                ttl INTEGER NOT NULL,
+                PRIMARY KEY (domain, term)
+            )
+            """,
+        ],
+    ),
+    (
+        7,
+        "Partition leases and worker heartbeats for sharded runs",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS shard_leases (
+                domain BLOB NOT NULL,
+                partition_id INTEGER NOT NULL,
+                owner BLOB NULL,
+                expires TIMESTAMP NULL,
+                completed TIMESTAMP NULL,
+                PRIMARY KEY (domain, partition_id)
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS shard_leases_owner ON shard_leases (owner)
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS shard_workers (
+                worker BLOB NOT NULL PRIMARY KEY,
+                heartbeat TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+        ],
+    ),
+    (
+        8,
+        "Template decisions per language and identifier",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS template_decisions (
+                language BLOB NOT NULL,
+                id_type BLOB NOT NULL,
+                id_value BLOB NOT NULL,
+                template BLOB NULL,
+                original_doi BLOB NOT NULL,
+                original_pmid BLOB NOT NULL,
+                build_hash BLOB NOT NULL,
+                PRIMARY KEY (language, id_type, id_value)
+            )
+            """,
+        ],
+    ),
+    (
+        9,
+        "Owners of queued edits for sharded runs",
+        [
+            """
+            ALTER TABLE edit_queue ADD COLUMN owner BLOB NULL
+            """,
+        ],
+    ),
+    (
+        10,
+        "Deletion times of retracted identifiers",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS retraction_deletions (
+                id_type BLOB NOT NULL,
+                id_value BLOB NOT NULL,
+                deleted TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id_type, id_value)
+            )
+            """,
+        ],
+    ),
+]
+
+BACKEND_MIGRATIONS = {"mysql": MIGRATIONS, "sqlite": SQLITE_MIGRATIONS}
+
+SCHEMA_MIGRATIONS_TABLE = {
+    "mysql": """
+        CREATE TABLE IF NOT EXISTS `schema_migrations` (
+            `version` INT NOT NULL PRIMARY KEY,
+            `applied` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=Aria
+        """,
+    "sqlite": """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER NOT NULL PRIMARY KEY,
+            applied TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+}
+
+
+def applied_versions(cur, dialect="mysql"):
+    cur.execute(SCHEMA_MIGRATIONS_TABLE[dialect])
+    cur.execute("SELECT version FROM schema_migrations")
+    return {x[0] for x in cur.fetchall()}
+
+
+def apply_migrations(backend):
+    """
+    Applies every migration for the backend's dialect not yet recorded in
+    schema_migrations, in version order. Returns the list of versions
+    applied.
+
+    On SQLite each migration runs in one transaction, so a failed one
+    leaves nothing behind. MySQL commits every DDL statement as it runs,
+    and Aria tables aren't transactional anyway, so a failed migration can
+    be left half applied and unrecorded. Every MySQL step is written to be
+    safe to rerun (IF NOT EXISTS, and updates that skip rows already
+    done), so to recover, fix the cause and run the migrations again.
+    """
+    with backend.cursor() as cur:
+        done = applied_versions(cur, backend.dialect)
+
+    applied = []
+    for version, description, steps in BACKEND_MIGRATIONS[backend.dialect]:
+        if version in done:
+            continue
+        logger.info("Applying migration %d: %s", version, description)
+        with backend.cursor() as cur:
+            for step in steps:
+                if callable(step):
+                    step(cur)
+                else:
+                    cur.execute(step)
+            cur.execute(
+                "INSERT INTO schema_migrations (version) VALUES (%s)", (version,)
+            )
+        applied.append(version)
+    return applied
+
+
+if __name__ == "__main__":
+    from .db import Database
+    from .retraction_bot import load_bot_settings
+
+    logging.basicConfig(level=logging.INFO)
+    database = Database(load_bot_settings()["db"])
+    applied = database.migrate()
+    logger.info("Applied migrations: %s", applied or "none")
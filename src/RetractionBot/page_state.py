@@ -0,0 +1,87 @@
+import logging
+import threading
+
+from .metrics import metrics
+from .throttle import site_limiter
+
+logger = logging.getLogger(__name__)
+
+
+def has_revision_info(page):
+    # Pages from search results already have their page and revision IDs,
+    # and reading them through the public properties would load any which
+    # are missing one page at a time.
+    return hasattr(page, "_pageid") and hasattr(page, "_revid")
+
+
+def load_revision_info(site, pages, limiter=None):
+    """
+    Loads the page and latest revision IDs of any of pages which don't
+    have them yet, with a single API request per batch of pages (500 for
+    bots) and without fetching their text.
+    """
+    missing = [x for x in pages if not has_revision_info(x)]
+    if not missing:
+        return
+    limiter = limiter or site_limiter(site)
+    batch_size = site.maxlimit
+    for i in range(0, len(missing), batch_size):
+        group = missing[i : i + batch_size]
+
+        def fetch():
+            with metrics.timer("revision_info", language=site.code):
+                for _ in site.preloadpages(group, groupsize=batch_size, content=False):
+                    pass
+
+        try:
+            limiter.call(fetch)
+        except Exception as e:
+            logger.error("Failed to load revisions of %d pages: %r", len(group), e)
+
+
+class PageStateCache:
+    """
+    The revision of each page on a wiki the bot last checked, and the
+    version of the retraction dataset it checked it against. A page needs
+    checking again only if it has been edited since, or if any of the
+    retracted works it may cite has been added or changed since. Pages
+    may be recorded as checked from any thread.
+    """
+
+    def __init__(self, database, domain, index):
+        self._database = database
+        self.domain = domain
+        self.index = index
+        self._states = database.load_page_states(domain)
+        self._checked = []
+        self._lock = threading.Lock()
+
+    def is_current(self, page, identifiers):
+        """
+        Returns True if page, whose revision info must be loaded, is
+        unchanged since it was last checked and none of identifiers, the
+        identifiers it was found by, has changed in the dataset since.
+        """
+        if not has_revision_info(page):
+            return False
+        state = self._states.get(page.pageid)
+        if state is None:
+            return False
+        revid, dataset_version = state
+        return revid == page.latest_revision_id and not self.index.changed_since(
+            identifiers, dataset_version
+        )
+
+    def checked(self, page):
+        """Records that page has been checked at its latest revision."""
+        state = (page.latest_revision_id, self.index.dataset_version)
+        with self._lock:
+            self._states[page.pageid] = state
+            self._checked.append((page.pageid,) + state)
+
+    def save(self):
+        """Writes the states recorded by checked since the last save."""
+        with self._lock:
+            checked, self._checked = self._checked, []
+        if checked:
+            self._database.save_page_states(self.domain, checked)
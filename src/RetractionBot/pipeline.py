@@ -0,0 +1,72 @@
+import concurrent.futures
+import logging
+
+from .metrics import metrics
+from .throttle import site_limiter
+
+logger = logging.getLogger(__name__)
+
+# Pages whose text is fetched per API request. 50 is the most the API
+# allows for prop=revisions with content.
+PRELOAD_GROUP_SIZE = 50
+
+# Threads analysing pages while the next group downloads.
+ANALYSIS_WORKERS = 4
+
+
+def preloaded_batches(site, pages, groupsize=PRELOAD_GROUP_SIZE, limiter=None):
+    """
+    Yields lists of up to groupsize pages, each list's text having been
+    fetched with a single API request. Requests are paced by limiter, the
+    site's shared RateLimiter by default; groups which can't be fetched are
+    logged and skipped.
+    """
+    limiter = limiter or site_limiter(site)
+    pages = list(pages)
+    for i in range(0, len(pages), groupsize):
+        group = pages[i : i + groupsize]
+
+        def fetch():
+            with metrics.timer("fetch", language=site.code):
+                return list(site.preloadpages(group, groupsize=groupsize))
+
+        try:
+            batch = limiter.call(fetch)
+        except Exception as e:
+            logger.error("Failed to fetch %d pages: %r", len(group), e)
+            metrics.count("fetch_failures", len(group), language=site.code)
+            continue
+        metrics.count("pages_fetched", len(batch), language=site.code)
+        yield batch
+
+
+def _collect(submitted):
+    for page, future in submitted:
+        try:
+            yield page, future.result()
+        except Exception as e:
+            logger.exception("Failed to process %s", page, exc_info=e)
+            metrics.count("analysis_failures")
+
+
+def analyse_pages(
+    site,
+    pages,
+    analyse,
+    workers=ANALYSIS_WORKERS,
+    groupsize=PRELOAD_GROUP_SIZE,
+    limiter=None,
+):
+    """
+    Yields (page, analyse(page.text)) for each of pages. Pages are fetched
+    in groups, and each group is analysed on a pool of threads while the
+    next one downloads and the results of the previous one are consumed.
+    Pages whose analysis raises are logged and skipped.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        previous = []
+        for batch in preloaded_batches(site, pages, groupsize, limiter):
+            submitted = [(page, pool.submit(analyse, page.text)) for page in batch]
+            yield from _collect(previous)
+            previous = submitted
+        yield from _collect(previous)
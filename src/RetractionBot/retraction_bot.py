@@ -1,9 +1,12 @@
+import argparse
+import concurrent.futures
+import contextlib
 import datetime
 import logging
 import os
 import pywikibot
-from pywikibot import pagegenerators
 import re
+import time
 import pywikibot.login
 import yaml
 
@@ -12,9 +15,29 @@ try:
 except ImportError:
     from yaml import Loader
 import mwparserfromhell
-import time
 
 from .db import Database
+from .edit_queue import DEFAULT_EDIT_RATE, LOG_BATCH_SIZE, EditQueue
+from .metrics import metrics, run_report
+from .page_state import PageStateCache, load_revision_info
+from .identifiers import DOI_REGEX
+from .pipeline import ANALYSIS_WORKERS, PRELOAD_GROUP_SIZE, analyse_pages
+from .retraction_index import RetractionIndex
+from .rewrite import RewriteEngine, load_decisions
+from .schedule import ROUND_SIZE, prioritise_terms, rounds
+from .search import cited_terms, read_candidates, search_terms
+from .search_cache import DEFAULT_TTL_DAYS, TTL_JITTER, SearchCache
+from .sharding import (
+    DEFAULT_PARTITIONS,
+    HEARTBEAT_INTERVAL,
+    LEASE_TTL,
+    SWEEP_HOURS,
+    Shard,
+    partitioned,
+    share_budgets,
+)
+from .snapshot import SnapshotIndex, open_snapshot
+from .throttle import site_limiter
 
 directory = os.path.dirname(os.path.realpath(__file__))
 
@@ -27,7 +50,9 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.DEBUG)
-DOI_REGEX = r"\b(10[.][0-9]{4,}(?:[.][0-9]+)*/(?:(?![\"&'<>])[a-zA-Z.\/0-9\-])+)\b"
+
+# Seconds between checks of a wiki's killswitch while its edits are saved.
+KILLSWITCH_INTERVAL = 60 * 5
 
 
 def check_bot_killswitches(site):
@@ -55,6 +80,26 @@ def check_bot_killswitches(site):
     return True
 
 
+def killswitch_check(site, interval=KILLSWITCH_INTERVAL):
+    """
+    Returns a function returning whether the bot can run on site, which
+    checks the killswitch at most once per interval, for the edit queue
+    to call before each save.
+    """
+    checked = None
+    can_run = False
+
+    def check():
+        nonlocal checked, can_run
+        now = time.monotonic()
+        if checked is None or now - checked > interval:
+            can_run = check_bot_killswitches(site)
+            checked = now
+        return can_run
+
+    return check
+
+
 def load_bot_settings():
     """Returns the contents of bot_settings.yaml"""
     with open("bot_settings.yml") as bot_settings_file:
@@ -62,316 +107,375 @@ def load_bot_settings():
     return loaded_yaml
 
 
-def run_bot():
+def load_index(database, bot_settings):
+    """
+    Returns the retraction index: the snapshot named by the snapshot path
+    setting, if there is one which can be read, or else every retraction
+    loaded into memory from the database. Either way every template lookup
+    is served without a DB round trip.
+    """
+    path = (bot_settings.get("snapshot") or {}).get("path")
+    index = open_snapshot(path) if path else None
+    if index is None:
+        index = RetractionIndex.from_database(database)
+    return index
+
+
+def run_bot(candidate_files=None, jobs=None, worker_id=None):
+    """
+    Flags citations to retracted works on every configured wiki.
+    candidate_files optionally maps a language to a candidate page list
+    written by find_citing_pages, which is used instead of searching.
+    With jobs greater than one, this is one of that many sharded jobs,
+    each processing the partitions of every wiki's work it leases, within
+    its share of the request and edit rates.
+
+    The wikis are run concurrently, each on its own thread with its own
+    rate limit and killswitch, sharing one retraction index, so a run
+    takes as long as the slowest wiki rather than all of them together.
+    A wiki whose run fails is logged without stopping the others.
+    """
+    candidate_files = candidate_files or {}
     bot_settings = load_bot_settings()
-    bot_languages = bot_settings["template_name_map"]
-    template_field_names = bot_settings["template_field_names"]
-    database = Database(bot_settings["db"])
-    retracted_identifiers = database.load_retracted_identifiers()
-
-    for language, template_map in bot_languages.items():
-
-        field_map = template_field_names[language]
-
-        site = pywikibot.Site(language, "wikipedia")
-        site.login()
-        bot_can_run = check_bot_killswitches(site)
-
-        for identifier in retracted_identifiers:
-            search_string = ""
-            time.sleep(5)  # 10s sleep between API calls.
-            original_id = identifier[0].decode("utf-8").strip()
-            original_pmid = identifier[1].decode("utf-8").strip()
-
-            logger.info("Starting processing %s - %s", original_id, original_pmid)
-            doi_valid = bool(re.match(DOI_REGEX, original_id))
-            pmid_valid = original_pmid != "0" and original_pmid != 0
-
-            if doi_valid and pmid_valid:
-                search_string = '"' + original_id + '" OR "' + original_pmid + '"'
-            elif doi_valid:
-                search_string = '"' + original_id + '"'
-            elif pmid_valid:
-                search_string = '"' + original_pmid + '"'
+    with run_report("retractionbot", bot_settings.get("metrics"), directory):
+        database = Database(bot_settings["db"])
+        with metrics.timer("index_load"):
+            index = load_index(database, bot_settings)
+            if isinstance(index, SnapshotIndex):
+                retracted_identifiers = index.retracted_identifiers()
             else:
-                continue
-
-            page_list = []
-            try:
-                page_list = pagegenerators.SearchPageGenerator(
-                    search_string, namespaces=[0], site=site
-                )
-            except Exception as e:
-                logger.error(e)
-                time.sleep(60 * 5)
-                continue
-
-            for wp_page in page_list:
-                page_text = ""
+                retracted_identifiers = database.load_retracted_identifiers()
+            # Build the prefilter's matcher before pages are analysed on
+            # threads.
+            index.matcher
+
+        shard_settings = bot_settings.get("shard", {})
+        jobs = jobs or shard_settings.get("jobs", 1)
+        shard = None
+        if jobs > 1:
+            bot_settings = share_budgets(bot_settings, jobs)
+            shard = Shard(
+                database,
+                worker_id,
+                partitions=shard_settings.get("partitions", DEFAULT_PARTITIONS),
+                lease_ttl=shard_settings.get("lease_ttl", LEASE_TTL),
+                heartbeat_interval=shard_settings.get(
+                    "heartbeat_interval", HEARTBEAT_INTERVAL
+                ),
+                sweep_hours=shard_settings.get("sweep_hours", SWEEP_HOURS),
+            )
+            logger.info("Running as %s, one of %d jobs", shard.worker_id, jobs)
+
+        languages = list(bot_settings["template_name_map"])
+        workers = bot_settings.get("fetch", {}).get("language_workers")
+        with shard or contextlib.nullcontext(), concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or len(languages), thread_name_prefix="language"
+        ) as pool:
+            futures = {
+                pool.submit(
+                    run_language,
+                    language,
+                    bot_settings,
+                    database,
+                    index,
+                    retracted_identifiers,
+                    candidate_files.get(language),
+                    shard,
+                ): language
+                for language in languages
+            }
+            summaries = []
+            for future in concurrent.futures.as_completed(futures):
                 try:
-                    page_text = wp_page.text
+                    summaries.append(future.result())
                 except Exception as e:
-                    logger.error(e)
-                    continue
-
-                changes = []
-
-                # Returns list of Tag objects with each cite.
-                wikitext = mwparserfromhell.parse(page_text)
-
-                logger.debug("Processing %s", wp_page)
-                page_cites = [
-                    x
-                    for x in wikitext.filter_tags()
-                    if x.tag.lower() == "ref" and re.findall(DOI_REGEX, str(x))
-                ]
-
-                num_cites_found = len(page_cites)
-
-                if num_cites_found == 0:
-                    logger.info(
-                        "Couldn't find any DOIs on page {page}.".format(page=wp_page)
-                    )
-                    continue
-                else:
-                    logger.info("Page %s has %d dois cited", wp_page, num_cites_found)
-
-                raw_templates = wikitext.filter_templates()
-
-                doi_field = field_map.get("doi", "doi")
-                pmid_field = field_map.get("pmid", "pmid")
-
-                for i, item in enumerate(raw_templates):
-                    new_code = None
-                    if i == len(raw_templates) - 1 or raw_templates[
-                        i + 1
-                    ].name.casefold().strip() not in (
-                        x.casefold() for x in template_map.values()
-                    ):
-                        if "cochrane" in str(item).lower():
-                            continue
-                        # Process new retractions
-                        if item.name.lower() in [doi_field.lower(), "doi-inline"]:
-                            logger.debug("Processing doi templates")
-                            if item.has("1", ignore_empty=True):
-                                record = database.retrieve_retracted_identifier(
-                                    item.get("1").value.strip()
-                                )
-                            # get list of retractions in record
-                            xitems = [x.retraction_nature for x in record]
-                            for r in record:
-                                if (
-                                    "retraction" in xitems
-                                    and r.retraction_nature == "retraction"
-                                ):
-                                    new_code = process_item(r, template_map, field_map)
-                                if (
-                                    "retracted" in xitems
-                                    and r.retraction_nature == "retraction"
-                                ):
-                                    new_code = process_item(r, template_map, field_map)
-                                if (
-                                    new_code is None
-                                    and "expression of concern" in xitems
-                                    and r.retraction_nature == "expression of concern"
-                                ):
-                                    new_code = process_item(r, template_map, field_map)
-                                elif new_code is None:
-                                    new_code = process_item(r, template_map, field_map)
-
-                                if new_code is not None:
-                                    changes.append(r.original_doi)
-                                    if not wikitext.contains(str(item) + str(new_code)):
-                                        wikitext.replace(
-                                            str(item), str(item) + str(new_code)
-                                        )
-
-                        if item.name.lower() == pmid_field.lower():
-                            logger.debug("Processing pmid templates")
-                            if item.has("1", ignore_empty=True):
-                                record = database.retrieve_retracted_identifier(
-                                    item.get("1").value.strip()
-                                )
-                            for r in record:
-                                new_code = process_item(r, template_map, field_map)
-                                if new_code is not None:
-                                    changes.append(r.original_pubmed)
-                                    wikitext.replace(
-                                        str(item), str(item) + str(new_code)
-                                    )
-
-                        if "cite" in item.name.lower():
-                            logger.debug("Processing cite templates")
-                            record = []
-                            if item.has(doi_field, ignore_empty=True):
-                                doi_value = item.get(doi_field).value.strip()
-                                logger.debug("DOI %s found", doi_value)
-                                record = database.retrieve_retracted_identifier(
-                                    doi_value
-                                )
-                            elif item.has(pmid_field, ignore_empty=True):
-                                pmid_value = item.get(pmid_field).value.strip()
-                                logger.debug("PMID %s found", pmid_value)
-                                record = database.retrieve_retracted_identifier(
-                                    pmid_value
-                                )
-
-                            for r in record:
-                                new_code = process_item(r, template_map, field_map)
-                                if (
-                                    new_code is not None
-                                    and r.original_doi not in changes
-                                ):
-                                    changes.append(r.original_doi)
-                                    wikitext.replace(
-                                        str(item), str(item) + str(new_code)
-                                    )
-                    else:
-                        # Check existing retraction
-                        if item.has(doi_field, ignore_empty=True):
-                            record = database.retrieve_retracted_identifier(
-                                item.get(doi_field).value.strip()
-                            )
-                        elif item.has(pmid_field, ignore_empty=True):
-                            record = database.retrieve_retracted_identifier(
-                                item.get(pmid_field).value.strip()
-                            )
-                        else:
-                            continue
-                        in_use = None
-
-                        logger.debug("Existing retracted item: %s", record)
-
-                        for r in record:
-                            if (
-                                r.retraction_nature is None
-                                or r.retraction_nature == "Reinstatement"
-                            ):
-                                wikitext.replace(str(raw_templates[i + 1]), "")
-                                continue
-                            if (
-                                r.retraction_nature is None
-                                or r.retraction_nature == "Retraction"
-                                and (
-                                    in_use is None
-                                    or in_use.retraction_nature != "Retraction"
-                                )
-                            ):
-                                in_use = r
-                            elif (
-                                r.retraction_nature is None
-                                or r.retraction_nature == "Expression of concern"
-                                and (
-                                    in_use is None
-                                    or in_use.retraction_nature != "Retraction"
-                                )
-                            ):
-                                in_use = r
-                            elif r.retraction_nature is None or in_use is None:
-                                in_use = r
-
-                        logger.debug("In Use item: %s", in_use)
-
-                        if in_use is not None:
-                            new_code = process_item(in_use, template_map, field_map)
-                            intentional_field = field_map.get(
-                                "intentional", "intentional"
-                            )
-                            if raw_templates[i + 1].has(
-                                intentional_field, ignore_empty=True
-                            ):
-                                new_code.add(
-                                    intentional_field,
-                                    raw_templates[i + 1]
-                                    .get(intentional_field)
-                                    .value.strip(),
-                                )
-                            if raw_templates[i + 1].has(
-                                "pmcid", ignore_empty=True
-                            ):
-                                new_code.add(
-                                    "pmcid",
-                                    raw_templates[i + 1]
-                                    .get("pmcid")
-                                    .value.strip(),
-                                )
-                            if raw_templates[i + 1].has("checked", ignore_empty=True):
-                                new_code.add(
-                                    "checked",
-                                    raw_templates[i + 1].get("checked").value.strip(),
-                                )
-                            if raw_templates[i + 1].has(
-                                "doi-access", ignore_empty=True
-                            ):
-                                new_code.add(
-                                    "doi-access",
-                                    raw_templates[i + 1]
-                                    .get("doi-access")
-                                    .value.strip(),
-                                )
-                            if (
-                                new_code is not None
-                                and raw_templates[i + 1] != new_code
-                            ):
-                                wikitext.replace(raw_templates[i + 1], str(new_code))
-
-                page_text = str(wikitext)
-
-                # Only bother trying to make an edit if we changed anything
-                if page_text != wp_page.text and bot_can_run:
-                    wp_page.text = page_text
-                    wp_page.save(bot_settings["summary_map"][language], minor=False)
-
-                    logger.info(
-                        "Successfully edited {page_name} with "
-                        "retracted source(s).".format(page_name=wp_page.title())
-                    )
-                    for x in changes:
-                        database.log_retraction_edit(
-                            datetime.datetime.now(),
-                            language + ".wikipedia.org",
-                            wp_page,
-                            x,
-                            0,
-                        )
-
-
-def process_item(record, template_map, field_map):
-    new_code = ""
-    if record.retraction_nature == "Retraction":
-        logger.info(
-            "Generating Retraction template needed for DOI %s", record.original_doi
-        )
-        new_code = mwparserfromhell.nodes.template.Template(
-            name=template_map.get("retracted", "Retracted")
+                    logger.exception("Run on %s failed", futures[future], exc_info=e)
+                    metrics.count("language_failures", language=futures[future])
+
+        for summary in sorted(summaries, key=lambda x: x["language"]):
+            logger.info(
+                "%(language)s: checked %(pages_checked)d pages, skipped "
+                "%(pages_unchanged)d unchanged, edited %(pages_edited)d and "
+                "flagged %(citations_flagged)d citations in %(seconds).0fs",
+                summary,
+            )
+        return summaries
+
+
+def search_rounds(
+    site, domain, database, retracted_identifiers, settings, limiter, shard=None
+):
+    """
+    Yields (citing pages, terms) for each round of identifiers on a wiki,
+    new identifiers first, or, given a shard, for the identifiers in each
+    partition it leases. Only identifiers never searched for, and those
+    whose cached results have expired, are searched; the pages citing the
+    rest are taken from the search cache. The caller records the terms as
+    searched once it has processed the round's pages, so an interrupted
+    run resumes from there.
+    """
+    progress = database.load_search_progress(domain)
+    terms = prioritise_terms(search_terms(retracted_identifiers), progress)
+    cache = SearchCache(
+        database,
+        domain,
+        settings.get("search_ttl_days", DEFAULT_TTL_DAYS),
+        settings.get("search_ttl_jitter", TTL_JITTER),
+    )
+    # The budget limits refreshes of expired results; new identifiers are
+    # always searched.
+    to_search = cache.plan(terms, settings.get("budget"))
+    logger.info(
+        "Searching %s for %d of %d identifiers, %d never searched",
+        domain,
+        len(to_search),
+        len(terms),
+        len([x for x in terms if x not in cache]),
+    )
+
+    for partition_terms in partitioned(shard, domain, terms):
+        for round_terms in rounds(
+            partition_terms, settings.get("round_size", ROUND_SIZE)
+        ):
+            # Search for the whole round before touching any page, so that
+            # a page citing several retracted works is only fetched, parsed
+            # and saved once.
+            found = cache.cached_pages(
+                site, [x for x in round_terms if x not in to_search], limiter
+            )
+            searched = cache.search(
+                site, [x for x in round_terms if x in to_search], limiter
+            )
+            for page, page_terms in searched.items():
+                found.setdefault(page, set()).update(page_terms)
+            yield found, round_terms
+            cache.save(found)
+
+
+def run_language(
+    language,
+    bot_settings,
+    database,
+    index,
+    retracted_identifiers,
+    candidate_file=None,
+    shard=None,
+):
+    """
+    Runs the bot on one language's Wikipedia, returning a summary of what
+    it did. Given a shard, only the partitions of the work it leases are
+    processed.
+    """
+    start = time.monotonic()
+    summary = {
+        "language": language,
+        "can_run": False,
+        "pages_checked": 0,
+        "pages_unchanged": 0,
+        "pages_edited": 0,
+        "citations_flagged": 0,
+    }
+    template_map = bot_settings["template_name_map"][language]
+    field_map = bot_settings["template_field_names"][language]
+    fetch_settings = bot_settings.get("fetch", {})
+    domain = language + ".wikipedia.org"
+
+    site = pywikibot.Site(language, "wikipedia")
+    site.login()
+    bot_can_run = check_bot_killswitches(site)
+    summary["can_run"] = bot_can_run
+    # Searches and page fetches share one adaptive rate limit per site.
+    limiter = site_limiter(site, **bot_settings.get("rate_limit", {}))
+
+    if candidate_file:
+        # Pages found offline by find_citing_pages replace the searches.
+        candidates = read_candidates(candidate_file)
+        page_rounds = (
+            ({pywikibot.Page(site, x): candidates[x] for x in titles}, None)
+            for titles in partitioned(shard, domain, list(candidates))
         )
-    elif record.retraction_nature == "Expression of concern":
-        logger.info("Generating EoC template needed for DOI %s", record.original_doi)
-        new_code = mwparserfromhell.nodes.template.Template(
-            name=template_map.get("expression of concern", "Expression of Concern")
+    else:
+        page_rounds = search_rounds(
+            site,
+            domain,
+            database,
+            retracted_identifiers,
+            bot_settings.get("schedule", {}),
+            limiter,
+            shard,
         )
-    elif record.retraction_nature == "Correction":
-        logger.info(
-            "Generating Erratum template needed for DOI %s", record.original_doi
+
+    decisions = load_decisions(database, language, template_map, field_map, index)
+    if decisions is None:
+        logger.warning(
+            "No template decisions for %s match the dataset, rendering "
+            "templates as pages are processed",
+            language,
         )
-        new_code = mwparserfromhell.nodes.template.Template(
-            name=template_map.get("erratum", "Erratum")
+    engine = RewriteEngine(template_map, field_map, decisions)
+
+    def analyse(page_text):
+        return process_page(page_text, index, engine)
+
+    page_states = None
+    if fetch_settings.get("skip_unchanged", True):
+        page_states = PageStateCache(database, domain, index)
+
+    # Analysis only queues edits; they are saved by the queue's writer
+    # thread at the permitted edit rate. Edits left queued by an earlier
+    # run are saved first, unless the killswitch is off.
+    edits = None
+    if bot_can_run:
+        edit_settings = bot_settings.get("edits", {})
+        edits = EditQueue(
+            database,
+            site,
+            domain,
+            bot_settings["summary_map"][language],
+            analyse,
+            page_states,
+            rate=edit_settings.get("rate", DEFAULT_EDIT_RATE),
+            log_batch_size=edit_settings.get("log_batch_size", LOG_BATCH_SIZE),
+            can_run=killswitch_check(site),
+            shard=shard,
         )
+        edits.start()
+
+    # Every retraction on a page is handled when it is first processed, so
+    # pages found again in a later round are skipped. Pages skipped as
+    # unchanged aren't, as a later round may find them by an identifier
+    # which has changed.
+    processed = set()
+    try:
+        for found, round_terms in page_rounds:
+            citing_pages = [x for x in found if x not in processed]
+            if page_states is not None:
+                load_revision_info(site, citing_pages, limiter)
+                unchanged = {
+                    x for x in citing_pages if page_states.is_current(x, found[x])
+                }
+                citing_pages = [x for x in citing_pages if x not in unchanged]
+                summary["pages_unchanged"] += len(unchanged)
+                metrics.count("pages_unchanged", len(unchanged), language=language)
+            processed.update(citing_pages)
+            logger.info("%d pages to check on %s", len(citing_pages), language)
+
+            for wp_page, (page_text, changes) in analyse_pages(
+                site,
+                citing_pages,
+                analyse,
+                workers=fetch_settings.get("workers", ANALYSIS_WORKERS),
+                groupsize=fetch_settings.get("group_size", PRELOAD_GROUP_SIZE),
+                limiter=limiter,
+            ):
+                logger.debug("Processed %s", wp_page)
+                summary["pages_checked"] += 1
+                # Searches only say which of their terms a page might cite.
+                found[wp_page] = cited_terms(found[wp_page], wp_page.text)
+
+                # Only bother trying to make an edit if we changed anything.
+                # Pages are recorded as checked by the queue once saved; a
+                # page left unedited by the killswitch still needs its edit.
+                if page_text != wp_page.text:
+                    if edits is not None:
+                        edits.put(wp_page, page_text, changes)
+                elif page_states is not None:
+                    page_states.checked(wp_page)
+
+            if page_states is not None:
+                page_states.save()
+            if round_terms:
+                database.record_search_progress(domain, round_terms)
+    finally:
+        if edits is not None:
+            edits.close()
+            summary["pages_edited"] = edits.edited
+            summary["citations_flagged"] = edits.flagged
+        if page_states is not None:
+            page_states.save()
+
+    summary["seconds"] = time.monotonic() - start
+    metrics.observe("language_run", summary["seconds"], language=language)
+    return summary
+
+
+def prefilter(page_text, index):
+    """
+    Scans the raw text of a page for identifiers in the retraction index,
+    returning (start, end, id_type, canonical value) for each hit in text
+    order. Far cheaper than parsing, and a page with no hits needs no
+    changes.
+    """
+    return index.matcher.find(page_text)
+
+
+def process_page(page_text, index, engine, hits=None):
+    """
+    Flags every citation on a page to a work in the retraction index, and
+    updates or removes existing flags, using the RewriteEngine for the
+    page's language. Returns the new page text and the list of identifiers
+    whose citations were flagged. hits are the page's prefilter results,
+    which are computed if not given; only the identifiers they found are
+    resolved.
+    """
+    changes = []
+
+    metrics.count("pages_analysed")
+    if hits is None:
+        with metrics.timer("prefilter"):
+            hits = prefilter(page_text, index)
+    if not hits:
+        logger.info("No retracted identifiers found on page.")
+        metrics.count("pages_prefiltered")
+        return page_text, changes
+
+    # Returns list of Tag objects with each cite.
+    with metrics.timer("parse"):
+        wikitext = mwparserfromhell.parse(page_text)
+
+    page_cites = [
+        x
+        for x in wikitext.filter_tags()
+        if x.tag.lower() == "ref" and re.findall(DOI_REGEX, str(x))
+    ]
+
+    num_cites_found = len(page_cites)
+
+    if num_cites_found == 0:
+        logger.info("Couldn't find any DOIs on page.")
+        return page_text, changes
     else:
-        logger.debug("No change needed for doi %s", record.original_doi)
-        return None
+        logger.info("Page has %d dois cited", num_cites_found)
 
-    if record.retraction_doi != "0" and record.retraction_doi != "unavaliable":
-        new_code.add(field_map.get("doi", "doi"), record.retraction_doi)
-    if record.retraction_pubmed != "0":
-        new_code.add(field_map.get("pmid", "pmid"), record.retraction_pubmed)
-    if record.url != "":
-        for idx, x in enumerate(record.url.split(";")):
-            if x != "":
-                new_code.add(str(idx + 1), x + " ''Retraction Watch''")
-    return new_code
+    with metrics.timer("rewrite"):
+        changes = engine.rewrite(wikitext, index.retrieve_retracted_identifier, hits)
+        page_text = str(wikitext)
+    return page_text, changes
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--candidates",
+        action="append",
+        default=[],
+        metavar="LANG:FILE",
+        help="use a candidate page list from find_citing_pages for a wiki",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="run as one of this many sharded jobs, overriding shard.jobs",
+    )
+    parser.add_argument(
+        "--worker-id",
+        help="name of this job in a sharded run; defaults to host and PID",
+    )
+    args = parser.parse_args()
+
     logger.info("Starting bot run at {dt}".format(dt=datetime.datetime.now()))
-    run_bot()
+    run_bot(
+        dict(x.split(":", 1) for x in args.candidates),
+        jobs=args.jobs,
+        worker_id=args.worker_id,
+    )
@@ -0,0 +1,115 @@
+import functools
+import logging
+import sys
+
+from .db import Retraction
+from .identifiers import classify_identifier, record_identifiers
+from .matcher import IdentifierMatcher
+
+logger = logging.getLogger(__name__)
+
+
+class RetractionIndex:
+    """
+    In-memory index of the retractions table keyed by canonical DOI and
+    PMID, loaded once so that processing pages needs no DB round trips.
+    retrieve_retracted_identifier matches the Database method of the same
+    name and can be used in its place.
+    """
+
+    def __init__(self, rows=(), versions=None):
+        self._records = {}
+        self.count = 0
+        for row in rows:
+            self.add(Retraction(*row))
+        # When the records for each identifier last changed, and the latest
+        # of those: the version of the dataset the index holds.
+        self.versions = versions or {}
+        self.dataset_version = max(self.versions.values(), default=None)
+
+    @classmethod
+    def from_database(cls, database):
+        index = cls(database.load_retractions(), database.load_identifier_versions())
+        logger.info(
+            "Loaded %d retractions under %d identifiers, ~%.1f MiB",
+            index.count,
+            len(index),
+            index.approximate_size() / 2**20,
+        )
+        return index
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, id):
+        identifier = classify_identifier(id)
+        return identifier is not None and identifier in self._records
+
+    def add(self, retraction):
+        for id_type, id_value in record_identifiers(
+            retraction.original_doi, retraction.original_pubmed
+        ):
+            key = (id_type, sys.intern(id_value))
+            # Nearly every identifier has a single record, so store tuples
+            # rather than lists to keep the per-key overhead small.
+            self._records[key] = self._records.get(key, ()) + (retraction,)
+        self.count += 1
+
+    def items(self):
+        """Returns ((id_type, canonical value), records) for every identifier."""
+        return self._records.items()
+
+    def retrieve_retracted_identifier(self, id):
+        identifier = classify_identifier(id)
+        if identifier is None:
+            return []
+        return list(self._records.get(identifier, ()))
+
+    def changed_since(self, identifiers, version):
+        """
+        Returns True if the records for any of identifiers were added or
+        changed after the given dataset version.
+        """
+        if version is None:
+            return True
+        for id in identifiers:
+            changed = self.versions.get(classify_identifier(id))
+            if changed is not None and changed > version:
+                return True
+        return False
+
+    @functools.cached_property
+    def matcher(self):
+        """
+        IdentifierMatcher for every identifier in the index, built on first
+        use. Build it before sharing the index between threads.
+        """
+        return IdentifierMatcher.from_index(self)
+
+    def identifiers(self, id_type=None):
+        """Yields the canonical values indexed, optionally of one type."""
+        for key_type, id_value in self._records:
+            if id_type is None or key_type == id_type:
+                yield id_value
+
+    def approximate_size(self):
+        """
+        Rough number of bytes held by the index: the dict, its keys and
+        every distinct record and string it references.
+        """
+        seen = set()
+        size = sys.getsizeof(self._records)
+
+        def sizeof(obj):
+            if id(obj) in seen:
+                return 0
+            seen.add(id(obj))
+            return sys.getsizeof(obj)
+
+        for key, records in self._records.items():
+            size += sizeof(key) + sizeof(key[1]) + sizeof(records)
+            for record in records:
+                size += sizeof(record)
+                for slot in Retraction.__slots__:
+                    size += sizeof(getattr(record, slot))
+        return size
@@ -0,0 +1,412 @@
+import hashlib
+import json
+import logging
+
+import mwparserfromhell
+from mwparserfromhell.nodes import Template, Text
+
+from .identifiers import classify_identifier
+
+logger = logging.getLogger(__name__)
+
+# Natures which get a flag, in order of precedence.
+FLAGGED_NATURES = ("Retraction", "Expression of concern", "Correction")
+
+# Sources of records, in order of precedence between records of the same
+# nature. Retraction Watch records have the notice's DOI and links to the
+# Retraction Watch database, which PubMed's often lack.
+ORIGINS = ("Crossref", "NCBI")
+
+# Parameters editors may have set on an existing flag, which are kept when
+# it is updated. The intentional parameter's name is localised.
+KEPT_PARAMETERS = ("pmcid", "checked", "doi-access")
+
+
+def process_item(record, template_map, field_map):
+    new_code = ""
+    if record.retraction_nature == "Retraction":
+        logger.debug(
+            "Generating Retraction template needed for DOI %s", record.original_doi
+        )
+        new_code = mwparserfromhell.nodes.template.Template(
+            name=template_map.get("retracted", "Retracted")
+        )
+    elif record.retraction_nature == "Expression of concern":
+        logger.debug("Generating EoC template needed for DOI %s", record.original_doi)
+        new_code = mwparserfromhell.nodes.template.Template(
+            name=template_map.get("expression of concern", "Expression of Concern")
+        )
+    elif record.retraction_nature == "Correction":
+        logger.debug(
+            "Generating Erratum template needed for DOI %s", record.original_doi
+        )
+        new_code = mwparserfromhell.nodes.template.Template(
+            name=template_map.get("erratum", "Erratum")
+        )
+    else:
+        logger.debug("No change needed for doi %s", record.original_doi)
+        return None
+
+    if record.retraction_doi != "0" and record.retraction_doi != "unavaliable":
+        new_code.add(field_map.get("doi", "doi"), record.retraction_doi)
+    if record.retraction_pubmed != "0":
+        new_code.add(field_map.get("pmid", "pmid"), record.retraction_pubmed)
+    if record.url != "":
+        for idx, x in enumerate(record.url.split(";")):
+            if x != "":
+                new_code.add(str(idx + 1), x + " ''Retraction Watch''")
+    return new_code
+
+
+def is_reinstated(records):
+    return any(r.retraction_nature == "Reinstatement" for r in records)
+
+
+def select_record(records):
+    """
+    Picks the record a citation should be flagged with: a retraction over
+    an expression of concern over a correction, and of those, one from
+    the first of ORIGINS. Returns None if none of the records warrant a
+    flag.
+    """
+
+    def precedence(record):
+        return (
+            FLAGGED_NATURES.index(record.retraction_nature),
+            ORIGINS.index(record.origin) if record.origin in ORIGINS else len(ORIGINS),
+        )
+
+    in_use = None
+    for r in records:
+        if r.retraction_nature not in FLAGGED_NATURES:
+            continue
+        if in_use is None or precedence(r) < precedence(in_use):
+            in_use = r
+    return in_use
+
+
+class Decision:
+    """
+    How citations of one identifier are flagged in one language: with the
+    rendered flag template, or, if template is None, by removing any flag
+    because the work was reinstated. original_doi and original_pubmed are
+    those of the record the flag was rendered from.
+    """
+
+    __slots__ = ("template", "original_doi", "original_pubmed")
+
+    def __init__(self, template, original_doi="", original_pubmed=""):
+        self.template = template
+        self.original_doi = original_doi
+        self.original_pubmed = original_pubmed
+
+    def __repr__(self):
+        return "Decision(%r)" % self.template
+
+
+def decide(records, template_map, field_map):
+    """
+    Resolves the records for an identifier into a Decision, or None if
+    its citations are left alone.
+    """
+    if is_reinstated(records):
+        return Decision(None)
+    in_use = select_record(records)
+    if in_use is None:
+        return None
+    return Decision(
+        str(process_item(in_use, template_map, field_map)),
+        in_use.original_doi,
+        in_use.original_pubmed,
+    )
+
+
+def build_decisions(index, template_map, field_map):
+    """
+    Returns a dict of (id_type, canonical value) to Decision for every
+    identifier in a RetractionIndex whose citations get flagged or have
+    flags removed.
+    """
+    decisions = {}
+    for key, records in index.items():
+        decision = decide(records, template_map, field_map)
+        if decision is not None:
+            decisions[key] = decision
+    return decisions
+
+
+def build_hash(template_map, field_map, index):
+    """
+    Fingerprint of one language's template settings and the version of
+    the dataset in index, which decisions built from them are stored
+    against, so decisions left behind by either changing aren't used.
+    """
+    return hashlib.sha1(
+        json.dumps(
+            [template_map, field_map, index.dataset_version, index.count, len(index)],
+            sort_keys=True,
+            default=str,
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+def save_decisions(database, language, template_map, field_map, index):
+    """
+    Builds the decisions for a language from index and stores them,
+    unless those stored were already built from the same settings and
+    dataset. Returns the number of decisions built, or None if they
+    were up to date.
+    """
+    key = build_hash(template_map, field_map, index)
+    if database.has_template_decisions(language, key):
+        return None
+    decisions = build_decisions(index, template_map, field_map)
+    database.save_template_decisions(
+        language,
+        key,
+        [
+            (id_type, id_value, x.template, x.original_doi, x.original_pubmed)
+            for (id_type, id_value), x in decisions.items()
+        ],
+    )
+    return len(decisions)
+
+
+def load_decisions(database, language, template_map, field_map, index):
+    """
+    Returns the stored decisions for a language, for use by RewriteEngine,
+    or None if there are none built from its current settings and the
+    dataset in index.
+    """
+    rows = database.load_template_decisions(
+        language, build_hash(template_map, field_map, index)
+    )
+    if rows is None:
+        return None
+    return {key: Decision(*value) for key, value in rows.items()}
+
+
+def _walk_templates(wikicode):
+    """
+    Yields (parent, index, template) for every template in wikicode,
+    nested ones included, in the same order as filter_templates.
+    """
+    for i, node in enumerate(wikicode.nodes):
+        if isinstance(node, Template):
+            yield wikicode, i, node
+        for child in node.__children__():
+            yield from _walk_templates(child)
+
+
+def _param(template, name):
+    if template.has(name, ignore_empty=True):
+        return template.get(name).value.strip()
+    return None
+
+
+class RewriteEngine:
+    """
+    Adds, updates and removes retraction flags on a page for one language.
+
+    A citation template is flagged by inserting {{Retracted}}, {{Expression
+    of Concern}} or {{Erratum}} directly after it, and a citation already
+    followed by one of those has it brought up to date, or removed if the
+    work was reinstated. Edits are collected against positions in the
+    parse tree during a single walk of it and then applied together, so
+    the cost of a page is linear in its number of templates. Template and
+    field names for the language are worked out once, when the engine is
+    created.
+
+    decisions, from build_decisions, maps each identifier to the flag its
+    citations get, precomputed when the dataset was ingested, so a
+    citation costs a lookup and a splice of the rendered template. Without
+    them, each citation's records are resolved and its flag rendered on
+    the spot.
+    """
+
+    def __init__(self, template_map, field_map, decisions=None):
+        self.template_map = template_map
+        self.field_map = field_map
+        self.decisions = decisions
+        self.flag_names = {x.casefold() for x in template_map.values()}
+        self.doi_field = field_map.get("doi", "doi")
+        self.pmid_field = field_map.get("pmid", "pmid")
+        self.doi_names = {self.doi_field.lower(), "doi-inline"}
+        self.pmid_name = self.pmid_field.lower()
+        self.intentional_field = field_map.get("intentional", "intentional")
+
+    def is_flag(self, template):
+        return template.name.strip().casefold() in self.flag_names
+
+    def citation_identifiers(self, template):
+        """
+        Returns the identifiers a template cites, DOI before PMID, each
+        with whether it is a PMID. A template which isn't a citation cites
+        none.
+        """
+        name = template.name.strip().lower()
+        if name in self.doi_names:
+            candidates = [(_param(template, "1"), False)]
+        elif name == self.pmid_name:
+            candidates = [(_param(template, "1"), True)]
+        elif "cite" in name:
+            candidates = [
+                (_param(template, self.doi_field), False),
+                (_param(template, self.pmid_field), True),
+            ]
+        else:
+            candidates = []
+        return [x for x in candidates if x[0]]
+
+    def flag_identifiers(self, template):
+        """The identifiers cited by a template followed by an existing flag."""
+        candidates = [
+            (_param(template, self.doi_field), False),
+            (_param(template, self.pmid_field), True),
+        ]
+        return [x for x in candidates if x[0]]
+
+    def following_flag(self, parent, index):
+        """
+        Returns (parent, index, flag) for the flag directly after the node
+        at index in parent, whitespace aside, or None if it isn't followed
+        by one. Templates nested in the node don't count.
+        """
+        for i in range(index + 1, len(parent.nodes)):
+            node = parent.nodes[i]
+            if isinstance(node, Text) and not node.value.strip():
+                continue
+            if isinstance(node, Template) and self.is_flag(node):
+                return parent, i, node
+            return None
+        return None
+
+    def render(self, record):
+        return process_item(record, self.template_map, self.field_map)
+
+    def decision(self, identifier, lookup, keys=None):
+        """
+        Returns the Decision for citations of identifier, or None if they
+        are left alone. lookup finds the identifier's records when there
+        are no precomputed decisions. Given keys, the set of (id_type,
+        canonical value) found on the page, identifiers not among them
+        are left alone without being resolved.
+        """
+        key = classify_identifier(identifier)
+        if key is None or (keys is not None and key not in keys):
+            return None
+        if self.decisions is None:
+            return decide(lookup(identifier), self.template_map, self.field_map)
+        return self.decisions.get(key)
+
+    def first_decision(self, candidates, lookup, keys=None):
+        """
+        Returns the Decision for the first of candidates, as returned by
+        citation_identifiers, which has one, and the identifier it was
+        made for, logged as the record's own DOI or PMID where it has
+        one. A citation whose DOI isn't in the dataset may still be
+        flagged by its PMID. Returns (None, None) if none has a decision.
+        """
+        for identifier, is_pmid in candidates:
+            decision = self.decision(identifier, lookup, keys)
+            if decision is not None:
+                if is_pmid:
+                    return decision, decision.original_pubmed or identifier
+                return decision, decision.original_doi or identifier
+        return None, None
+
+    def updated_flag(self, decision, existing):
+        """
+        Returns the text of the flag for decision, keeping any parameters
+        editors set on the existing flag.
+        """
+        kept = [
+            (name, _param(existing, name))
+            for name in (self.intentional_field,) + KEPT_PARAMETERS
+        ]
+        kept = [x for x in kept if x[1]]
+        if not kept:
+            return decision.template
+        new_code = mwparserfromhell.parse(decision.template).filter_templates()[0]
+        for name, value in kept:
+            new_code.add(name, value)
+        return str(new_code)
+
+    def plan(self, wikitext, lookup, hits=None):
+        """
+        Walks the parse tree and returns (edits, changes). edits is a list
+        of (parent, index, order, node) where node replaces the one at index
+        in parent if order is 0 (or removes it if node is None), and is
+        inserted at index if order is 1. changes lists the identifiers of
+        newly flagged citations. Given the page's prefilter hits, only
+        citations of the identifiers they found are resolved.
+        """
+        keys = None if hits is None else {(x[2], x[3]) for x in hits}
+        edits = []
+        changes = []
+
+        for parent, index, item in _walk_templates(wikitext):
+            following = self.following_flag(parent, index)
+
+            if following is not None:
+                # Check existing retraction
+                decision, _ = self.first_decision(
+                    self.flag_identifiers(item), lookup, keys
+                )
+                flag_parent, flag_index, flag = following
+                logger.debug("Existing retracted item: %s", decision)
+                if decision is None:
+                    continue
+                if decision.template is None:
+                    edits.append((flag_parent, flag_index, 0, None))
+                    continue
+                new_code = self.updated_flag(decision, flag)
+                if new_code != str(flag):
+                    edits.append((flag_parent, flag_index, 0, Text(new_code)))
+                continue
+
+            # Process new retractions
+            candidates = self.citation_identifiers(item)
+            if not candidates or "cochrane" in str(item).lower():
+                continue
+            decision, identifier = self.first_decision(candidates, lookup, keys)
+            if decision is None or decision.template is None:
+                continue
+            # The rendered flag is spliced in as text; only the page's text
+            # is used once the edits are applied.
+            edits.append((parent, index + 1, 1, Text(decision.template)))
+            changes.append(identifier)
+
+        return edits, changes
+
+    def apply(self, edits):
+        """
+        Applies planned edits, highest index first within each parent so
+        that earlier positions stay valid, and removals and replacements
+        before insertions at the same position.
+        """
+        by_parent = {}
+        for parent, index, order, node in edits:
+            by_parent.setdefault(id(parent), (parent, []))[1].append(
+                (index, order, node)
+            )
+        for parent, parent_edits in by_parent.values():
+            parent_edits.sort(key=lambda x: (-x[0], x[1]))
+            for index, order, node in parent_edits:
+                if order == 1:
+                    parent.nodes.insert(index, node)
+                elif node is None:
+                    del parent.nodes[index]
+                else:
+                    parent.nodes[index] = node
+
+    def rewrite(self, wikitext, lookup, hits=None):
+        """
+        Flags the citations in parsed wikitext in place, using lookup to
+        find the retraction records for an identifier, and only resolving
+        the identifiers among the prefilter's hits if given. Returns the
+        list of identifiers whose citations were newly flagged.
+        """
+        edits, changes = self.plan(wikitext, lookup, hits)
+        self.apply(edits)
+        return list(dict.fromkeys(changes))
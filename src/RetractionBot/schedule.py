@@ -0,0 +1,21 @@
+# Identifiers searched per round. Each round's pages are processed, and its
+# progress saved, before the next round starts, so at most one round of
+# searching is repeated after a crash.
+ROUND_SIZE = 2000
+
+
+def prioritise_terms(terms, progress):
+    """
+    Orders search terms so that a run spends its budget on new work first.
+    Terms never searched come first, keeping their given order (newest
+    retractions first), followed by the rest, least recently searched
+    first. progress maps terms to when they were last searched.
+    """
+    new = [x for x in terms if x not in progress]
+    searched = sorted((x for x in terms if x in progress), key=progress.get)
+    return new + searched
+
+
+def rounds(terms, size=ROUND_SIZE):
+    """Splits terms into lists of up to size terms."""
+    return [terms[i : i + size] for i in range(0, len(terms), size)]
@@ -0,0 +1,168 @@
+import logging
+import re
+
+from pywikibot import pagegenerators
+
+from .identifiers import DOI_REGEX, classify_identifier
+from .matcher import IdentifierMatcher
+from .metrics import metrics
+from .throttle import site_limiter
+
+logger = logging.getLogger(__name__)
+
+# CirrusSearch rejects full text queries longer than this many characters.
+MAX_QUERY_LENGTH = 300
+
+# A batch returning this many pages may have had its results truncated, so
+# it is split and each half searched again.
+RESULT_CAP = 500
+
+
+def search_terms(retracted_identifiers):
+    """
+    Given (doi, pmid) rows from load_retracted_identifiers, returns the
+    distinct DOIs and PMIDs worth searching for, in row order.
+    """
+    terms = {}
+    for identifier in retracted_identifiers:
+        original_id = identifier[0].decode("utf-8").strip()
+        original_pmid = identifier[1].decode("utf-8").strip()
+
+        # Quotes can't be escaped inside an insource phrase.
+        if re.match(DOI_REGEX, original_id) and '"' not in original_id:
+            terms[original_id] = None
+        if original_pmid.isdigit() and int(original_pmid) != 0:
+            terms[original_pmid] = None
+    return list(terms)
+
+
+def build_query(terms):
+    return " OR ".join('insource:"{}"'.format(x) for x in terms)
+
+
+def plan_batches(terms, max_length=MAX_QUERY_LENGTH):
+    """
+    Greedily packs search terms, in order, into batches whose combined
+    query fits within max_length. A term too long to share a query is
+    given a batch of its own.
+    """
+    batches = []
+    batch = []
+    for term in terms:
+        if batch and len(build_query(batch + [term])) > max_length:
+            batches.append(batch)
+            batch = []
+        batch.append(term)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def cited_terms(terms, text):
+    """
+    Returns the set of terms cited in text. If none of them can be found,
+    as when the page cites one through a template, all of terms are
+    returned, since the search which found the page still matched one.
+    """
+    by_key = {}
+    for term in terms:
+        identifier = classify_identifier(term)
+        if identifier is not None:
+            by_key.setdefault(identifier, set()).add(term)
+    matcher = IdentifierMatcher.from_sets(
+        {x[1] for x in by_key if x[0] == "doi"},
+        {x[1] for x in by_key if x[0] == "pmid"},
+    )
+
+    cited = set()
+    for _, _, id_type, id_value in matcher.finditer(text):
+        cited.update(by_key[id_type, id_value])
+    return cited or set(terms)
+
+
+def search_pages(
+    site, terms, max_length=MAX_QUERY_LENGTH, result_cap=RESULT_CAP, limiter=None
+):
+    """
+    Searches the main namespace of site for pages citing any of terms,
+    many terms per query. Yields (batch, pages) for each query made, where
+    batch is the list of terms searched for and pages the list of pages
+    found, without their text. Batches whose results reach result_cap are
+    split in two and searched again, until each half fits or holds a
+    single term. Queries are paced by limiter, the site's shared
+    RateLimiter by default.
+    """
+    limiter = limiter or site_limiter(site)
+    pending = list(reversed(plan_batches(terms, max_length)))
+    while pending:
+        batch = pending.pop()
+        logger.info("Searching for %d identifiers: %s", len(batch), batch)
+
+        def search():
+            with metrics.timer("search", language=site.code):
+                return list(
+                    pagegenerators.SearchPageGenerator(
+                        build_query(batch),
+                        total=result_cap,
+                        namespaces=[0],
+                        site=site,
+                    )
+                )
+
+        try:
+            pages = limiter.call(search)
+        except Exception as e:
+            logger.error("Search for %s failed: %r", batch, e)
+            metrics.count("search_failures", language=site.code)
+            continue
+
+        if len(pages) >= result_cap:
+            if len(batch) > 1:
+                logger.info("Splitting batch of %d identifiers", len(batch))
+                metrics.count("search_splits", language=site.code)
+                pending.append(batch[len(batch) // 2 :])
+                pending.append(batch[: len(batch) // 2])
+                continue
+            logger.warning("Results for %s truncated at %d", batch[0], result_cap)
+
+        yield batch, pages
+
+
+def search_citing_pages(site, terms, **kwargs):
+    """
+    Runs every search for terms and returns a dict mapping each page found
+    to the set of terms searched for by the queries which found it, so
+    that each page can be processed once however many of the retracted
+    works it cites. Once a page's text is loaded, cited_terms narrows its
+    set down to the terms it actually cites.
+    """
+    pages = {}
+    for batch, found in search_pages(site, terms, **kwargs):
+        logger.info("%d pages cite one of %s", len(found), batch)
+        for page in found:
+            pages.setdefault(page, set()).update(batch)
+    return pages
+
+
+def write_candidates(path, results):
+    """
+    Writes scan results as a candidate page list, one page per line: the
+    title, a tab, then the space separated identifiers it cites.
+    """
+    count = 0
+    with open(path, "w", encoding="utf-8") as candidates:
+        for title, identifiers in results:
+            candidates.write(title + "\t" + " ".join(sorted(identifiers)) + "\n")
+            count += 1
+    return count
+
+
+def read_candidates(path):
+    """Reads a candidate page list into a dict of title to identifiers."""
+    candidates = {}
+    with open(path, encoding="utf-8") as candidate_file:
+        for line in candidate_file:
+            title, _, identifiers = line.rstrip("\n").partition("\t")
+            if title:
+                candidates[title] = set(identifiers.split())
+    return candidates
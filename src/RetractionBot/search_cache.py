@@ -0,0 +1,137 @@
+"""
+Cache of the pages on a wiki found by searching for each retracted
+identifier, so that a run only searches for identifiers it hasn't seen
+before and those whose cached results have expired.
+
+Each entry is given a TTL drawn at random from around the configured one,
+so entries written together, as on the first run, expire spread out over
+a range of days rather than all on the same run.
+"""
+
+import datetime
+import logging
+import random
+
+from .metrics import metrics
+from .search import search_pages
+
+logger = logging.getLogger(__name__)
+
+# Days a term's search results are reused for, on average.
+DEFAULT_TTL_DAYS = 30
+
+# Each entry's TTL is the default varied by up to this fraction either way.
+TTL_JITTER = 0.5
+
+
+class SearchCache:
+    """
+    The page IDs found by the last search for each term on one wiki, when
+    they were fetched, and how long they are good for.
+    """
+
+    def __init__(self, database, domain, ttl_days=DEFAULT_TTL_DAYS, jitter=TTL_JITTER):
+        self._database = database
+        self.domain = domain
+        self.ttl = datetime.timedelta(days=ttl_days).total_seconds()
+        self.jitter = jitter
+        self._entries = database.load_search_cache(domain)
+        # Terms searched for but not yet saved, and when.
+        self._searched = {}
+
+    def __contains__(self, term):
+        return term in self._entries
+
+    def expires(self, term):
+        page_ids, fetched, ttl = self._entries[term]
+        return fetched + datetime.timedelta(seconds=ttl)
+
+    def plan(self, terms, budget=None, now=None):
+        """
+        Returns the set of terms to search for on this run: every term
+        never searched, and the expired ones, longest expired first, up to
+        budget if given. The rest are served from the cache.
+        """
+        now = now or datetime.datetime.now()
+        new = {x for x in terms if x not in self._entries}
+        expired = sorted(
+            (x for x in terms if x not in new and self.expires(x) <= now),
+            key=self.expires,
+        )
+        if budget is not None:
+            expired = expired[:budget]
+        return new | set(expired)
+
+    def cached_pages(self, site, terms, limiter):
+        """
+        Returns a dict mapping each page cached for any of terms to the
+        terms it was found by, loading the pages by ID a batch at a time.
+        """
+        by_id = {}
+        for term in terms:
+            for page_id in self._entries[term][0]:
+                by_id.setdefault(page_id, set()).add(term)
+        metrics.count("search_cache_hits", len(terms), language=site.code)
+        if not by_id:
+            return {}
+
+        pages = {}
+        page_ids = list(by_id)
+        batch_size = site.maxlimit
+        for i in range(0, len(page_ids), batch_size):
+            group = page_ids[i : i + batch_size]
+
+            def fetch():
+                with metrics.timer("cached_pages", language=site.code):
+                    return list(site.load_pages_from_pageids(group))
+
+            try:
+                loaded = limiter.call(fetch)
+            except Exception as e:
+                logger.error("Failed to load %d cached pages: %r", len(group), e)
+                continue
+            # Pages deleted since they were cached are left out.
+            for page in loaded:
+                pages[page] = by_id[page.pageid]
+        return pages
+
+    def search(self, site, terms, limiter, timestamp=None):
+        """
+        Searches for terms as search_citing_pages does. The terms whose
+        search succeeded are only cached by save, once the caller has
+        narrowed each page down to the terms it cites.
+        """
+        timestamp = timestamp or datetime.datetime.now()
+        pages = {}
+        for batch, found in search_pages(site, terms, limiter=limiter):
+            logger.info("%d pages cite one of %s", len(found), batch)
+            for term in batch:
+                self._searched[term] = timestamp
+            for page in found:
+                pages.setdefault(page, set()).update(batch)
+        metrics.count("search_cache_misses", len(terms), language=site.code)
+        return pages
+
+    def save(self, pages):
+        """
+        Caches the IDs of the pages found for each term searched for since
+        the last save, given a dict mapping pages to the terms they cite.
+        Pages are cached under the terms they cite, not every term of the
+        query which found them, so a term's entry doesn't bring in pages
+        citing its batchmates when it's served from the cache.
+        """
+        found = {x: set() for x in self._searched}
+        for page, page_terms in pages.items():
+            for term in page_terms:
+                if term in found:
+                    found[term].add(page.pageid)
+
+        entries = []
+        for term, page_ids in found.items():
+            ttl = int(self.ttl * random.uniform(1 - self.jitter, 1 + self.jitter))
+            entry = (sorted(page_ids), self._searched[term], ttl)
+            self._entries[term] = entry
+            entries.append((term,) + entry)
+        self._searched = {}
+        if entries:
+            self._database.save_search_cache(self.domain, entries)
@@ -0,0 +1,235 @@
+"""
+Sharded runs, where several bot processes share each wiki's work. The
+search terms (or candidate pages) of a wiki are split into a fixed number
+of partitions by a stable hash, and each process works through partitions
+it has leased in the shard_leases table.
+
+Partitions are assigned to the live workers by consistent hashing, so each
+worker starts with its own share and a worker joining or leaving only
+moves the partitions next to it on the ring. Leases are kept alive by a
+heartbeat thread and expire if their worker stops, and a worker which has
+finished its own share steals any partition which is unleased or whose
+lease has expired, so the partitions of a crashed worker are picked up.
+"""
+
+import bisect
+import datetime
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+import zlib
+
+from .edit_queue import DEFAULT_EDIT_RATE
+from .metrics import metrics
+from .throttle import DEFAULT_MIN_RATE, DEFAULT_RATE
+
+logger = logging.getLogger(__name__)
+
+# Partitions each wiki's work is split into. Should comfortably exceed the
+# number of workers, so that work can be balanced between them.
+DEFAULT_PARTITIONS = 64
+
+# Seconds a lease lasts without a heartbeat, and between heartbeats.
+LEASE_TTL = 5 * 60
+HEARTBEAT_INTERVAL = 60
+
+# A partition completed less than this many hours ago isn't worked on
+# again, so the jobs of one scheduled run each claim it only once.
+SWEEP_HOURS = 20
+
+# Points on the hash ring per worker, to even out the share of each.
+VIRTUAL_NODES = 32
+
+
+def partition_of(value, partitions=DEFAULT_PARTITIONS):
+    """
+    Returns the partition of a search term or page title. Unlike hash(),
+    this is the same in every process.
+    """
+    return zlib.crc32(value.encode("utf-8")) % partitions
+
+
+def _ring_position(key):
+    return int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring mapping partitions to workers."""
+
+    def __init__(self, workers, virtual_nodes=VIRTUAL_NODES):
+        self._ring = sorted(
+            (_ring_position("{0}#{1}".format(worker, i)), worker)
+            for worker in workers
+            for i in range(virtual_nodes)
+        )
+        self._positions = [x[0] for x in self._ring]
+
+    def owner(self, domain, partition):
+        if not self._ring:
+            return None
+        position = _ring_position("{0}/{1}".format(domain, partition))
+        i = bisect.bisect(self._positions, position) % len(self._ring)
+        return self._ring[i][1]
+
+
+def default_worker_id():
+    return "{0}-{1}".format(socket.gethostname(), os.getpid())
+
+
+class Shard:
+    """
+    One worker of a sharded run. partitions(domain) yields the partitions
+    of a wiki this worker should process, leasing each one first and
+    marking it completed once the caller asks for the next. Use as a
+    context manager, which keeps the worker's leases alive while it runs.
+    """
+
+    def __init__(
+        self,
+        database,
+        worker_id=None,
+        partitions=DEFAULT_PARTITIONS,
+        lease_ttl=LEASE_TTL,
+        heartbeat_interval=HEARTBEAT_INTERVAL,
+        sweep_hours=SWEEP_HOURS,
+    ):
+        self._database = database
+        self.worker_id = worker_id or default_worker_id()
+        self.count = partitions
+        self.lease_ttl = datetime.timedelta(seconds=lease_ttl)
+        self.heartbeat_interval = heartbeat_interval
+        self.sweep = datetime.timedelta(hours=sweep_hours)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.beat()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._heartbeats, name="heartbeat", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+    def partition_of(self, value):
+        return partition_of(value, self.count)
+
+    def beat(self):
+        """Extends this worker's leases and records it as alive."""
+        self._database.heartbeat(
+            self.worker_id, datetime.datetime.now() + self.lease_ttl
+        )
+
+    def _heartbeats(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                self.beat()
+            except Exception as e:
+                logger.warning("Heartbeat failed: %r", e)
+
+    def _claim_order(self, domain, leases, now):
+        """
+        Returns the partitions of domain which are due and free to lease:
+        this worker's own on the hash ring first, then the rest, which are
+        stolen from workers which have stopped or not got to them yet.
+        """
+        ring = HashRing(self._database.load_workers(now - self.lease_ttl))
+        free = [
+            partition
+            for partition, (owner, expires, completed) in sorted(leases.items())
+            if (completed is None or completed < now - self.sweep)
+            and (owner is None or owner == self.worker_id or expires < now)
+        ]
+        own = [x for x in free if ring.owner(domain, x) == self.worker_id]
+        return own + [x for x in free if x not in own]
+
+    def _pending(self, leases, now):
+        return [
+            x
+            for x, (_, _, completed) in leases.items()
+            if completed is None or completed < now - self.sweep
+        ]
+
+    def partitions(self, domain):
+        """
+        Yields each partition of domain to process, until every partition
+        has been completed in this sweep. While the only ones left are
+        leased by other workers, waits for them to be completed or for
+        their leases to expire.
+        """
+        self._database.ensure_partitions(domain, self.count)
+        while True:
+            now = datetime.datetime.now()
+            leases = self._database.load_leases(domain, self.count)
+            if not self._pending(leases, now):
+                return
+            claimed = None
+            for partition in self._claim_order(domain, leases, now):
+                if self._database.claim_partition(
+                    domain,
+                    partition,
+                    self.worker_id,
+                    now + self.lease_ttl,
+                    now,
+                    now - self.sweep,
+                ):
+                    claimed = partition
+                    break
+            if claimed is None:
+                time.sleep(self.heartbeat_interval)
+                continue
+
+            owner = leases[claimed][0]
+            if owner not in (None, self.worker_id):
+                logger.info(
+                    "Took over partition %d of %s from %s", claimed, domain, owner
+                )
+                metrics.count("partitions_stolen", domain=domain)
+            completed = None
+            try:
+                yield claimed
+                completed = datetime.datetime.now()
+                metrics.count("partitions_completed", domain=domain)
+            finally:
+                # A partition abandoned by an error is released for
+                # another worker to retry.
+                self._database.release_partition(
+                    domain, claimed, self.worker_id, completed
+                )
+
+
+def partitioned(shard, domain, values):
+    """
+    Yields values whole if shard is None. Otherwise yields, in turn, the
+    values in each partition of domain that shard claims, each partition
+    being completed once the caller has finished with its values.
+    """
+    if shard is None:
+        yield values
+        return
+    for partition in shard.partitions(domain):
+        yield [x for x in values if shard.partition_of(x) == partition]
+
+
+def share_budgets(bot_settings, jobs):
+    """
+    Returns a copy of bot_settings giving one of jobs sharded jobs its
+    share of each wiki's request and edit rates, so that together they
+    stay within them.
+    """
+    settings = dict(bot_settings)
+    rate_limit = dict(settings.get("rate_limit", {}))
+    rate_limit["rate"] = rate_limit.get("rate", DEFAULT_RATE) / jobs
+    rate_limit["min_rate"] = rate_limit.get("min_rate", DEFAULT_MIN_RATE) / jobs
+    edits = dict(settings.get("edits", {}))
+    edits["rate"] = edits.get("rate", DEFAULT_EDIT_RATE) / jobs
+    settings["rate_limit"] = rate_limit
+    settings["edits"] = edits
+    return settings
@@ -0,0 +1,425 @@
+"""
+Memory-mapped snapshot of the retraction dataset, written after each
+ingest, so that the bot can start without loading every row from the
+database, the worker processes of a sharded run share one copy of the
+dataset through the page cache, and runs can be made offline.
+
+A snapshot file is laid out as:
+
+    header   magic, format version, counts, the dataset version and the
+             offset of each section below
+    keys     an entry per identifier, sorted by key bytes (id_type, NUL,
+             canonical value): its string, its run of record references
+             and when its records last changed
+    refs     record numbers, a run of them per key
+    records  per record, the offset and length of each of its fields
+    terms    the (original DOI, original PMID) of every row, in the order
+             load_retracted_identifiers returns them
+    strings  the bytes of every distinct string, referenced by offset
+
+Integers are little-endian. Opening a snapshot reads only its header;
+lookups binary search the key table in the mapped file.
+"""
+
+import argparse
+import datetime
+import functools
+import logging
+import mmap
+import os
+import struct
+
+from .db import Retraction
+from .identifiers import classify_identifier
+from .matcher import IdentifierMatcher
+from .retraction_index import RetractionIndex
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"RBSNAP\0\0"
+
+# Bumped whenever the layout changes. Snapshots of other versions aren't
+# read, and the database is used until the next ingest writes a new one.
+FORMAT_VERSION = 1
+
+# Magic, format version, records in the dataset, keys, records stored,
+# terms, dataset version, then the offsets of the keys, refs, records,
+# terms and strings sections and the size of the file.
+HEADER = struct.Struct("<8sIIIIIq6Q")
+
+# Offset and length of the key's string, first ref and number of refs, and
+# when the key's records last changed.
+KEY = struct.Struct("<IIIIq")
+
+REF = struct.Struct("<I")
+
+# Offset and length of each of a Retraction's fields, in slot order.
+RECORD = struct.Struct("<%dI" % (2 * len(Retraction.__slots__)))
+
+# Offset and length of a row's original DOI and original PMID.
+TERM = struct.Struct("<4I")
+
+# Versions are stored as microseconds since the epoch, or this if unknown.
+NO_VERSION = -(2**63)
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _to_micros(timestamp):
+    if timestamp is None:
+        return NO_VERSION
+    return (timestamp - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def _from_micros(micros):
+    if micros == NO_VERSION:
+        return None
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+def _key_bytes(id_type, id_value):
+    return (id_type + "\0" + id_value).encode("utf-8")
+
+
+class _Strings:
+    """Pool of distinct strings, each stored once."""
+
+    def __init__(self):
+        self._offsets = {}
+        self._chunks = []
+        self.size = 0
+
+    def add(self, value):
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        offset = self._offsets.get(value)
+        if offset is None:
+            offset = self._offsets[value] = self.size
+            self._chunks.append(value)
+            self.size += len(value)
+        return offset, len(value)
+
+    def tobytes(self):
+        return b"".join(self._chunks)
+
+
+def write_snapshot(path, index, retracted_identifiers):
+    """
+    Writes a snapshot of a RetractionIndex, and of the (doi, pmid) rows
+    from load_retracted_identifiers, to path. The file is written beside
+    path and renamed over it, so processes which have the old snapshot
+    mapped keep reading it unchanged. Returns the size of the file.
+    """
+    strings = _Strings()
+    numbers = {}
+    records = []
+    refs = []
+    keys = []
+    for key, key_records in sorted(index.items(), key=lambda x: _key_bytes(*x[0])):
+        start = len(refs)
+        for record in key_records:
+            # Records shared by a DOI and a PMID key are stored once.
+            fields = tuple(getattr(record, x) for x in Retraction.__slots__)
+            number = numbers.get(fields)
+            if number is None:
+                number = numbers[fields] = len(records)
+                records.append(fields)
+            refs.append(number)
+        keys.append(
+            KEY.pack(
+                *strings.add(_key_bytes(*key)),
+                start,
+                len(key_records),
+                _to_micros(index.versions.get(key)),
+            )
+        )
+
+    sections = [
+        b"".join(keys),
+        b"".join(REF.pack(x) for x in refs),
+        b"".join(
+            RECORD.pack(*(x for field in fields for x in strings.add(field)))
+            for fields in records
+        ),
+        b"".join(
+            TERM.pack(*strings.add(doi), *strings.add(pmid))
+            for doi, pmid in retracted_identifiers
+        ),
+    ]
+    sections.append(strings.tobytes())
+
+    offsets = []
+    offset = HEADER.size
+    for section in sections:
+        offsets.append(offset)
+        offset += len(section)
+    header = HEADER.pack(
+        MAGIC,
+        FORMAT_VERSION,
+        index.count,
+        len(keys),
+        len(records),
+        len(retracted_identifiers),
+        _to_micros(index.dataset_version),
+        *offsets,
+        offset,
+    )
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(header)
+        for section in sections:
+            f.write(section)
+    os.replace(temp_path, path)
+    return offset
+
+
+def export_snapshot(database, path):
+    """Writes a snapshot of the retractions in database to path."""
+    index = RetractionIndex.from_database(database)
+    size = write_snapshot(path, index, database.load_retracted_identifiers())
+    logger.info("Wrote %d identifiers to %s, %.1f MiB", len(index), path, size / 2**20)
+    return size
+
+
+class _KeySet:
+    """The canonical values of one identifier type in a snapshot, as a set."""
+
+    def __init__(self, snapshot, id_type):
+        self._snapshot = snapshot
+        self._id_type = id_type
+        self._lo, self._hi = snapshot._type_range(id_type)
+
+    def __len__(self):
+        return self._hi - self._lo
+
+    def __contains__(self, value):
+        # The matcher looks up whatever a candidate canonicalises to, which
+        # is None for a PMID of 0.
+        if not value:
+            return False
+        return (
+            self._snapshot._find(_key_bytes(self._id_type, value), self._lo, self._hi)
+            is not None
+        )
+
+
+class SnapshotIndex:
+    """
+    Read-only RetractionIndex served from a snapshot file mapped into
+    memory, which can be used wherever a RetractionIndex is. Raises
+    ValueError if path isn't a snapshot this version of the bot can read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._read_header()
+        except Exception:
+            self._map.close()
+            raise
+
+    def _read_header(self):
+        if len(self._map) < HEADER.size:
+            raise ValueError("too short to be a snapshot")
+        (
+            magic,
+            version,
+            self.count,
+            self._key_count,
+            self._record_count,
+            self._term_count,
+            dataset_version,
+            self._keys,
+            self._refs,
+            self._records,
+            self._terms,
+            self._strings,
+            size,
+        ) = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError("not a snapshot")
+        if version != FORMAT_VERSION:
+            raise ValueError(
+                "version %d snapshot, not version %d" % (version, FORMAT_VERSION)
+            )
+        if size != len(self._map):
+            raise ValueError("truncated")
+        self.dataset_version = _from_micros(dataset_version)
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _string(self, offset, length):
+        start = self._strings + offset
+        return self._map[start : start + length]
+
+    def _key(self, number):
+        return KEY.unpack_from(self._map, self._keys + number * KEY.size)
+
+    def _lower_bound(self, key, lo=0, hi=None):
+        """Returns the number of the first key not less than key."""
+        hi = self._key_count if hi is None else hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._string(*self._key(mid)[:2]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find(self, key, lo=0, hi=None):
+        """Returns the entry for key, or None if it isn't in the snapshot."""
+        hi = self._key_count if hi is None else hi
+        number = self._lower_bound(key, lo, hi)
+        if number < hi:
+            entry = self._key(number)
+            if self._string(*entry[:2]) == key:
+                return entry
+        return None
+
+    def _type_range(self, id_type):
+        prefix = id_type.encode("utf-8")
+        return (
+            self._lower_bound(prefix + b"\0"),
+            self._lower_bound(prefix + b"\1"),
+        )
+
+    def _entry(self, id):
+        identifier = classify_identifier(id)
+        if identifier is None:
+            return None
+        return self._find(_key_bytes(*identifier))
+
+    def _load_records(self, entry):
+        records = []
+        for i in range(entry[2], entry[2] + entry[3]):
+            (number,) = REF.unpack_from(self._map, self._refs + i * REF.size)
+            fields = RECORD.unpack_from(self._map, self._records + number * RECORD.size)
+            records.append(
+                Retraction(
+                    *(
+                        self._string(fields[j], fields[j + 1])
+                        for j in range(0, len(fields), 2)
+                    )
+                )
+            )
+        return records
+
+    def __len__(self):
+        return self._key_count
+
+    def __contains__(self, id):
+        return self._entry(id) is not None
+
+    def items(self):
+        """Yields ((id_type, canonical value), records) for every identifier."""
+        for number in range(self._key_count):
+            entry = self._key(number)
+            id_type, id_value = self._string(*entry[:2]).decode("utf-8").split("\0", 1)
+            yield (id_type, id_value), tuple(self._load_records(entry))
+
+    def retrieve_retracted_identifier(self, id):
+        entry = self._entry(id)
+        if entry is None:
+            return []
+        return self._load_records(entry)
+
+    def changed_since(self, identifiers, version):
+        """
+        Returns True if the records for any of identifiers were added or
+        changed after the given dataset version.
+        """
+        if version is None:
+            return True
+        for id in identifiers:
+            entry = self._entry(id)
+            if entry is None:
+                continue
+            changed = _from_micros(entry[4])
+            if changed is not None and changed > version:
+                return True
+        return False
+
+    @functools.cached_property
+    def matcher(self):
+        """
+        IdentifierMatcher looking identifiers up in the snapshot, rather
+        than in sets built from every identifier in it.
+        """
+        return IdentifierMatcher.from_sets(_KeySet(self, "doi"), _KeySet(self, "pmid"))
+
+    def identifiers(self, id_type=None):
+        """Yields the canonical values indexed, optionally of one type."""
+        lo, hi = (0, self._key_count) if id_type is None else self._type_range(id_type)
+        for number in range(lo, hi):
+            key = self._string(*self._key(number)[:2])
+            yield key.decode("utf-8").split("\0", 1)[1]
+
+    def retracted_identifiers(self):
+        """Returns the (doi, pmid) rows load_retracted_identifiers would."""
+        rows = []
+        for i in range(self._term_count):
+            doi_offset, doi_length, pmid_offset, pmid_length = TERM.unpack_from(
+                self._map, self._terms + i * TERM.size
+            )
+            rows.append(
+                (
+                    self._string(doi_offset, doi_length),
+                    self._string(pmid_offset, pmid_length),
+                )
+            )
+        return rows
+
+    def approximate_size(self):
+        """Size of the mapped file, which is shared between processes."""
+        return len(self._map)
+
+
+def open_snapshot(path):
+    """
+    Returns the SnapshotIndex at path, or None, after logging why, if
+    there's no snapshot there that can be read.
+    """
+    try:
+        snapshot = SnapshotIndex(path)
+    except FileNotFoundError:
+        logger.warning("No snapshot at %s, loading from the database", path)
+        return None
+    except ValueError as e:
+        logger.warning("Can't read %s (%s), loading from the database", path, e)
+        return None
+    logger.info(
+        "Mapped %d retractions under %d identifiers from %s",
+        snapshot.count,
+        len(snapshot),
+        path,
+    )
+    return snapshot
+
+
+if __name__ == "__main__":
+    from .db import Database
+    from .retraction_bot import load_bot_settings
+
+    parser = argparse.ArgumentParser(
+        description="Write a snapshot of the retraction dataset."
+    )
+    parser.add_argument("--output", help="snapshot file; defaults to snapshot.path")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO
+    )
+    bot_settings = load_bot_settings()
+    output = args.output or (bot_settings.get("snapshot") or {}).get("path")
+    if not output:
+        parser.error("no --output given and no snapshot.path setting")
+    export_snapshot(Database(bot_settings["db"]), output)
@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+
+import pywikibot.exceptions
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Requests per second once the servers are healthy, and the floor the rate
+# backs off to under sustained throttling.
+DEFAULT_RATE = 1.0
+DEFAULT_MIN_RATE = 1 / 300
+
+# Pause after a throttling response which didn't say how long to wait,
+# doubling with each consecutive one up to the maximum.
+BASE_BACKOFF = 5
+MAX_BACKOFF = 60 * 5
+
+# Attempts at a request before giving up on a throttled server.
+MAX_ATTEMPTS = 5
+
+# API error codes meaning the client should slow down.
+THROTTLE_CODES = {"maxlag", "ratelimited", "readonly"}
+THROTTLE_STATUSES = {429, 503}
+
+
+def retry_after(exception):
+    """
+    If an exception means the server is throttling us, returns the number
+    of seconds it asked us to wait, or 0 if it didn't say. Returns None for
+    any other error.
+    """
+    if isinstance(exception, pywikibot.exceptions.MaxlagTimeoutError):
+        return 0
+    if isinstance(exception, pywikibot.exceptions.APIError):
+        if exception.code not in THROTTLE_CODES:
+            return None
+        return float(exception.other.get("lag", 0))
+    if isinstance(exception, pywikibot.exceptions.Server504Error):
+        return 0
+
+    response = getattr(exception, "response", None)
+    if getattr(response, "status_code", None) in THROTTLE_STATUSES:
+        try:
+            return float(response.headers.get("Retry-After", 0))
+        except ValueError:
+            return 0
+    return None
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the rate of requests to one site. Throttling
+    responses halve the rate and pause all requests, for as long as the
+    server asked or for an exponentially growing backoff. Each success
+    then raises the rate by a tenth of the maximum until it is back to
+    full speed.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, min_rate=DEFAULT_MIN_RATE, burst=1):
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._consecutive_throttles = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be made."""
+        waited = 0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                wait = self._paused_until - now
+                if wait <= 0 and self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                wait = max(wait, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+            waited += wait
+        metrics.observe("throttle_wait", waited)
+
+    def call(self, func, *args, max_attempts=MAX_ATTEMPTS, **kwargs):
+        """
+        Calls func once a request may be made, retrying if the server
+        throttles it. Other errors, and throttling on the last attempt, are
+        raised.
+        """
+        for attempt in range(max_attempts):
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                delay = retry_after(e)
+                if delay is None or attempt == max_attempts - 1:
+                    raise
+                self.throttled(delay)
+                continue
+            self.succeeded()
+            return result
+
+    def succeeded(self):
+        with self._lock:
+            self._consecutive_throttles = 0
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+    def throttled(self, delay=0):
+        """
+        Records a throttling response, pausing for delay seconds if the
+        server gave one.
+        """
+        with self._lock:
+            if not delay:
+                delay = min(MAX_BACKOFF, BASE_BACKOFF * 2**self._consecutive_throttles)
+            self._consecutive_throttles += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self._tokens = 0
+        metrics.count("throttled")
+        logger.warning(
+            "Throttled, pausing %.1fs and slowing to %.3f requests/s",
+            delay,
+            self.rate,
+        )
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def site_limiter(site, **settings):
+    """
+    Returns the RateLimiter shared by everything making requests to site,
+    creating it from settings on first use.
+    """
+    with _limiters_lock:
+        key = (site.family.name, site.code)
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(**settings)
+        return _limiters[key]
@@ -0,0 +1,472 @@
+"""
+Long-running alternative to a full sweep, which follows the recent changes
+feed and flags citations of retracted works within minutes of them being
+added to an article, so that its work is proportional to the number of
+edits rather than to the size of the dataset.
+
+    python -m src.RetractionBot.watcher
+    python -m src.RetractionBot.watcher --source events.txt
+    python -m src.RetractionBot.watcher --source tcp://localhost:9000
+
+The feed is read in the Server-Sent Events format of Wikimedia's
+EventStreams, or as one JSON event per line, from a URL, a file ("-" for
+standard input) or a TCP socket. Edits to articles on the configured wikis
+are gathered into batches, and the new revisions of each batch fetched
+with one request. A page is only processed, and edited through the edit
+queue if need be, when its new revision cites an identifier in the
+retraction index that the revision before it didn't.
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+
+import pywikibot
+import requests
+
+from .db import Database
+from .edit_queue import DEFAULT_EDIT_RATE, LOG_BATCH_SIZE, EditQueue, QueuedEdit
+from .find_retractions import user_agent
+from .metrics import metrics, run_report
+from .retraction_bot import (
+    check_bot_killswitches,
+    load_bot_settings,
+    load_index,
+    process_page,
+)
+from .rewrite import RewriteEngine, load_decisions
+from .throttle import site_limiter
+
+directory = os.path.dirname(os.path.realpath(__file__))
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    filename=os.path.join(directory, "watcher.log"),
+    level=logging.INFO,
+)
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
+RECENT_CHANGES_URL = "https://stream.wikimedia.org/v2/stream/recentchange"
+
+# Revisions fetched per API request, the most the API allows with content.
+REVISION_BATCH_SIZE = 50
+
+# Longest an edit waits for its batch to fill before the batch is checked.
+MAX_DELAY = 10
+
+# Seconds between reloads of the retraction index, to pick up new records.
+INDEX_RELOAD_INTERVAL = 60 * 60
+
+# Seconds between checks of each wiki's killswitch.
+KILLSWITCH_INTERVAL = 60 * 5
+
+# Longest pause before reconnecting to a stream which has failed.
+MAX_RECONNECT_DELAY = 60
+
+# Seconds between checks for due batches while no events arrive.
+FLUSH_CHECK_INTERVAL = 1
+
+# Events read ahead of the ones being handled, beyond which reading waits.
+EVENT_QUEUE_SIZE = 10000
+
+
+def parse_events(lines):
+    """
+    Parses Server-Sent Events from an iterable of lines, yielding (event
+    ID, data) for each event. A line holding a JSON object on its own is
+    taken to be a whole event, so that files of one event per line can be
+    read too.
+    """
+    event_id = None
+    data = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            if data:
+                yield event_id, "\n".join(data)
+                data = []
+            continue
+        if line.startswith("{") and not data:
+            yield None, line
+            continue
+        if line.startswith(":"):
+            # A comment, used as a keepalive.
+            continue
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "data":
+            data.append(value)
+        elif field == "id":
+            event_id = value
+    if data:
+        yield event_id, "\n".join(data)
+
+
+def is_stream_url(source):
+    return source.startswith(("http://", "https://"))
+
+
+def read_lines(source, last_event_id=None):
+    """
+    Yields the lines of source, a stream URL, a tcp://host:port address, a
+    file path or "-" for standard input. A stream is resumed after
+    last_event_id, if given.
+    """
+    if is_stream_url(source):
+        headers = {"Accept": "text/event-stream", "User-Agent": user_agent}
+        if last_event_id:
+            headers["Last-Event-ID"] = last_event_id
+        with requests.get(source, stream=True, headers=headers, timeout=60) as r:
+            r.raise_for_status()
+            r.encoding = "utf-8"
+            yield from r.iter_lines(decode_unicode=True)
+    elif source.startswith("tcp://"):
+        host, _, port = source[len("tcp://") :].rpartition(":")
+        with socket.create_connection((host, int(port))) as connection:
+            with connection.makefile("r", encoding="utf-8") as lines:
+                yield from lines
+    elif source == "-":
+        yield from sys.stdin
+    else:
+        with open(source, encoding="utf-8") as lines:
+            yield from lines
+
+
+def follow(source):
+    """
+    Yields each event from source as a dict. A stream URL is reconnected
+    to whenever it drops, resuming from the last event seen; a file or
+    socket is read to its end.
+    """
+    last_event_id = None
+    delay = 1
+    while True:
+        try:
+            for event_id, data in parse_events(read_lines(source, last_event_id)):
+                try:
+                    event = json.loads(data)
+                except ValueError:
+                    logger.warning("Skipping malformed event: %r", data[:200])
+                    continue
+                last_event_id = event_id or last_event_id
+                delay = 1
+                yield event
+        except (OSError, requests.RequestException) as e:
+            if not is_stream_url(source):
+                raise
+            logger.warning("Stream failed, reconnecting in %ds: %r", delay, e)
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            continue
+        if not is_stream_url(source):
+            return
+        logger.info("Stream closed, reconnecting")
+
+
+def is_article_edit(event):
+    """Returns True for an edit or creation of a page in the main namespace."""
+    return (
+        event.get("type") in ("edit", "new")
+        and event.get("namespace") == 0
+        and "new" in event.get("revision", {})
+    )
+
+
+def fetch_revisions(site, revids, limiter):
+    """
+    Returns a dict of revision ID to (page ID, title, text) for revids,
+    fetching up to REVISION_BATCH_SIZE revisions per request. Revisions
+    which have been deleted or hidden are left out.
+    """
+    revisions = {}
+    for i in range(0, len(revids), REVISION_BATCH_SIZE):
+        group = revids[i : i + REVISION_BATCH_SIZE]
+
+        def fetch():
+            with metrics.timer("revisions", language=site.code):
+                return site.simple_request(
+                    action="query",
+                    prop="revisions",
+                    revids=group,
+                    rvprop="ids|content",
+                    rvslots="main",
+                    formatversion=2,
+                ).submit()
+
+        try:
+            data = limiter.call(fetch)
+        except Exception as e:
+            logger.error("Failed to fetch %d revisions: %r", len(group), e)
+            continue
+        for page in data.get("query", {}).get("pages", []):
+            for revision in page.get("revisions", []):
+                text = revision.get("slots", {}).get("main", {}).get("content")
+                if text is not None:
+                    revisions[revision["revid"]] = (page["pageid"], page["title"], text)
+    return revisions
+
+
+class WikiWatcher:
+    """
+    Edits to one wiki waiting to be checked, and what's needed to check
+    them and queue the edits which flag their citations.
+    """
+
+    def __init__(self, language, bot_settings, database, index):
+        self.language = language
+        self.domain = language + ".wikipedia.org"
+        self.database = database
+        self.template_map = bot_settings["template_name_map"][language]
+        self.field_map = bot_settings["template_field_names"][language]
+        self.set_index(index)
+        self.site = pywikibot.Site(language, "wikipedia")
+        self.site.login()
+        self.username = self.site.username()
+        self.limiter = site_limiter(self.site, **bot_settings.get("rate_limit", {}))
+        watch_settings = bot_settings.get("watch", {})
+        self.batch_size = watch_settings.get("batch_size", REVISION_BATCH_SIZE)
+        self.max_delay = watch_settings.get("max_delay", MAX_DELAY)
+        self.killswitch_interval = watch_settings.get(
+            "killswitch_interval", KILLSWITCH_INTERVAL
+        )
+        self._can_run = False
+        self._killswitch_checked = None
+        self._pending = {}
+        self._oldest = None
+        edit_settings = bot_settings.get("edits", {})
+        self.edits = EditQueue(
+            database,
+            self.site,
+            self.domain,
+            bot_settings["summary_map"][language],
+            self.analyse,
+            rate=edit_settings.get("rate", DEFAULT_EDIT_RATE),
+            log_batch_size=edit_settings.get("log_batch_size", LOG_BATCH_SIZE),
+            can_run=self.can_run,
+        )
+
+    def set_index(self, index):
+        """
+        Checks edits against index from now on, with the template decisions
+        built from it if they have been stored. The index and its engine
+        are replaced together, in one assignment, so the edit queue's
+        writer, which rebases edits on its own thread, never pairs one
+        with the other's predecessor.
+        """
+        engine = RewriteEngine(
+            self.template_map,
+            self.field_map,
+            load_decisions(
+                self.database, self.language, self.template_map, self.field_map, index
+            ),
+        )
+        self.checker = (index, engine)
+
+    def analyse(self, page_text):
+        index, engine = self.checker
+        return process_page(page_text, index, engine)
+
+    def can_run(self):
+        """
+        Checks the killswitch, at most once per killswitch interval. Also
+        called by the edit queue's writer before each save.
+        """
+        now = time.monotonic()
+        if (
+            self._killswitch_checked is None
+            or now - self._killswitch_checked > self.killswitch_interval
+        ):
+            self._can_run = check_bot_killswitches(self.site)
+            if self._can_run:
+                self.edits.start()
+            self._killswitch_checked = now
+        return self._can_run
+
+    def add(self, event):
+        """
+        Adds an edit to the batch, merged with any earlier edit to the same
+        page in it, so the batch compares the page's latest revision with
+        the one before the first of its edits.
+        """
+        if event.get("user") == self.username:
+            return
+        old, new = event["revision"].get("old"), event["revision"]["new"]
+        earlier = self._pending.get(event["title"])
+        if earlier is not None:
+            old, new = earlier[0], max(earlier[1], new)
+        self._pending[event["title"]] = (old, new)
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+    def due(self):
+        return bool(self._pending) and (
+            len(self._pending) >= self.batch_size
+            or time.monotonic() - self._oldest >= self.max_delay
+        )
+
+    def flush(self):
+        """
+        Checks the batch of edits, processing each page whose latest
+        revision cites a retracted work which it didn't before the batch.
+        """
+        if not self._pending:
+            return
+        pending, self._pending, self._oldest = self._pending, {}, None
+        index, _ = self.checker
+        matcher = index.matcher
+        new = fetch_revisions(self.site, [x[1] for x in pending.values()], self.limiter)
+        metrics.count("revisions_checked", len(new), language=self.language)
+
+        found = {}
+        for title, (old_revid, new_revid) in pending.items():
+            if new_revid in new:
+                identifiers = matcher.matches(new[new_revid][2])
+                if identifiers:
+                    found[title] = identifiers
+        if not found:
+            return
+
+        # Most edits cite nothing retracted, so only a few old revisions
+        # need fetching.
+        old = fetch_revisions(
+            self.site,
+            [pending[x][0] for x in found if pending[x][0]],
+            self.limiter,
+        )
+        for title, identifiers in found.items():
+            old_revid, new_revid = pending[title]
+            if old_revid:
+                if old_revid not in old:
+                    continue
+                identifiers = identifiers - matcher.matches(old[old_revid][2])
+            if not identifiers:
+                continue
+            metrics.count("citations_added", len(identifiers), language=self.language)
+            logger.info(
+                "Retracted work(s) %s cited on %s in revision %d",
+                ", ".join(sorted(identifiers)),
+                title,
+                new_revid,
+            )
+            self.process(new_revid, *new[new_revid])
+
+    def process(self, revid, page_id, title, text):
+        page_text, changes = self.analyse(text)
+        if page_text == text or not self.can_run():
+            return
+        self.edits.add(QueuedEdit(page_id, title, revid, page_text, changes))
+
+    def close(self):
+        self.flush()
+        self.edits.close()
+
+
+class Watcher:
+    """
+    Follows a recent changes feed, sending edits to the configured wikis
+    to their WikiWatcher and reloading the retraction index periodically.
+    """
+
+    def __init__(self, bot_settings, database):
+        self.bot_settings = bot_settings
+        self.database = database
+        self.index_reload_interval = bot_settings.get("watch", {}).get(
+            "index_reload_interval", INDEX_RELOAD_INTERVAL
+        )
+        self.index = self.load_index()
+        self.wikis = {}
+        for language in bot_settings["template_name_map"]:
+            wiki = WikiWatcher(language, bot_settings, database, self.index)
+            self.wikis[wiki.domain] = wiki
+
+    def load_index(self):
+        with metrics.timer("index_load"):
+            index = load_index(self.database, self.bot_settings)
+            index.matcher
+        self._index_loaded = time.monotonic()
+        logger.info("Loaded %d retracted identifiers", len(index))
+        return index
+
+    def reload_index(self):
+        if time.monotonic() - self._index_loaded < self.index_reload_interval:
+            return
+        self.index = self.load_index()
+        # The replaced index isn't closed, as an edit being rebased may
+        # still be using it; a snapshot's file is unmapped once the last
+        # reference to it goes.
+        for wiki in self.wikis.values():
+            wiki.set_index(self.index)
+
+    def _read(self, source, events):
+        """
+        Puts each event from source on events, then None once the source
+        ends, or the exception it failed with.
+        """
+        try:
+            for event in follow(source):
+                events.put(event)
+        except Exception as e:
+            events.put(e)
+        else:
+            events.put(None)
+
+    def run(self, source):
+        """
+        Handles the events from source until it ends. Events are read on
+        a thread of their own, so that batches are checked once due even
+        while the feed is quiet.
+        """
+        events = queue.Queue(EVENT_QUEUE_SIZE)
+        reader = threading.Thread(
+            target=self._read, args=(source, events), name="events", daemon=True
+        )
+        reader.start()
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=FLUSH_CHECK_INTERVAL)
+                except queue.Empty:
+                    event = {}
+                if event is None:
+                    break
+                if isinstance(event, Exception):
+                    raise event
+                if event:
+                    metrics.count("events_seen")
+                    wiki = self.wikis.get(event.get("server_name"))
+                    if wiki is not None and is_article_edit(event):
+                        wiki.add(event)
+                for wiki in self.wikis.values():
+                    if wiki.due():
+                        wiki.flush()
+                self.reload_index()
+        finally:
+            for wiki in self.wikis.values():
+                wiki.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--source",
+        help="stream URL, file, - for stdin or tcp://host:port to read events from",
+    )
+    args = parser.parse_args()
+
+    bot_settings = load_bot_settings()
+    source = args.source or bot_settings.get("watch", {}).get(
+        "source", RECENT_CHANGES_URL
+    )
+    logger.info("Watching %s", source)
+    with run_report("watcher", bot_settings.get("metrics"), directory):
+        Watcher(bot_settings, Database(bot_settings["db"])).run(source)
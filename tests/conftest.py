@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+# pywikibot refuses to import without a user-config.py unless told not to
+# look for one.
+os.environ.setdefault("PYWIKIBOT_NO_USER_CONFIG", "2")
+
+
+def row(doi, notice, pmid="0", notice_pmid="0", nature="Retraction", url=""):
+    """A retractions row as Database.load_retractions returns it."""
+    return tuple(
+        x.encode("utf-8")
+        for x in ("Crossref", doi, notice, pmid, notice_pmid, nature, url)
+    )
+
+
+class Family:
+    def __init__(self, name):
+        self.name = name
+
+
+class Site:
+    """
+    Stand-in for a pywikibot site. Sites of the same family and code share
+    a rate limiter, so tests which set one up differently use a family of
+    their own.
+    """
+
+    def __init__(self, code="en", family="wikipedia"):
+        self.code = code
+        self.family = Family(family)
+
+
+class Page:
+    """Stand-in for a pywikibot page found by a search."""
+
+    def __init__(self, title, text=None, pageid=None):
+        self.title = title
+        self.text = text
+        self.pageid = pageid
+
+    def __repr__(self):
+        return self.title
+
+
+class Limiter:
+    """RateLimiter which calls straight through."""
+
+    def call(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+
+@pytest.fixture
+def database(tmp_path):
+    from src.RetractionBot.db import Database
+
+    database = Database({"backend": "sqlite", "path": str(tmp_path / "bot.sqlite3")})
+    database.migrate()
+    yield database
+    database.close()
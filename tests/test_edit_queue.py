@@ -0,0 +1,97 @@
+import datetime
+
+import pytest
+from conftest import Site
+
+from src.RetractionBot import edit_queue
+from src.RetractionBot.edit_queue import EditQueue, QueuedEdit
+
+DOMAIN = "en.wikipedia.org"
+
+
+class Page:
+    revisions = {}
+    saved = []
+
+    def __init__(self, site, title):
+        self.title = title
+        self.latest_revision_id = self.revisions[title]
+
+    def save(self, summary, minor=False):
+        self.saved.append((self.title, self.text))
+
+
+@pytest.fixture
+def pages(monkeypatch):
+    monkeypatch.setattr(Page, "revisions", {"First": 10, "Second": 20})
+    monkeypatch.setattr(Page, "saved", [])
+    monkeypatch.setattr(edit_queue.pywikibot, "Page", Page)
+    monkeypatch.setattr(edit_queue, "load_revision_info", lambda *args: None)
+    return Page
+
+
+def queue(database, **kwargs):
+    return EditQueue(
+        database,
+        # Not the family of the other tests, which set up its rate limiter.
+        Site(family="edit-queue"),
+        DOMAIN,
+        "summary",
+        None,
+        rate=1000,
+        **kwargs
+    )
+
+
+def test_edits_saved_and_logged(database, pages):
+    with queue(database) as edits:
+        edits.add(QueuedEdit(1, "First", 10, "first text", ["10.1000/a"]))
+        edits.add(QueuedEdit(2, "Second", 20, "second text", ["10.1000/b"]))
+
+    assert pages.saved == [("First", "first text"), ("Second", "second text")]
+    assert edits.edited == 2
+    assert database.load_queued_edits(DOMAIN, edit_queue.MAX_ATTEMPTS) == []
+
+
+def test_killswitch_stops_running_writer(database, pages):
+    answers = iter([True, False])
+
+    with queue(database, can_run=lambda: next(answers)) as edits:
+        edits.add(QueuedEdit(1, "First", 10, "first text", ["10.1000/a"]))
+        edits.add(QueuedEdit(2, "Second", 20, "second text", ["10.1000/b"]))
+
+    assert pages.saved == [("First", "first text")]
+    # Left for the next run to save.
+    assert database.load_queued_edits(DOMAIN, edit_queue.MAX_ATTEMPTS) == [
+        (2, "Second", 20, "second text", ["10.1000/b"])
+    ]
+
+
+class Shard:
+    lease_ttl = datetime.timedelta(minutes=5)
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+
+
+def test_sharded_jobs_resume_separate_edits(database, pages, monkeypatch):
+    now = datetime.datetime.now()
+    database.heartbeat("stopped", now, now - datetime.timedelta(hours=1))
+    database.heartbeat("other", now, now)
+    database.heartbeat("this", now, now)
+    database.queue_edit(DOMAIN, 1, "First", 10, "first text", [], "stopped")
+    database.queue_edit(DOMAIN, 2, "Second", 20, "second text", [], "other")
+    database.queue_edit(DOMAIN, 3, "Third", 30, "third text", [])
+    monkeypatch.setitem(Page.revisions, "Third", 30)
+
+    with queue(database, shard=Shard("this")):
+        pass
+
+    # The edits of a live job are left to it.
+    assert pages.saved == [("First", "first text"), ("Third", "third text")]
+    assert database.load_queued_edits(DOMAIN, edit_queue.MAX_ATTEMPTS) == [
+        (2, "Second", 20, "second text", [])
+    ]
+    with queue(database, shard=Shard("another")):
+        pass
+    assert pages.saved == [("First", "first text"), ("Third", "third text")]
@@ -0,0 +1,42 @@
+import bz2
+import os
+import shutil
+
+import pytest
+
+from src.RetractionBot.find_citing_pages import iter_dump_pages, scan_dump
+
+DUMP = os.path.join(os.path.dirname(__file__), "data", "pages-articles.xml")
+
+DOIS = {"10.1000/retracted.1", "10.1000/retracted.2"}
+PMIDS = {"123", "456"}
+
+
+@pytest.fixture(params=["xml", "bz2"])
+def dump(request, tmp_path):
+    if request.param == "xml":
+        return DUMP
+    path = str(tmp_path / "pages-articles.xml.bz2")
+    with open(DUMP, "rb") as source, bz2.open(path, "wb") as compressed:
+        shutil.copyfileobj(source, compressed)
+    return path
+
+
+def test_iter_dump_pages_skips_other_namespaces_and_redirects(dump):
+    assert [title for title, _ in iter_dump_pages(dump)] == [
+        "Cites a DOI",
+        "Cites a PMID",
+        "Cites both",
+        "Cites nothing retracted",
+        "Empty",
+    ]
+
+
+def test_scan_dump_reports_citing_pages(dump):
+    results = dict(scan_dump(dump, DOIS, PMIDS, workers=2, chunk_size=2))
+
+    assert results == {
+        "Cites a DOI": {"10.1000/retracted.1"},
+        "Cites a PMID": {"123"},
+        "Cites both": {"10.1000/retracted.2", "456"},
+    }
@@ -0,0 +1,47 @@
+import csv
+import io
+
+import pytest
+
+from src.RetractionBot.find_retractions import iter_decoded_lines
+
+CSV = (
+    "Record ID,Title,OriginalPaperDOI\r\n"
+    '1,"A study of\r\nline breaks",10.1000/a\r\n'
+    '2,"Études — résumé 研究 🧪",10.1000/b\r\n'
+    '3,"Split ""quoted""\nfield",10.1000/c\r\n'
+).encode("utf-8")
+
+
+def chunked(data, size):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def expected():
+    return list(csv.DictReader(io.StringIO(CSV.decode("utf-8"), newline="")))
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 64, len(CSV)])
+def test_decoded_lines_feed_dictreader(size):
+    rows = list(csv.DictReader(iter_decoded_lines(chunked(CSV, size))))
+
+    assert rows == expected()
+    assert rows[0]["Title"] == "A study of\r\nline breaks"
+    assert rows[1]["Title"] == "Études — résumé 研究 🧪"
+    assert rows[2]["Title"] == 'Split "quoted"\nfield'
+
+
+def test_multibyte_character_split_at_every_offset():
+    text = 'Title\r\n"Études — 研究 🧪"\r\n'
+    data = text.encode("utf-8")
+    for split in range(1, len(data)):
+        chunks = [data[:split], b"", data[split:]]
+        rows = list(csv.DictReader(iter_decoded_lines(chunks)))
+
+        assert rows == [{"Title": "Études — 研究 🧪"}], split
+
+
+def test_trailing_line_without_newline():
+    chunks = chunked(b"DOI\n10.1000/\xc3\xa9", 4)
+
+    assert list(iter_decoded_lines(chunks)) == ["DOI\n", "10.1000/é"]
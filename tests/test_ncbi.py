@@ -0,0 +1,210 @@
+import datetime
+import io
+import os
+
+import lxml.etree
+import pytest
+from conftest import Limiter
+
+from src.RetractionBot import find_retractions
+from src.RetractionBot.find_retractions import (
+    get_ncbi_retractions,
+    iter_pubmed_articles,
+    pubmed_links,
+)
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "data", "pubmed")
+
+SETTINGS = {"queries": ['"retracted publication"[pt]']}
+
+LINKS = {
+    "111-222": {
+        "record_id": "111-222",
+        "timestamp": datetime.datetime(2020, 3, 4),
+        "original_doi": "10.1000/original",
+        "retraction_doi": "0",
+        "original_pmid": "111",
+        "retraction_pmid": "222",
+        "retraction_nature": "Retraction",
+        "url": "",
+    },
+    "444-333": {
+        "record_id": "444-333",
+        "timestamp": datetime.datetime.fromtimestamp(0),
+        "original_doi": "",
+        "retraction_doi": "10.1000/notice",
+        "original_pmid": "444",
+        "retraction_pmid": "333",
+        "retraction_nature": "Retraction",
+        "url": "",
+    },
+}
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+
+class Response:
+    def __init__(self, body, status_code=200):
+        self.content = body
+        self.status_code = status_code
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise OSError("HTTP %d" % self.status_code)
+
+    def iter_content(self, chunk_size=1):
+        # Small chunks, so articles span several of them.
+        stream = io.BytesIO(self.content)
+        return iter(lambda: stream.read(100), b"")
+
+
+class Session:
+    """Answers esearch and efetch requests with fixed responses."""
+
+    def __init__(self, search, fetch):
+        self.search = search
+        self.fetch = fetch
+        self.requests = []
+
+    def __call__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def get(self, url, params=None, headers=None, stream=False):
+        self.requests.append((url.rsplit("/", 1)[1], params))
+        if url.endswith("esearch.fcgi"):
+            return self.search
+        return self.fetch
+
+
+def stored(database):
+    return set(database.load_row_hashes("NCBI"))
+
+
+def ingest(database, monkeypatch, fetch, search=None, **kwargs):
+    session = Session(search or Response(fixture("esearch.xml")), fetch)
+    monkeypatch.setattr(find_retractions.requests, "Session", session)
+    get_ncbi_retractions(database, SETTINGS, limiter=Limiter(), **kwargs)
+    return session
+
+
+def seed(database):
+    with database.bulk_writer("NCBI") as writer:
+        writer.add(**dict(LINKS["111-222"], record_id="999-998"))
+
+
+def test_iter_pubmed_articles_yields_each_article():
+    chunks = [fixture("efetch.xml")[i : i + 50] for i in range(0, 4000, 50)]
+
+    pmids = [x.findtext("MedlineCitation/PMID") for x in iter_pubmed_articles(chunks)]
+
+    assert pmids == ["111", "333"]
+
+
+def test_iter_pubmed_articles_raises_on_truncated_response():
+    with pytest.raises(lxml.etree.XMLSyntaxError):
+        for _ in iter_pubmed_articles([fixture("efetch-truncated.xml")]):
+            pass
+
+
+def test_pubmed_links():
+    articles = iter_pubmed_articles([fixture("efetch.xml")])
+
+    # Each article is cleared once the next is read, so links are taken
+    # as they stream in.
+    assert [pubmed_links(x) for x in articles] == [
+        [LINKS["111-222"]],
+        [LINKS["444-333"]],
+    ]
+
+
+def test_get_ncbi_retractions(database, monkeypatch):
+    session = ingest(database, monkeypatch, Response(fixture("efetch.xml")))
+
+    assert stored(database) == set(LINKS)
+    search, fetch = session.requests
+    assert search[0] == "esearch.fcgi"
+    assert search[1]["term"] == SETTINGS["queries"][0]
+    assert fetch[0] == "efetch.fcgi"
+    assert (fetch[1]["query_key"], fetch[1]["WebEnv"]) == ("1", "MCID_1")
+
+
+def test_stale_records_deleted(database, monkeypatch):
+    seed(database)
+
+    ingest(database, monkeypatch, Response(fixture("efetch.xml")), full_refresh=True)
+
+    assert stored(database) == set(LINKS)
+
+
+@pytest.mark.parametrize(
+    "search, fetch",
+    [
+        ("esearch.xml", "efetch-truncated.xml"),
+        # A well formed page with fewer records than the search found.
+        ("esearch-count-3.xml", "efetch.xml"),
+        ("esearch.xml", 500),
+        ("esearch-error.xml", "efetch.xml"),
+    ],
+    ids=["truncated", "short", "failed", "search-error"],
+)
+@pytest.mark.parametrize("full_refresh", [False, True])
+def test_failed_fetch_changes_nothing(
+    database, monkeypatch, search, fetch, full_refresh
+):
+    seed(database)
+    if search == "esearch-count-3.xml":
+        search = Response(fixture("esearch.xml").replace(b"<Count>2", b"<Count>3"))
+    else:
+        search = Response(fixture(search))
+    if fetch == 500:
+        fetch = Response(b"", 500)
+    else:
+        fetch = Response(fixture(fetch))
+
+    with pytest.raises(Exception):
+        ingest(database, monkeypatch, fetch, search, full_refresh=full_refresh)
+
+    assert stored(database) == {"999-998"}
+
+
+def test_partial_full_refresh_swapped_in_without_deleting(database, monkeypatch):
+    seed(database)
+
+    def links(article):
+        if article.findtext("MedlineCitation/PMID") == "333":
+            raise ValueError("unreadable record")
+        return pubmed_links(article)
+
+    monkeypatch.setattr(find_retractions, "pubmed_links", links)
+    ingest(database, monkeypatch, Response(fixture("efetch.xml")), full_refresh=True)
+
+    assert stored(database) == {"999-998", "111-222"}
+
+
+def test_partial_refresh_deletes_nothing(database, monkeypatch):
+    seed(database)
+
+    def links(article):
+        if article.findtext("MedlineCitation/PMID") == "333":
+            raise ValueError("unreadable record")
+        return pubmed_links(article)
+
+    monkeypatch.setattr(find_retractions, "pubmed_links", links)
+    ingest(database, monkeypatch, Response(fixture("efetch.xml")))
+
+    assert stored(database) == {"999-998", "111-222"}
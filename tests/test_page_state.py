@@ -0,0 +1,48 @@
+import datetime
+
+from src.RetractionBot.page_state import PageStateCache
+from src.RetractionBot.retraction_index import RetractionIndex
+
+DOMAIN = "en.wikipedia.org"
+
+
+class Page:
+    def __init__(self, pageid, revid):
+        self._pageid = self.pageid = pageid
+        self._revid = self.latest_revision_id = revid
+
+
+def record(record_id, doi, nature):
+    return {
+        "record_id": record_id,
+        "timestamp": datetime.datetime(2020, 1, 1),
+        "original_doi": doi,
+        "retraction_doi": "0",
+        "original_pmid": "0",
+        "retraction_pmid": "0",
+        "retraction_nature": nature,
+        "url": "",
+    }
+
+
+def test_deleted_record_invalidates_pages_citing_it(database):
+    with database.bulk_writer("Crossref") as writer:
+        writer.add(**record("1", "10.1000/a", "Retraction"))
+        writer.add(**record("2", "10.1000/a", "Expression of concern"))
+        writer.add(**record("3", "10.1000/b", "Retraction"))
+    states = PageStateCache(database, DOMAIN, RetractionIndex.from_database(database))
+    states.checked(Page(1, 10))
+    states.checked(Page(2, 20))
+    states.save()
+
+    # The retraction is withdrawn, leaving the expression of concern.
+    with database.bulk_writer("Crossref") as writer:
+        writer.keep("2")
+        writer.keep("3")
+        assert writer.delete_stale() == 1
+
+    index = RetractionIndex.from_database(database)
+    states = PageStateCache(database, DOMAIN, index)
+    assert not states.is_current(Page(1, 10), {"10.1000/a"})
+    assert states.is_current(Page(2, 20), {"10.1000/b"})
+    assert index.dataset_version == writer.changed
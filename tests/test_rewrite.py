@@ -0,0 +1,184 @@
+import mwparserfromhell
+import pytest
+from conftest import row
+
+from src.RetractionBot.retraction_bot import prefilter
+from src.RetractionBot.retraction_index import RetractionIndex
+from src.RetractionBot.rewrite import RewriteEngine, build_decisions
+
+TEMPLATE_MAP = {
+    "Retracted": "Retracted",
+    "retraction": "Retracted",
+    "eoc": "Expression of Concern",
+    "erratum": "Erratum",
+}
+FIELD_MAP = {"doi": "doi", "pmid": "pmid", "intentional": "intentional"}
+
+RETRACTED = "{{Retracted|doi=10.1000/a.notice|http://rw/1 ''Retraction Watch''}}"
+
+
+@pytest.fixture(scope="module")
+def index():
+    return RetractionIndex(
+        [
+            row("10.1000/a", "10.1000/a.notice", url="http://rw/1"),
+            row("10.1000/b", "10.1000/b.notice", nature="Expression of concern"),
+            row("", "0", pmid="123", notice_pmid="456"),
+            row("10.1000/back", "10.1000/back.notice"),
+            row("10.1000/back", "0", nature="Reinstatement"),
+            row("10.1000/fixed", "10.1000/fixed.notice", nature="Correction"),
+        ]
+    )
+
+
+@pytest.fixture(params=[False, True], ids=["resolved", "precomputed"])
+def engine(request, index):
+    decisions = None
+    if request.param:
+        decisions = build_decisions(index, TEMPLATE_MAP, FIELD_MAP)
+    return RewriteEngine(TEMPLATE_MAP, FIELD_MAP, decisions)
+
+
+def rewrite(engine, index, text, hits=None):
+    wikitext = mwparserfromhell.parse(text)
+    changes = engine.rewrite(wikitext, index.retrieve_retracted_identifier, hits)
+    return str(wikitext), changes
+
+
+@pytest.mark.parametrize(
+    "text, flag, changes",
+    [
+        ("{{cite journal |doi=10.1000/A}}", RETRACTED, ["10.1000/a"]),
+        (
+            "{{doi|10.1000/b}}",
+            "{{Expression of Concern|doi=10.1000/b.notice}}",
+            ["10.1000/b"],
+        ),
+        ("{{pmid|123}}", "{{Retracted|pmid=456}}", ["123"]),
+        ("{{cite journal|pmid=123}}", "{{Retracted|pmid=456}}", ["123"]),
+        # The DOI has no record, but the PMID does.
+        (
+            "{{cite journal|doi=10.1000/other|pmid=123}}",
+            "{{Retracted|pmid=456}}",
+            ["123"],
+        ),
+        (
+            "{{cite journal|doi=10.1000/fixed}}",
+            "{{Erratum|doi=10.1000/fixed.notice}}",
+            ["10.1000/fixed"],
+        ),
+    ],
+)
+def test_flag_inserted_after_citation(engine, index, text, flag, changes):
+    assert rewrite(engine, index, "See " + text + ".") == (
+        "See " + text + flag + ".",
+        changes,
+    )
+
+
+def test_existing_flag_updated_keeping_editor_parameters(engine, index):
+    text, changes = rewrite(
+        engine,
+        index,
+        "{{cite journal|doi=10.1000/a}}"
+        "{{Retracted|doi=10.1000/old|intentional=yes|pmcid=PMC1|checked=yes}}",
+    )
+
+    assert text == (
+        "{{cite journal|doi=10.1000/a}}"
+        "{{Retracted|doi=10.1000/a.notice|http://rw/1 ''Retraction Watch''"
+        "|intentional=yes|pmcid=PMC1|checked=yes}}"
+    )
+    assert changes == []
+
+
+def test_up_to_date_flag_left_alone(engine, index):
+    text = "{{cite journal|doi=10.1000/a}}" + RETRACTED
+
+    assert rewrite(engine, index, text) == (text, [])
+
+
+def test_existing_flag_found_by_pmid(engine, index):
+    text = "{{cite journal|doi=10.1000/other|pmid=123}}{{Retracted|pmid=1}}"
+
+    assert rewrite(engine, index, text) == (
+        "{{cite journal|doi=10.1000/other|pmid=123}}{{Retracted|pmid=456}}",
+        [],
+    )
+
+
+def test_flag_after_nested_template_found(engine, index):
+    text = (
+        "{{cite journal |title={{lang|fr|Le}} |doi=10.1000/a}}\n"
+        "{{Retracted|doi=10.1000/old}}"
+    )
+
+    assert rewrite(engine, index, text) == (
+        "{{cite journal |title={{lang|fr|Le}} |doi=10.1000/a}}\n" + RETRACTED,
+        [],
+    )
+
+
+def test_flag_removed_from_reinstated_work(engine, index):
+    assert rewrite(
+        engine,
+        index,
+        "{{cite journal|doi=10.1000/back}}{{Retracted|doi=10.1000/back.notice}} x",
+    ) == ("{{cite journal|doi=10.1000/back}} x", [])
+
+
+def test_nested_citations_under_one_parent(engine, index):
+    text, changes = rewrite(
+        engine,
+        index,
+        "<ref>{{Efn|{{cite journal|doi=10.1000/a}} and "
+        "{{cite journal|doi=10.1000/b}}{{Retracted|doi=10.1000/b.old}} and "
+        "{{cite journal|doi=10.1000/back}}{{Retracted}}}}</ref>",
+    )
+
+    assert text == (
+        "<ref>{{Efn|{{cite journal|doi=10.1000/a}}" + RETRACTED + " and "
+        "{{cite journal|doi=10.1000/b}}"
+        "{{Expression of Concern|doi=10.1000/b.notice}} and "
+        "{{cite journal|doi=10.1000/back}}}}</ref>"
+    )
+    assert changes == ["10.1000/a"]
+
+
+def test_cochrane_reviews_not_flagged(engine, index):
+    text = "{{cite journal|journal=Cochrane Database Syst Rev|doi=10.1000/a}}"
+
+    assert rewrite(engine, index, text) == (text, [])
+
+
+def test_unknown_identifiers_left_alone(engine, index):
+    text = "{{cite journal|doi=10.1000/other}} {{pmid|999}} {{cite web|url=x}}"
+
+    assert rewrite(engine, index, text) == (text, [])
+
+
+def test_only_prefilter_hits_resolved(engine, index):
+    text = "{{cite journal|doi=10.1000/a}} {{cite journal|doi=10.1000/b}}"
+    hits = [x for x in prefilter(text, index) if x[3] == "10.1000/b"]
+
+    assert rewrite(engine, index, text, hits) == (
+        "{{cite journal|doi=10.1000/a}} {{cite journal|doi=10.1000/b}}"
+        "{{Expression of Concern|doi=10.1000/b.notice}}",
+        ["10.1000/b"],
+    )
+
+
+def test_same_output_with_and_without_decisions(index):
+    text = (
+        "{{cite journal|doi=10.1000/a}}{{Retracted|intentional=yes}} "
+        "<ref>{{doi|10.1000/B}} {{pmid|0123}}</ref> "
+        "{{cite journal|doi=10.1000/back}}{{Retracted}} "
+        "{{cite journal|doi=10.1000/fixed}} {{cite journal|doi=10.1000/other}}"
+    )
+    resolved = RewriteEngine(TEMPLATE_MAP, FIELD_MAP)
+    precomputed = RewriteEngine(
+        TEMPLATE_MAP, FIELD_MAP, build_decisions(index, TEMPLATE_MAP, FIELD_MAP)
+    )
+
+    assert rewrite(resolved, index, text) == rewrite(precomputed, index, text)
+    assert rewrite(resolved, index, text)[0] != text
@@ -0,0 +1,49 @@
+from conftest import Limiter, Page, Site
+
+from src.RetractionBot.search import cited_terms, search_citing_pages
+
+
+def test_cited_terms_narrows_to_the_terms_cited():
+    terms = {"10.1000/abc", "10.1000/XYZ", "123", "10.1000/unused"}
+
+    assert cited_terms(terms, "{{cite journal |doi=10.1000/ABC. |pmid=0123}}") == {
+        "10.1000/abc",
+        "123",
+    }
+    assert cited_terms(terms, "[https://doi.org/10.1000%2Fxyz paper]") == {
+        "10.1000/XYZ"
+    }
+
+
+def test_cited_terms_falls_back_to_every_term():
+    assert cited_terms(["10.1000/abc", "123"], "{{Cite Q|Q123}}") == {
+        "10.1000/abc",
+        "123",
+    }
+
+
+def test_search_citing_pages_merges_batches(monkeypatch):
+    first = Page("First")
+    second = Page("Second")
+    results = {
+        'insource:"10.1000/a" OR insource:"10.1000/b"': [first, second],
+        'insource:"5"': [second],
+    }
+
+    def search(query, **kwargs):
+        # Text is only fetched once, when the pages are preloaded.
+        assert not kwargs.get("content")
+        return iter(results[query])
+
+    monkeypatch.setattr(
+        "src.RetractionBot.search.pagegenerators.SearchPageGenerator", search
+    )
+
+    pages = search_citing_pages(
+        Site(), ["10.1000/a", "10.1000/b", "5"], max_length=50, limiter=Limiter()
+    )
+
+    assert pages == {
+        first: {"10.1000/a", "10.1000/b"},
+        second: {"10.1000/a", "10.1000/b", "5"},
+    }
@@ -0,0 +1,44 @@
+import datetime
+
+from conftest import Limiter, Page, Site
+
+from src.RetractionBot.search import cited_terms
+from src.RetractionBot.search_cache import SearchCache
+
+
+def test_pages_cached_under_the_terms_they_cite(database, monkeypatch):
+    first = Page("First", "{{cite journal|doi=10.1000/a}}", pageid=1)
+    second = Page("Second", "{{cite journal|doi=10.1000/B|pmid=5}}", pageid=2)
+    # Found by the search, but cites none of the terms in a form it can
+    # be matched in.
+    third = Page("Third", "{{Cite Q|Q1}}", pageid=3)
+    monkeypatch.setattr(
+        "src.RetractionBot.search.pagegenerators.SearchPageGenerator",
+        lambda query, **kwargs: iter([first, second, third]),
+    )
+    cache = SearchCache(database, "en.wikipedia.org")
+    fetched = datetime.datetime(2024, 1, 1)
+    terms = {"10.1000/a", "10.1000/b", "5", "6"}
+
+    pages = cache.search(Site(), sorted(terms), Limiter(), fetched)
+
+    assert pages == {first: terms, second: terms, third: terms}
+    assert SearchCache(database, "en.wikipedia.org")._entries == {}
+
+    cache.save({page: cited_terms(found, page.text) for page, found in pages.items()})
+
+    cached = SearchCache(database, "en.wikipedia.org")
+    assert {x: cached._entries[x][0] for x in terms} == {
+        "10.1000/a": [1, 3],
+        "10.1000/b": [2, 3],
+        "5": [2, 3],
+        "6": [3],
+    }
+    assert {cached._entries[x][1] for x in terms} == {fetched}
+
+    # Only terms searched since the last save are written.
+    cache.save({first: {"10.1000/b"}})
+    assert SearchCache(database, "en.wikipedia.org")._entries["10.1000/b"][0] == [
+        2,
+        3,
+    ]
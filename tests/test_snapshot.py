@@ -0,0 +1,56 @@
+import datetime
+
+import pytest
+from conftest import row
+
+from src.RetractionBot.retraction_bot import load_index
+from src.RetractionBot.retraction_index import RetractionIndex
+from src.RetractionBot.snapshot import SnapshotIndex, write_snapshot
+
+
+@pytest.fixture
+def index():
+    rows = [row("10.1000/a", "10.1000/a.notice", "123"), row("", "0", "456")]
+    versions = {("doi", "10.1000/a"): datetime.datetime(2024, 1, 1)}
+    return RetractionIndex(rows, versions)
+
+
+@pytest.fixture
+def snapshot(index, tmp_path):
+    path = str(tmp_path / "retractions.snapshot")
+    write_snapshot(path, index, [(b"10.1000/a", b"123"), (b"", b"456")])
+    with SnapshotIndex(path) as snapshot:
+        yield snapshot
+
+
+def test_snapshot_matches_index(index, snapshot):
+    assert len(snapshot) == len(index)
+    assert snapshot.dataset_version == index.dataset_version
+    assert sorted(
+        (key, [x.retraction_doi for x in records]) for key, records in snapshot.items()
+    ) == sorted(
+        (key, [x.retraction_doi for x in records]) for key, records in index.items()
+    )
+    assert snapshot.retracted_identifiers() == [(b"10.1000/a", b"123"), (b"", b"456")]
+
+
+@pytest.mark.parametrize("text", ["pmid=0", "PMID: 000", "pubmed/0"])
+def test_matcher_skips_zero_pmids(snapshot, text):
+    assert snapshot.matcher.find(text + " and pmid=456") == [
+        (len(text) + 10, len(text) + 13, "pmid", "456")
+    ]
+
+
+def test_load_index_without_snapshot_path(index):
+    class Database:
+        def load_retractions(self):
+            return [row("10.1000/a", "10.1000/a.notice")]
+
+        def load_identifier_versions(self):
+            return {}
+
+    # An empty snapshot section in bot_settings.yml loads as None.
+    loaded = load_index(Database(), {"snapshot": None})
+
+    assert isinstance(loaded, RetractionIndex)
+    assert "10.1000/a" in loaded
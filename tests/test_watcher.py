@@ -0,0 +1,196 @@
+import os
+import threading
+
+import conftest
+import pytest
+from conftest import row
+
+from src.RetractionBot import watcher
+from src.RetractionBot.retraction_index import RetractionIndex
+from src.RetractionBot.watcher import Watcher, is_article_edit, parse_events
+
+EVENTS = os.path.join(os.path.dirname(__file__), "data", "recentchange.sse")
+
+CITATION = "<ref>{{cite journal|doi=10.1000/a}}</ref>"
+
+REVISIONS = {
+    10: (1, "Adds a retracted DOI", "A claim."),
+    11: (1, "Adds a retracted DOI", "A claim." + CITATION),
+    12: (1, "Adds a retracted DOI", "A claim." + CITATION + " Another."),
+    20: (2, "Already cited", "Old." + CITATION),
+    21: (2, "Already cited", "New." + CITATION),
+    50: (5, "New article", "A stub.<ref>{{cite journal|doi=10.1000/b}}</ref>"),
+}
+
+BOT_SETTINGS = {
+    "template_name_map": {"en": {"Retracted": "Retracted"}},
+    "template_field_names": {"en": {"doi": "doi", "pmid": "pmid"}},
+    "summary_map": {"en": "Flagging retracted citations"},
+    "watch": {"max_delay": 60, "index_reload_interval": 3600},
+    "rate_limit": {"rate": 1000},
+}
+
+
+class Request:
+    def __init__(self, revids):
+        self.revids = revids
+
+    def submit(self):
+        pages = {}
+        for revid in self.revids:
+            if revid in REVISIONS:
+                page_id, title, text = REVISIONS[revid]
+                pages.setdefault(page_id, {"pageid": page_id, "title": title})
+                pages[page_id].setdefault("revisions", []).append(
+                    {"revid": revid, "slots": {"main": {"content": text}}}
+                )
+        return {"query": {"pages": list(pages.values())}}
+
+
+class Site(conftest.Site):
+    def __init__(self):
+        super().__init__()
+        self.fetched = []
+        self.requested = threading.Event()
+
+    def login(self):
+        pass
+
+    def username(self):
+        return "RetractionBot"
+
+    def simple_request(self, revids, **kwargs):
+        self.fetched.append(sorted(revids))
+        self.requested.set()
+        return Request(revids)
+
+
+class Database:
+    def load_template_decisions(self, language, build_hash):
+        return None
+
+
+class Edits:
+    def __init__(self):
+        self.added = []
+        self.closed = False
+
+    def start(self):
+        pass
+
+    def add(self, edit):
+        self.added.append(edit)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def site(monkeypatch):
+    site = Site()
+    index = RetractionIndex(
+        [row("10.1000/a", "10.1000/a.notice"), row("10.1000/b", "0", "0", "456")]
+    )
+    monkeypatch.setattr(watcher.pywikibot, "Site", lambda *args: site)
+    monkeypatch.setattr(watcher, "load_index", lambda *args: index)
+    monkeypatch.setattr(watcher, "check_bot_killswitches", lambda site: True)
+    return site
+
+
+@pytest.fixture
+def bot(site):
+    bot = Watcher(BOT_SETTINGS, Database())
+    bot.wikis["en.wikipedia.org"].edits = Edits()
+    return bot
+
+
+def test_parse_events_reads_recorded_stream():
+    with open(EVENTS, encoding="utf-8") as lines:
+        events = list(parse_events(lines))
+
+    assert len(events) == 8
+    assert events[0][0] == (
+        '[{"topic":"eqiad.mediawiki.recentchange","partition":0,"offset":1000}]'
+    )
+    assert '"title": "Already cited"\n, "user"' in events[1][1]
+
+
+def test_watcher_flags_newly_cited_works(site, bot):
+    bot.run(EVENTS)
+
+    edits = bot.wikis["en.wikipedia.org"].edits
+    assert edits.closed
+    assert [(x.page_id, x.title, x.base_revid, x.changes) for x in edits.added] == [
+        (1, "Adds a retracted DOI", 12, ["10.1000/a"]),
+        (5, "New article", 50, ["10.1000/b"]),
+    ]
+    assert edits.added[0].text == (
+        "A claim.<ref>{{cite journal|doi=10.1000/a}}"
+        "{{Retracted|doi=10.1000/a.notice}}</ref> Another."
+    )
+    # The edits are fetched in one batch, then the old revisions of the
+    # pages whose new ones cite a retracted work.
+    assert site.fetched == [[12, 21, 50], [10, 20]]
+
+
+def test_article_edits_only():
+    with open(EVENTS, encoding="utf-8") as lines:
+        titles = [
+            x["title"]
+            for x in (watcher.json.loads(data) for _, data in parse_events(lines))
+            if is_article_edit(x)
+        ]
+
+    assert "Talk:Adds a retracted DOI" not in titles
+    assert "Deleted" not in titles
+
+
+def test_due_batch_flushed_while_feed_is_quiet(site, bot, monkeypatch):
+    finished = threading.Event()
+
+    def follow(source):
+        yield {
+            "type": "new",
+            "namespace": 0,
+            "server_name": "en.wikipedia.org",
+            "title": "New article",
+            "user": "Editor",
+            "revision": {"new": 50},
+        }
+        # No more events until the batch has been checked.
+        assert site.requested.wait(5)
+        finished.set()
+
+    monkeypatch.setattr(watcher, "follow", follow)
+    monkeypatch.setattr(watcher, "FLUSH_CHECK_INTERVAL", 0.01)
+    bot.wikis["en.wikipedia.org"].max_delay = 0.05
+
+    bot.run("events")
+
+    assert finished.is_set()
+    assert [x.title for x in bot.wikis["en.wikipedia.org"].edits.added] == [
+        "New article"
+    ]
+
+
+def test_reload_replaces_index_and_engine_together(bot, monkeypatch):
+    class Snapshot(RetractionIndex):
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    wiki = bot.wikis["en.wikipedia.org"]
+    old = bot.index = Snapshot()
+    wiki.set_index(old)
+    _, old_engine = wiki.checker
+    new = RetractionIndex()
+    monkeypatch.setattr(watcher, "load_index", lambda *args: new)
+    bot.index_reload_interval = 0
+
+    bot.reload_index()
+
+    index, engine = wiki.checker
+    assert index is new and engine is not old_engine
+    # An edit being rebased on the writer thread may still be using it.
+    assert not old.closed